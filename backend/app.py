@@ -1,23 +1,86 @@
 # app.py
+import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
+from sqlalchemy import event
 from routes import init_routes
-from models import db
+from models import db, DashboardKpi
+from migrations import upgrade_schema
+from commands import init_commands
+from utils import rebuild_kpis, token_revoked
+from search import ensure_product_search
+from metrics import init_metrics
 
-def create_app():
+def _configure_sqlite(engine, busy_timeout_ms):
+    """WAL (readers never block the writer) and a busy timeout (writers queue instead of
+    failing with "database is locked") on every new SQLite connection."""
+    if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+        return
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout_ms)}')
+        cursor.execute('PRAGMA synchronous=NORMAL')  # Durable enough with WAL, far fewer fsyncs
+        cursor.close()
+
+def _archive_uri(database_uri):
+    """Default archive database: next to the main SQLite file (stockmaster.db -> stockmaster-archive.db)"""
+    if database_uri.endswith('.db'):
+        return database_uri[:-3] + '-archive.db'
+    return 'sqlite://'  # In-memory main database: keep the archive in memory too
+
+def create_app(config=None):
     app = Flask(__name__)
     app.config['SECRET_KEY'] = 'your-secret-key-here'  # Change in production
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///stockmaster.db'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['JWT_SECRET_KEY'] = 'your-jwt-secret-key-here'  # Change in production
-    CORS(app)  # Enable CORS for React frontend
+    app.config['TOKEN_VERSION_CACHE_SECONDS'] = 30  # Revoked tokens stop working in other workers within this
+    app.config['OTP_STORE'] = 'sqlite'  # Password-reset codes: 'sqlite' (shared by all workers) or 'memory'
+    app.config['OTP_MAX_ATTEMPTS'] = 5  # Wrong guesses before a reset code is burnt
+    app.config['OTP_REQUEST_LIMIT'] = 3  # Reset codes one address may request per window
+    app.config['OTP_REQUEST_WINDOW_SECONDS'] = 900
+    app.config['PER_WAREHOUSE_REFERENCES'] = False  # True: WH2/IN/0001 instead of WH/IN/0001
+    app.config['REFERENCE_BLOCK_SIZE'] = 1  # >1: each worker reserves reference numbers in blocks
+    app.config['SQLITE_BUSY_TIMEOUT_MS'] = 30000  # How long a writer waits for the lock
+    app.config['ASYNC_LINE_THRESHOLD'] = 500  # Documents with more lines are validated by a background job
+    app.config['JOB_POLL_INTERVAL'] = 1.0  # Seconds an idle worker waits before looking again
+    app.config['JOB_STALE_AFTER'] = 600  # Running jobs without a heartbeat for this long are re-queued
+    app.config['JOB_UPLOAD_DIR'] = os.path.join(app.instance_path, 'uploads')  # Spooled import files
+    app.config['EVENT_POLL_INTERVAL'] = 1.0  # Seconds between outbox reads of an open SSE stream
+    app.config['EVENT_KEEPALIVE_SECONDS'] = 15  # Comment line sent on quiet streams (proxies drop idle ones)
+    app.config['EVENT_STREAM_MAX_SECONDS'] = 300  # Streams end here; EventSource reconnects with Last-Event-ID
+    app.config['EVENT_RETENTION_DAYS'] = 7  # `flask --app app prune-events` drops older outbox rows
+    app.config['SNAPSHOT_INTERVAL_HOURS'] = 24  # Idle workers queue a stock snapshot this often (0 = never)
+    app.config['SNAPSHOT_FULL_EVERY'] = 7  # Every Nth snapshot run copies all quants; the others only changed pairs
+    app.config['ARCHIVE_DATABASE_URI'] = None  # Archived stock moves; None = next to the main database
+    app.config['METRICS_ENABLED'] = True  # Per-route request / SQL metrics at /metrics (Prometheus text format)
+    app.config['ARCHIVE_AFTER_DAYS'] = 365  # `flask --app app archive-moves` default age (rounded to a month start)
+    if config:
+        app.config.update(config)  # e.g. tests pointing at a temporary database
+    app.config['SQLALCHEMY_BINDS'] = {
+        'archive': app.config['ARCHIVE_DATABASE_URI'] or _archive_uri(app.config['SQLALCHEMY_DATABASE_URI']),
+        **app.config.get('SQLALCHEMY_BINDS', {})
+    }
+    CORS(app, expose_headers=['X-Next-Cursor'])  # Enable CORS for React frontend
     db.init_app(app)
     jwt = JWTManager(app)
+    jwt.token_in_blocklist_loader(lambda jwt_header, jwt_payload: token_revoked(jwt_payload))
     init_routes(app)
+    init_commands(app)
     with app.app_context():
+        for engine in db.engines.values():  # Before the first connection
+            _configure_sqlite(engine, app.config['SQLITE_BUSY_TIMEOUT_MS'])
+        if app.config['METRICS_ENABLED']:
+            init_metrics(app)
         db.create_all()
+        upgrade_schema()  # Add indexes missing from databases created by older versions
+        app.extensions['product_fts'] = ensure_product_search()  # Full-text product search (FTS5)
+        if not DashboardKpi.query.get(1):
+            rebuild_kpis()  # First start (or after populate_db): seed the KPI counters
     return app
 
 if __name__ == '__main__':
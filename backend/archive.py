@@ -0,0 +1,120 @@
+# archive.py — moving old StockMove history out of the main database
+# Done moves created before a cutoff (always a month start) are copied to the archive database
+# (bind 'archive'), folded into monthly StockMoveRollup rows and deleted from stock_move. The
+# move-history API and point-in-time stock only read the archive when asked about older dates.
+from datetime import datetime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, StockMove, ArchivedStockMove, StockMoveRollup, MoveArchiveRun
+
+ARCHIVE_BATCH_SIZE = 5000
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+def archive_bounds():
+    """(cutoff, through_move_id): moves created before cutoff may be archived; archive rows above
+    through_move_id are still in stock_move (a batch in flight) and must be ignored by readers."""
+    return db.session.query(db.func.max(MoveArchiveRun.cutoff),
+                            db.func.coalesce(db.func.max(MoveArchiveRun.through_move_id), 0)).one()
+
+def archive_conditions(since):
+    """Filter for reading ArchivedStockMove when a query starting at `since` reaches archived
+    dates; None when stock_move alone answers it (since is None or not before the cutoff)."""
+    if since is None:
+        return None
+    cutoff, through_move_id = archive_bounds()
+    if cutoff is None or since >= cutoff:
+        return None
+    return [ArchivedStockMove.id <= through_move_id]
+
+def _rollup_rows(moves):
+    totals = {}
+    for move in moves:
+        month = move['created_at'].strftime('%Y-%m')
+        for warehouse_id, field in ((move['to_location_id'], 'qty_in'), (move['from_location_id'], 'qty_out')):
+            if warehouse_id is None:
+                continue  # Vendor / customer side
+            row = totals.setdefault((move['product_id'], warehouse_id, month), {
+                'product_id': move['product_id'], 'warehouse_id': warehouse_id, 'month': month,
+                'qty_in': 0.0, 'qty_out': 0.0, 'move_count': 0})
+            row[field] += move['quantity'] or 0.0
+            row['move_count'] += 1
+    return list(totals.values())
+
+def _add_rollups(rows):
+    table = StockMoveRollup.__table__
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(index_elements=['product_id', 'warehouse_id', 'month'], set_={
+        'qty_in': table.c.qty_in + stmt.excluded.qty_in,
+        'qty_out': table.c.qty_out + stmt.excluded.qty_out,
+        'move_count': table.c.move_count + stmt.excluded.move_count})
+    db.session.execute(stmt, rows)
+
+def archive_moves(before, progress=None):
+    """Archive the done moves created before `before` (rounded down to a month start); returns the run.
+
+    Each batch is copied to the archive database first (committed there), then rolled up and
+    deleted from stock_move in one main-database transaction. An interrupted run leaves at most
+    one batch in both places, above through_move_id: readers ignore it, and the next run drops
+    it from the archive before copying the batch again. Move ids are never reused
+    (AUTOINCREMENT), so any other id already in the archive is an error, not a duplicate to skip.
+    """
+    through_move_id = archive_bounds()[1]
+    run = MoveArchiveRun(cutoff=month_start(before), started_at=datetime.utcnow())
+    db.session.add(run)
+    db.session.commit()
+    table = StockMove.__table__
+    archive_table = ArchivedStockMove.__table__
+    with db.engines['archive'].begin() as conn:
+        conn.execute(archive_table.delete().where(archive_table.c.id > through_move_id))
+    pending = db.and_(table.c.created_at < run.cutoff, db.func.coalesce(table.c.state, 'done') == 'done')
+    while True:
+        batch = [dict(row) for row in db.session.execute(
+            db.select(table).where(pending).order_by(table.c.id).limit(ARCHIVE_BATCH_SIZE)).mappings()]
+        if not batch:
+            break
+        with db.engines['archive'].begin() as conn:
+            conn.execute(archive_table.insert(), batch)
+        ids = [move['id'] for move in batch]
+        _add_rollups(_rollup_rows(batch))
+        db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        run.through_move_id = max(run.through_move_id or 0, ids[-1])
+        run.move_count = (run.move_count or 0) + len(batch)
+        db.session.commit()
+        if progress:
+            progress(run.move_count)
+    run.finished_at = datetime.utcnow()
+    db.session.commit()
+    return run
+
+def monthly_totals(product_id=None, warehouse_id=None):
+    """[{month, qty_in, qty_out, net, move_count}]: archived months from the rollups, the rest live"""
+    months = {}
+    def add(month, qty_in, qty_out, count):
+        row = months.setdefault(month, {'month': month, 'qty_in': 0.0, 'qty_out': 0.0, 'move_count': 0})
+        row['qty_in'] += qty_in or 0.0
+        row['qty_out'] += qty_out or 0.0
+        row['move_count'] += count or 0
+
+    rollups = db.session.query(StockMoveRollup.month, db.func.sum(StockMoveRollup.qty_in),
+                               db.func.sum(StockMoveRollup.qty_out), db.func.sum(StockMoveRollup.move_count))
+    if product_id:
+        rollups = rollups.filter(StockMoveRollup.product_id == product_id)
+    if warehouse_id:
+        rollups = rollups.filter(StockMoveRollup.warehouse_id == warehouse_id)
+    for month, qty_in, qty_out, count in rollups.group_by(StockMoveRollup.month):
+        add(month, qty_in, qty_out, count)
+
+    month = db.func.strftime('%Y-%m', StockMove.created_at)
+    for column, incoming in ((StockMove.to_location_id, True), (StockMove.from_location_id, False)):
+        live = db.session.query(month, db.func.sum(StockMove.quantity), db.func.count()).filter(column.isnot(None))
+        if product_id:
+            live = live.filter(StockMove.product_id == product_id)
+        if warehouse_id:
+            live = live.filter(column == warehouse_id)
+        for month_key, qty, count in live.group_by(month):
+            add(month_key, qty if incoming else 0.0, 0.0 if incoming else qty, count)
+
+    for row in months.values():
+        row['net'] = row['qty_in'] - row['qty_out']
+    return [months[key] for key in sorted(months)]
@@ -0,0 +1,293 @@
+# benchmarks.py — in-process API benchmarks (Flask test client) against a temporary database
+# Usage: python benchmarks.py api [--scale 1k|100k|1m] [--requests 50] [--runs 5] [--update-baseline]
+#        python benchmarks.py serialization [--rows 50000] [--repeat 5]
+# `api` times the hot endpoints on a database seeded at the chosen scale and fails (exit 1) when
+# latency or query counts regress against benchmark_baseline.json. `serialization` compares the
+# old ORM + to_dict() + jsonify path with the SQL projection / compact encoder path.
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+from flask import jsonify
+from sqlalchemy import event
+from app import create_app
+from models import db, Warehouse, Product, StockQuant, StockMove
+import utils
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}  # Products, and as many stock moves
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+SEED_CHUNK_SIZE = 10000
+BENCH_WAREHOUSES = 10
+LINES_PER_DOCUMENT = 5
+
+def _timed(fn, repeat):
+    """(median seconds, response bytes) over repeat runs"""
+    timings, size = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = len(fn())
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), size
+
+def seed_serialization(rows):
+    """rows StockQuants (products x 50 warehouses) and rows StockMoves of product 1, bulk inserted"""
+    warehouses = 50
+    products = max(rows // warehouses, 1)
+    now = datetime.utcnow()
+    db.session.execute(Warehouse.__table__.insert(), [
+        {'name': f'Bench {i}', 'short_code': f'B{i}', 'created_at': now} for i in range(warehouses)])
+    db.session.execute(Product.__table__.insert(), [
+        {'name': f'Bench product {i}', 'sku': f'BENCH-{i}', 'cost': 1.0, 'created_at': now} for i in range(products)])
+    db.session.execute(StockQuant.__table__.insert(), [
+        {'product_id': p + 1, 'warehouse_id': w + 1, 'quantity': 10.0, 'binned_qty': 0.0, 'reserved_qty': 0.0,
+         'created_at': now} for p in range(products) for w in range(warehouses)])
+    db.session.execute(StockMove.__table__.insert(), [
+        {'reference': f'WH/IN/{i:05d}', 'product_id': 1, 'to_location_id': i % warehouses + 1, 'quantity': 1.0,
+         'move_type': 'receipt', 'state': 'done', 'created_at': now - timedelta(minutes=i)} for i in range(rows)])
+    db.session.commit()
+
+def _bench_app():
+    """(app, test client, manager auth headers) on a fresh temporary database"""
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{db_path}"})
+    client = app.test_client()
+    client.post("/api/auth/register", json={"email": "bench@test.com", "password": "b", "role": "manager"})
+    token = client.post("/api/auth/login", json={"email": "bench@test.com", "password": "b"}).json["access_token"]
+    return app, client, {"Authorization": f"Bearer {token}"}
+
+def bench_serialization(rows=50000, repeat=5):
+    app, client, headers = _bench_app()
+    with app.app_context():
+        seed_serialization(rows)
+
+    def old_path(query):
+        def run():
+            with app.test_request_context():
+                return jsonify([row.to_dict() for row in query()]).get_data()
+        return run
+
+    def endpoint(url, encoder=utils.orjson):
+        def run():
+            saved, utils.orjson = utils.orjson, encoder
+            try:
+                response = client.get(url, headers=headers)
+                assert response.status_code == 200, response.get_data(as_text=True)
+                return response.get_data()
+            finally:
+                utils.orjson = saved
+        return run
+
+    page = f"limit={utils.MAX_PAGE_SIZE}"  # Both lists are paginated: compare one full page
+    cases = [
+        ('/stock-quants', [
+            ('ORM + to_dict + jsonify (before)', old_path(
+                lambda: StockQuant.query.order_by(StockQuant.id).limit(utils.MAX_PAGE_SIZE).all())),
+            ('SQL rows + json module', endpoint(f'/api/stock-quants?{page}', encoder=None)),
+            ('SQL rows + orjson', endpoint(f'/api/stock-quants?{page}')),
+            ('fields=product_id,warehouse_id,quantity', endpoint(f'/api/stock-quants?{page}&fields=product_id,warehouse_id,quantity')),
+            ('format=rows', endpoint(f'/api/stock-quants?{page}&format=rows')),
+        ]),
+        ('/stock-moves/product/1', [
+            ('ORM + to_dict + jsonify (before)', old_path(
+                lambda: StockMove.query.filter_by(product_id=1).order_by(StockMove.created_at.desc(), StockMove.id.desc())
+                .limit(utils.MAX_PAGE_SIZE).all())),
+            ('SQL rows + json module', endpoint(f'/api/stock-moves/product/1?{page}', encoder=None)),
+            ('SQL rows + orjson', endpoint(f'/api/stock-moves/product/1?{page}')),
+            ('fields=id,quantity,created_at', endpoint(f'/api/stock-moves/product/1?{page}&fields=id,quantity,created_at')),
+            ('format=rows', endpoint(f'/api/stock-moves/product/1?{page}&format=rows')),
+        ]),
+    ]
+    print(f"{rows} rows, pages of {utils.MAX_PAGE_SIZE}, median of {repeat} runs, orjson {'available' if utils.orjson else 'not installed'}")
+    for title, variants in cases:
+        print(f"\n{title}")
+        baseline = None
+        for name, fn in variants:
+            seconds, size = _timed(fn, repeat)
+            baseline = baseline or seconds
+            print(f"  {name:<42} {seconds * 1000:8.1f} ms  {size / 1024:8.0f} KiB  x{baseline / seconds:4.1f}")
+
+def _insert_chunks(table, rows):
+    """Bulk insert an iterable of row dicts SEED_CHUNK_SIZE at a time"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == SEED_CHUNK_SIZE:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+
+def seed_scale(size):
+    """size products spread over BENCH_WAREHOUSES warehouses and size done receipt moves.
+
+    Product p lives in warehouse (p - 1) % BENCH_WAREHOUSES + 1; the quants are the sums of
+    the moves, so stock, moves and the dashboard KPIs agree.
+    """
+    now = datetime.utcnow()
+    home = lambda product_id: (product_id - 1) % BENCH_WAREHOUSES + 1
+    _insert_chunks(Warehouse.__table__, ({'name': f'Bench {i}', 'short_code': f'B{i}', 'created_at': now}
+                                         for i in range(1, BENCH_WAREHOUSES + 1)))
+    _insert_chunks(Product.__table__, ({'name': f'Bench product {i}', 'sku': f'BENCH-{i}', 'cost': 1.0,
+                                        'reorder_min': 10, 'unit_of_measure': 'pcs', 'created_at': now}
+                                       for i in range(1, size + 1)))
+    _insert_chunks(StockMove.__table__, ({'reference': f'WH/IN/{i:07d}', 'product_id': i % size + 1,
+                                          'to_location_id': home(i % size + 1), 'quantity': 100.0,
+                                          'move_type': 'receipt', 'state': 'done',
+                                          'created_at': now - timedelta(minutes=i % 525600)} for i in range(size)))
+    db.session.execute(StockQuant.__table__.insert().from_select(
+        ['product_id', 'warehouse_id', 'quantity', 'binned_qty', 'reserved_qty', 'created_at'],
+        db.select(StockMove.product_id, StockMove.to_location_id, db.func.sum(StockMove.quantity),
+                  db.literal(0.0), db.literal(0.0), db.literal(now))
+        .group_by(StockMove.product_id, StockMove.to_location_id)))
+    db.session.commit()
+    utils.rebuild_kpis()
+
+def _percentile(samples, pct):
+    """Nearest-rank percentile of a sorted list"""
+    return samples[max(math.ceil(pct / 100 * len(samples)) - 1, 0)]
+
+def api_cases(client, headers):
+    """[(name, method, prepare)]: prepare() runs untimed and returns the URL for one request"""
+    stocked = list(range(1, BENCH_WAREHOUSES * LINES_PER_DOCUMENT + 1, BENCH_WAREHOUSES))  # Warehouse 1 products
+
+    def created(url, body):
+        response = client.post(url, json=body, headers=headers)
+        assert response.status_code == 201, response.get_data(as_text=True)
+        return response.json['id']
+
+    def receipt():
+        return f"/api/receipts/{created('/api/receipts', {'vendor': 'Bench', 'warehouse_id': 1, 'lines': [{'product_id': p, 'demand_qty': 1, 'done_qty': 1} for p in stocked]})}/validate"
+
+    def delivery():
+        delivery_id = created('/api/deliveries', {'delivery_address': 'Bench', 'warehouse_id': 1, 'lines': [
+            {'product_id': p, 'demand_qty': 1, 'done_qty': 1} for p in stocked]})
+        client.post(f"/api/deliveries/{delivery_id}/mark-ready", headers=headers)
+        return f"/api/deliveries/{delivery_id}/validate"
+
+    def transfer():
+        return f"/api/transfers/{created('/api/transfers', {'from_warehouse_id': 1, 'to_warehouse_id': 2, 'lines': [{'product_id': p, 'quantity': 1} for p in stocked]})}/validate"
+
+    def count():
+        count_id = created('/api/adjustments/counts', {'warehouse_id': 1})
+        client.post(f"/api/adjustments/counts/{count_id}/lines", headers=headers, json={'lines': [
+            {'product_id': p, 'counted_qty': 100} for p in stocked]})
+        return f"/api/adjustments/counts/{count_id}/apply"
+
+    return [
+        ('GET /products', 'get', lambda: '/api/products'),
+        ('GET /stock-moves', 'get', lambda: '/api/stock-moves'),
+        ('GET /dashboard/summary', 'get', lambda: '/api/dashboard/summary'),
+        ('POST /receipts/<id>/validate', 'post', receipt),
+        ('POST /deliveries/<id>/validate', 'post', delivery),
+        ('POST /transfers/<id>/validate', 'post', transfer),
+        ('POST /adjustments/counts/<id>/apply', 'post', count),
+    ]
+
+def bench_api(scale='1k', requests=50, runs=5):
+    """{case: {p50_ms, p99_ms, queries}} for the hot endpoints at scale.
+
+    Every case is timed in runs rounds of requests requests; p50 and p99 are the medians of the
+    per-round percentiles, so one slow request (GC pause, page cache miss) does not set p99.
+    queries is the most SQL statements any single request of the case executed.
+    """
+    app, client, headers = _bench_app()
+    with app.app_context():
+        start = time.perf_counter()
+        seed_scale(SCALES[scale])
+        print(f"Seeded {scale} in {time.perf_counter() - start:.1f} s")
+        engine = db.engine
+    statements = [0]
+    def count_statement(*args):
+        statements[0] += 1
+    event.listen(engine, "before_cursor_execute", count_statement)
+    cases = api_cases(client, headers)
+    rounds = {name: ([], [], [0]) for name, _, _ in cases}  # name -> (p50s, p99s, [queries])
+    try:
+        # Rounds go over all the cases in turn, so a slow stretch of the machine hits one round of each
+        for _ in range(runs):
+            for name, method, prepare in cases:
+                getattr(client, method)(prepare(), headers=headers)  # Untimed warm-up (statement cache, pages)
+                p50s, p99s, queries = rounds[name]
+                timings = []
+                for _ in range(requests):
+                    url = prepare()
+                    statements[0] = 0
+                    started = time.perf_counter()
+                    response = getattr(client, method)(url, headers=headers)
+                    timings.append(time.perf_counter() - started)
+                    assert response.status_code == 200, f"{name}: {response.status_code} {response.get_data(as_text=True)}"
+                    queries[0] = max(queries[0], statements[0])
+                timings.sort()
+                p50s.append(_percentile(timings, 50))
+                p99s.append(_percentile(timings, 99))
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    return {name: {'p50_ms': round(statistics.median(p50s) * 1000, 2), 'p99_ms': round(statistics.median(p99s) * 1000, 2),
+                   'queries': queries[0]} for name, (p50s, p99s, queries) in rounds.items()}
+
+def compare_to_baseline(results, baseline, tolerance=0.5, slack_ms=2.0):
+    """Regression messages: latency above baseline * (1 + tolerance) + slack_ms, or more queries"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            limit = base[key] * (1 + tolerance) + slack_ms
+            if result[key] > limit:
+                regressions.append(f"{name}: {key} {result[key]:.1f} > {limit:.1f} (baseline {base[key]:.1f})")
+        if result['queries'] > base['queries']:
+            regressions.append(f"{name}: {result['queries']} queries > baseline {base['queries']}")
+    return regressions
+
+def run_api_benchmarks(scale, requests, baseline_path=BASELINE_PATH, update_baseline=False, tolerance=0.5, runs=5):
+    """Print the results; returns False when they regressed against the stored baseline"""
+    results = bench_api(scale, requests, runs)
+    stored = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            stored = json.load(f)
+    baseline = stored.get(scale, {})
+    print(f"\n{scale} scale, {runs} rounds of {requests} requests per endpoint")
+    print(f"  {'endpoint':<36} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8}   baseline p50/p99/queries")
+    for name, result in results.items():
+        base = baseline.get(name)
+        reference = f"{base['p50_ms']:.1f} / {base['p99_ms']:.1f} / {base['queries']}" if base else "-"
+        print(f"  {name:<36} {result['p50_ms']:8.1f} {result['p99_ms']:8.1f} {result['queries']:8}   {reference}")
+    if update_baseline:
+        stored[scale] = results
+        with open(baseline_path, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"\nBaseline for {scale} written to {baseline_path}")
+        return True
+    regressions = compare_to_baseline(results, baseline, tolerance)
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    if not baseline:
+        print(f"\nNo {scale} baseline yet (run with --update-baseline)")
+    return not regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='In-process StockMaster benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    api = commands.add_parser('api', help='Latency and query counts of the hot endpoints')
+    api.add_argument('--scale', choices=SCALES, default='1k')
+    api.add_argument('--requests', type=int, default=50, help='Timed requests per endpoint and round')
+    api.add_argument('--runs', type=int, default=5, help='Rounds per endpoint; percentiles are their medians')
+    api.add_argument('--baseline', default=BASELINE_PATH)
+    api.add_argument('--update-baseline', action='store_true', help='Store these results as the new baseline')
+    api.add_argument('--tolerance', type=float, default=0.5, help='Allowed latency increase (0.5 = +50%%)')
+    serialization = commands.add_parser('serialization', help='List serialization paths compared')
+    serialization.add_argument('--rows', type=int, default=50000)
+    serialization.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if args.command == 'api':
+        sys.exit(0 if run_api_benchmarks(args.scale, args.requests, args.baseline, args.update_baseline,
+                                         args.tolerance, args.runs) else 1)
+    bench_serialization(args.rows, args.repeat)
@@ -0,0 +1,51 @@
+# commands.py — maintenance commands, e.g. `flask --app app rebuild-kpis`
+import click
+from datetime import datetime, timedelta
+from flask import current_app
+from utils import rebuild_kpis
+from jobs import run_worker, start_worker_pool, worker_config
+from events import prune_events
+from models import db
+from snapshots import take_snapshot
+from archive import archive_moves
+
+def init_commands(app):
+    @app.cli.command('rebuild-kpis')
+    def rebuild_kpis_command():
+        """Recompute the dashboard KPI counters from the current tables."""
+        kpi = rebuild_kpis()
+        click.echo(f"KPIs rebuilt: {kpi.total_products} products, stock value {kpi.total_stock_value:.2f}")
+
+    @app.cli.command('worker')
+    @click.option('--processes', default=2, show_default=True, help='Worker processes to run.')
+    @click.option('--once', is_flag=True, help='Run queued jobs in this process, then exit.')
+    def worker_command(processes, once):
+        """Run background jobs (validations, imports, rebuilds) from the job queue."""
+        if once:
+            click.echo(f"Ran {run_worker(once=True)} job(s)")
+            return
+        click.echo(f"Starting {processes} worker process(es); Ctrl+C to stop")
+        start_worker_pool(worker_config(current_app.config), processes)
+
+    @app.cli.command('prune-events')
+    def prune_events_command():
+        """Delete outbox events older than EVENT_RETENTION_DAYS."""
+        removed = prune_events(current_app.config['EVENT_RETENTION_DAYS'])
+        click.echo(f"Removed {removed} event(s)")
+
+    @app.cli.command('snapshot-stock')
+    @click.option('--full', is_flag=True, help='Copy every quant instead of only the changed ones.')
+    def snapshot_stock_command(full):
+        """Record a stock snapshot run for point-in-time (as_of) queries."""
+        run = take_snapshot(full=True if full else None)
+        db.session.commit()
+        click.echo(f"Snapshot {run.id}: {run.row_count} row(s), {'full' if run.is_full else 'incremental'}")
+
+    @app.cli.command('archive-moves')
+    @click.option('--before', help='Archive moves created before this date (rounded down to a month start).')
+    def archive_moves_command(before):
+        """Move old stock moves to the archive database, keeping monthly rollups."""
+        cutoff = datetime.fromisoformat(before) if before else \
+            datetime.utcnow() - timedelta(days=current_app.config['ARCHIVE_AFTER_DAYS'])
+        run = archive_moves(cutoff, progress=lambda count: click.echo(f"  {count} move(s) archived"))
+        click.echo(f"Archived {run.move_count} move(s) created before {run.cutoff:%Y-%m-%d}")
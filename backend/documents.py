@@ -0,0 +1,80 @@
+# documents.py — validating documents (receipts, deliveries, transfers, count sessions)
+# Shared by the HTTP routes and the background job worker; the caller commits.
+from datetime import datetime
+from models import db, Receipt, Delivery, Transfer, Adjustment, AdjustmentLine
+from utils import post_moves, bump_kpis, release_reservations, transition, apply_counts
+
+class StatusConflict(Exception):
+    """Another request changed the document's status first (HTTP 409)"""
+
+def _check_lines(lines):
+    for line in lines:
+        if line.done_qty > line.demand_qty:  # Prevent over-receipt / over-delivery
+            raise ValueError(f'Done qty cannot exceed demand for product {line.product_id}')
+
+def validate_receipt(receipt, user_id=None, progress=None):
+    """Post a draft receipt's done quantities into stock (progress: a background job's heartbeat)"""
+    if receipt.status != 'draft':
+        raise ValueError('Receipt must be draft to validate')
+    if progress:
+        progress(0)  # Heartbeat commits, so it goes before the lines are read and posted
+    _check_lines(receipt.receipt_lines)
+    moves = [{'product_id': line.product_id, 'from_location_id': None,
+              'to_location_id': receipt.warehouse_id, 'to_sublocation_id': line.location_id,
+              'quantity': line.done_qty, 'move_type': 'receipt'}
+             for line in receipt.receipt_lines if line.done_qty > 0]
+    # All lines post in one transaction together with the (guarded) status change
+    if not transition(Receipt, receipt.id, ('draft',), 'done', validated_at=datetime.utcnow()):
+        raise StatusConflict('Receipt was already validated or canceled')
+    post_moves(moves, receipt.reference, user_id)
+    bump_kpis(receipts_pending=-1)
+    return {'message': 'Receipt validated, stock updated', 'line_count': len(moves)}
+
+def validate_delivery(delivery, user_id=None, progress=None):
+    """Ship a ready delivery: consume its reservation and take the done quantities out of stock"""
+    if delivery.status != 'ready':
+        raise ValueError('Delivery must be ready to validate')
+    if progress:
+        progress(0)
+    _check_lines(delivery.delivery_lines)
+    moves = [{'product_id': line.product_id, 'from_location_id': delivery.warehouse_id,
+              'from_sublocation_id': line.location_id, 'to_location_id': None,
+              'quantity': line.done_qty, 'move_type': 'delivery'}
+             for line in delivery.delivery_lines if line.done_qty > 0]
+    if not transition(Delivery, delivery.id, ('ready',), 'done', validated_at=datetime.utcnow()):
+        raise StatusConflict('Delivery was already validated or canceled')
+    # The delivery consumes its own reservation; post_moves checks the rest against free stock
+    release_reservations([delivery.id])
+    post_moves(moves, delivery.reference, user_id)
+    bump_kpis(deliveries_pending=-1)
+    return {'message': 'Delivery validated, stock updated', 'line_count': len(moves)}
+
+def validate_transfer(transfer, user_id=None, progress=None):
+    """Move a draft transfer's quantities between warehouses (and bins)"""
+    if transfer.status != 'draft':
+        raise ValueError('Transfer must be draft to validate')
+    if progress:
+        progress(0)
+    # One move per line; source stock is checked by post_moves
+    moves = [{'product_id': line.product_id, 'from_location_id': transfer.from_warehouse_id,
+              'from_sublocation_id': line.from_location_id, 'to_location_id': transfer.to_warehouse_id,
+              'to_sublocation_id': line.to_location_id, 'quantity': line.quantity, 'move_type': 'transfer'}
+             for line in transfer.transfer_lines if line.quantity > 0]
+    if not transition(Transfer, transfer.id, ('draft',), 'done', validated_at=datetime.utcnow()):
+        raise StatusConflict('Transfer was already validated')
+    post_moves(moves, transfer.reference, user_id)
+    bump_kpis(transfers_pending=-1)
+    return {'message': 'Transfer validated, stock moved', 'line_count': len(moves)}
+
+def apply_count_session(adjustment, user_id=None, progress=None):
+    """Apply the staged counts of an open count session"""
+    if adjustment.status != 'open':
+        raise ValueError('Count session is not open')
+    if progress:
+        progress(0)
+    counts = dict(db.session.query(AdjustmentLine.product_id, AdjustmentLine.counted_qty)
+                  .filter_by(adjustment_id=adjustment.id))
+    if not transition(Adjustment, adjustment.id, ('open',), 'done'):
+        raise StatusConflict('Count session was already applied')
+    line_count = apply_counts(adjustment, counts, user_id)
+    return {'message': 'Count applied, stock updated', 'reference': adjustment.reference, 'line_count': line_count}
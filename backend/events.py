@@ -0,0 +1,86 @@
+# events.py — Server-sent events: live clients follow the outbox instead of polling the API
+import json
+import time
+from datetime import datetime, timedelta
+from flask import request, current_app, Response, stream_with_context
+from models import db, OutboxEvent
+
+EVENT_BATCH_SIZE = 500
+
+def _format_event(event_id, topic, payload):
+    return f"id: {event_id}\nevent: {topic}\ndata: {payload}\n\n"
+
+def _newest_event_id():
+    """Highest event id handed out so far — AUTOINCREMENT keeps it even after pruning emptied the outbox"""
+    handed_out = db.session.execute(db.text("SELECT seq FROM sqlite_sequence WHERE name = 'outbox_event'")).scalar()
+    return max(handed_out or 0, db.session.query(db.func.coalesce(db.func.max(OutboxEvent.id), 0)).scalar())
+
+def _start_after(newest):
+    """Last event the client has seen: Last-Event-ID (browser reconnect) or ?last_event_id=.
+
+    A fresh client starts at the newest event, so it only receives changes from now on.
+    """
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_id and last_id.isdigit():
+        return int(last_id)
+    return newest
+
+def event_stream():
+    """text/event-stream response replaying missed events, then following new ones.
+
+    Each poll reads the outbox on a short-lived connection (no session is held open while the
+    client waits). Streams end after EVENT_STREAM_MAX_SECONDS; EventSource reconnects on its own
+    and resumes from Last-Event-ID.
+    """
+    newest = _newest_event_id()
+    last_id = _start_after(newest)
+    topics = [t for t in request.args.get('topics', '').split(',') if t]
+    oldest = db.session.query(db.func.min(OutboxEvent.id)).scalar()
+    db.session.remove()  # Do not keep the request's connection for the life of the stream
+    config = current_app.config
+    poll_interval = config['EVENT_POLL_INTERVAL']
+    keepalive = config['EVENT_KEEPALIVE_SECONDS']
+    deadline = time.monotonic() + config['EVENT_STREAM_MAX_SECONDS']
+    table = OutboxEvent.__table__
+
+    def generate():
+        nonlocal last_id
+        yield f"retry: {int(poll_interval * 1000) * 3}\n\n"
+        if last_id and oldest and last_id < oldest - 1:
+            # Missed events were already pruned: the client must reload everything
+            yield _format_event(oldest - 1, 'reset', json.dumps({'reason': 'events pruned'}))
+        elif last_id > newest:
+            # An id this outbox never handed out (e.g. a restored database): reload, then follow from here
+            yield _format_event(newest, 'reset', json.dumps({'reason': 'unknown event id'}))
+            last_id = newest
+        last_sent = time.monotonic()
+        while time.monotonic() < deadline:
+            query = db.select(table.c.id, table.c.topic, table.c.payload)\
+                .where(table.c.id > last_id).order_by(table.c.id).limit(EVENT_BATCH_SIZE)
+            if topics:
+                query = query.where(table.c.topic.in_(topics))
+            with db.engine.connect() as conn:
+                rows = conn.execute(query).all()
+            for event_id, topic, payload in rows:
+                yield _format_event(event_id, topic, payload)
+                last_id = event_id
+            if rows:
+                last_sent = time.monotonic()
+                if len(rows) == EVENT_BATCH_SIZE:
+                    continue  # Still catching up
+            elif time.monotonic() - last_sent >= keepalive:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(poll_interval)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Do not let a reverse proxy buffer the stream
+    return response
+
+def prune_events(retention_days):
+    """Delete outbox events older than retention_days; returns how many were removed"""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    result = db.session.execute(OutboxEvent.__table__.delete().where(OutboxEvent.__table__.c.created_at < cutoff))
+    db.session.commit()
+    return result.rowcount
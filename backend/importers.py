@@ -0,0 +1,252 @@
+# importers.py — streaming bulk imports (CSV / NDJSON), processed in bounded batches
+import io
+import os
+import csv
+import json
+import shutil
+import tempfile
+from flask import request
+from models import db, Product, Category, Warehouse, AdjustmentLine
+from utils import post_moves, bump_kpis, bump_table_version
+
+IMPORT_BATCH_SIZE = 1000
+MAX_IMPORT_ERRORS = 1000  # Report is capped; error_count keeps the full total
+
+def _upload_source():
+    """(binary stream, format) for a multipart 'file' upload or the raw request body.
+
+    Format comes from ?format=, else the file extension / content type (default csv).
+    """
+    upload = request.files.get('file')
+    if upload:
+        stream, name, content_type = upload.stream, upload.filename or '', upload.mimetype or ''
+    else:
+        stream, name, content_type = io.BufferedReader(request.stream), '', request.mimetype or ''
+    fmt = request.args.get('format')
+    if not fmt:
+        fmt = 'ndjson' if name.endswith(('.ndjson', '.jsonl')) or 'ndjson' in content_type or 'jsonl' in content_type else 'csv'
+    return stream, fmt
+
+def open_upload():
+    """(text stream, format) for the upload; nothing is read up front — rows are pulled as consumed"""
+    stream, fmt = _upload_source()
+    return io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''), fmt
+
+def save_upload(directory):
+    """Spool the upload to a file for a background import job; returns (path, format)"""
+    stream, fmt = _upload_source()
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix='.' + fmt, dir=directory)
+    with os.fdopen(fd, 'wb') as target:
+        shutil.copyfileobj(stream, target, 1024 * 1024)
+    return path, fmt
+
+def open_saved_upload(path):
+    return io.TextIOWrapper(open(path, 'rb'), encoding='utf-8-sig', newline='')
+
+def iter_records(text_stream, fmt):
+    """Yield (row_number, dict) from a CSV (with header) or NDJSON stream; bad JSON yields an error string"""
+    if fmt == 'ndjson':
+        for row_number, line in enumerate(text_stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield row_number, f"Invalid JSON: {e}"
+                continue
+            yield row_number, record if isinstance(record, dict) else "Each line must be a JSON object"
+    else:
+        for row_number, record in enumerate(csv.DictReader(text_stream), start=1):
+            yield row_number, {k.strip(): v.strip() for k, v in record.items() if k and v is not None and v.strip() != ''}
+
+def _batches(records, size):
+    batch = []
+    for item in records:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class ImportReport:
+    """Running totals plus a capped per-row error list"""
+    def __init__(self):
+        self.imported = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, row_number, sku, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_IMPORT_ERRORS:
+            self.errors.append({'row': row_number, 'sku': sku, 'error': message})
+
+    def to_dict(self):
+        return {
+            'imported': self.imported,
+            'error_count': self.error_count,
+            'errors': self.errors,
+            'errors_truncated': self.error_count > len(self.errors)
+        }
+
+def _initial_stock(record):
+    """{warehouse_id: qty} from either initial_stock (NDJSON dict) or warehouse_id + initial_qty columns"""
+    if isinstance(record.get('initial_stock'), dict):
+        return {int(wh_id): float(qty) for wh_id, qty in record['initial_stock'].items() if float(qty) > 0}
+    if record.get('initial_qty') not in (None, ''):
+        qty = float(record['initial_qty'])
+        if qty > 0:
+            if not record.get('warehouse_id'):
+                raise ValueError("warehouse_id required with initial_qty")
+            return {int(record['warehouse_id']): qty}
+    return {}
+
+def _parse_product(record, categories, warehouse_ids):
+    """Validated Product column dict + initial stock for one record; raises ValueError"""
+    sku = str(record.get('sku', '')).strip()
+    name = str(record.get('name', '')).strip()
+    if not sku or not name:
+        raise ValueError("Name and SKU required")
+    category_id = record.get('category_id')
+    if category_id not in (None, ''):
+        category_id = int(category_id)
+    elif record.get('category'):
+        category_name = str(record['category']).strip()
+        category_id = categories.get(category_name, category_name)  # Unknown names are created with the batch
+    else:
+        category_id = None
+    stock = _initial_stock(record)
+    unknown = set(stock) - warehouse_ids
+    if unknown:
+        raise ValueError(f"Unknown warehouse(s): {sorted(unknown)}")
+    return {
+        'name': name,
+        'sku': sku,
+        'category_id': category_id,
+        'unit_of_measure': record.get('unit_of_measure') or 'pcs',
+        'reorder_min': int(float(record.get('reorder_min') or 0)),
+        'cost': float(record.get('cost') or 0.0),
+        'sales_price': float(record.get('sales_price') or 0.0)
+    }, stock
+
+def _resolve_categories(rows, categories):
+    """Create categories referenced by name that do not exist yet; rows get their ids"""
+    new_names = {row['category_id'] for row in rows if isinstance(row['category_id'], str)}
+    if new_names:
+        db.session.execute(Category.__table__.insert(), [{'name': name} for name in new_names])
+        for cat_id, name in db.session.query(Category.id, Category.name).filter(Category.name.in_(new_names)):
+            categories[name] = cat_id
+        bump_table_version('category')
+    for row in rows:
+        if isinstance(row['category_id'], str):
+            row['category_id'] = categories[row['category_id']]
+
+def import_products(records, user_id=None, progress=None):
+    """Import product records in batches of IMPORT_BATCH_SIZE, one commit per batch.
+
+    Per batch: one query for SKUs that already exist, one executemany INSERT, one query for the
+    new ids, and initial stock posted through the move ledger (post_moves). Memory stays bounded
+    by the batch size no matter how long the input is. Returns an ImportReport.
+    """
+    report = ImportReport()
+    categories = dict((name, cat_id) for cat_id, name in db.session.query(Category.id, Category.name))
+    warehouse_ids = {wh_id for (wh_id,) in db.session.query(Warehouse.id)}
+
+    for batch in _batches(records, IMPORT_BATCH_SIZE):
+        parsed = []
+        for row_number, record in batch:
+            if isinstance(record, str):
+                report.error(row_number, None, record)
+                continue
+            try:
+                row, stock = _parse_product(record, categories, warehouse_ids)
+            except (ValueError, TypeError) as e:
+                report.error(row_number, record.get('sku'), str(e))
+                continue
+            parsed.append((row_number, row, stock))
+
+        skus = [row['sku'] for _, row, _ in parsed]
+        existing = {sku for (sku,) in db.session.query(Product.sku).filter(Product.sku.in_(skus))} if skus else set()
+        rows, stocks, seen = [], {}, set()
+        for row_number, row, stock in parsed:
+            if row['sku'] in existing or row['sku'] in seen:
+                report.error(row_number, row['sku'], 'SKU exists')
+                continue
+            seen.add(row['sku'])
+            rows.append(row)
+            stocks[row['sku']] = stock
+        if not rows:
+            continue
+
+        try:
+            _resolve_categories(rows, categories)
+            db.session.execute(Product.__table__.insert(), rows)
+            ids = dict(db.session.query(Product.sku, Product.id).filter(Product.sku.in_(list(stocks))))
+            bump_kpis(total_products=len(rows), out_of_stock_count=len(rows))
+            post_moves([{'product_id': ids[sku], 'from_location_id': None, 'to_location_id': wh_id,
+                         'quantity': qty, 'move_type': 'adjustment'}
+                        for sku, stock in stocks.items() for wh_id, qty in stock.items()], 'IMPORT', user_id)
+            db.session.commit()
+            report.imported += len(rows)
+        except Exception as e:
+            db.session.rollback()
+            categories = dict((name, cat_id) for cat_id, name in db.session.query(Category.id, Category.name))
+            for row in rows:
+                report.error(None, row['sku'], f"Batch failed: {e}")
+        if progress:
+            progress(report)
+    return report
+
+def stage_counts(adjustment, records, mode='set'):
+    """Add scanned counts to an open count session (Adjustment with status 'open').
+
+    Records carry product_id or sku plus counted_qty. mode='set' keeps the latest count per
+    product, mode='add' sums counts (several scanners covering the same product). Works in
+    batches: one SKU lookup, one query for already-staged lines, then bulk insert/update.
+    """
+    report = ImportReport()
+    for batch in _batches(records, IMPORT_BATCH_SIZE):
+        skus = {str(r['sku']).strip() for _, r in batch if isinstance(r, dict) and r.get('sku') and not r.get('product_id')}
+        sku_ids = dict(db.session.query(Product.sku, Product.id).filter(Product.sku.in_(skus))) if skus else {}
+        counts, rows = {}, {}  # product_id -> counted qty / [(row number, sku)] of the rows counting it
+        for row_number, record in batch:
+            if isinstance(record, str):
+                report.error(row_number, None, record)
+                continue
+            try:
+                product_id = int(record['product_id']) if record.get('product_id') else sku_ids.get(str(record.get('sku', '')).strip())
+                if not product_id:
+                    raise ValueError("Unknown product")
+                counted_qty = float(record['counted_qty'])
+                if counted_qty < 0:
+                    raise ValueError("counted_qty cannot be negative")
+            except (KeyError, ValueError, TypeError) as e:
+                report.error(row_number, record.get('sku'), str(e) if not isinstance(e, KeyError) else f"Missing {e}")
+                continue
+            counts[product_id] = counts.get(product_id, 0.0) + counted_qty if mode == 'add' else counted_qty
+            rows.setdefault(product_id, []).append((row_number, record.get('sku')))
+
+        known = {pid for (pid,) in db.session.query(Product.id).filter(Product.id.in_(list(counts)))}
+        for product_id in set(counts) - known:
+            for row_number, sku in rows[product_id]:
+                report.error(row_number, sku, f"Unknown product {product_id}")
+            del counts[product_id]
+        report.imported += sum(len(rows[product_id]) for product_id in counts)
+        staged = dict(db.session.query(AdjustmentLine.product_id, AdjustmentLine.id).filter(
+            AdjustmentLine.adjustment_id == adjustment.id, AdjustmentLine.product_id.in_(list(counts))))
+        updates, inserts = [], []
+        for product_id, counted_qty in counts.items():
+            if product_id in staged:
+                updates.append((staged[product_id], counted_qty))
+            else:
+                inserts.append({'adjustment_id': adjustment.id, 'product_id': product_id, 'counted_qty': counted_qty})
+        if inserts:
+            db.session.execute(AdjustmentLine.__table__.insert(), inserts)
+        if updates:
+            table = AdjustmentLine.__table__
+            value = table.c.counted_qty + db.bindparam('qty') if mode == 'add' else db.bindparam('qty')
+            stmt = table.update().where(table.c.id == db.bindparam('line_id')).values(counted_qty=value)
+            db.session.execute(stmt, [{'line_id': line_id, 'qty': qty} for line_id, qty in updates])
+        db.session.commit()
+    return report
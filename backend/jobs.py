@@ -0,0 +1,203 @@
+# jobs.py — SQLite-backed background jobs: big validations, imports and rebuilds leave the request thread
+# Routes enqueue a Job and answer 202; `flask --app app worker` runs a pool of worker processes that
+# claim queued jobs with a guarded UPDATE, so any number of workers can share one queue. No broker needed.
+import os
+import json
+import time
+import signal
+import socket
+import multiprocessing
+from datetime import datetime, timedelta
+from flask import request, jsonify, current_app
+from models import db, Job, Receipt, Delivery, Transfer, Adjustment
+from utils import transition, rebuild_kpis
+from documents import validate_receipt, validate_delivery, validate_transfer, apply_count_session
+from importers import open_saved_upload, iter_records, import_products
+from snapshots import take_snapshot, snapshot_due
+
+MAX_JOB_ATTEMPTS = 3  # A job whose worker died is re-queued this many times, then failed
+# Settings (names or name prefixes) spawned workers take over from the app that starts them;
+# create_app() defaults everything else
+WORKER_CONFIG = ('SQLALCHEMY_DATABASE_URI', 'SQLALCHEMY_BINDS', 'ARCHIVE_', 'SQLITE_', 'JOB_', 'SNAPSHOT_',
+                 'EVENT_', 'ASYNC_LINE_THRESHOLD', 'REFERENCE_BLOCK_SIZE', 'PER_WAREHOUSE_REFERENCES')
+
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    """Register handler(payload, user_id, progress) -> JSON-able result for a job kind"""
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+def wants_async(line_count=0):
+    """Run in the background when asked (?async=1) or when the document is large"""
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return line_count > current_app.config.get('ASYNC_LINE_THRESHOLD', 500)
+
+def enqueue(kind, payload=None, user_id=None):
+    """Queue a job inside the caller's transaction — the caller commits"""
+    job = Job(kind=kind, payload=json.dumps(payload or {}), status='queued',
+              user_id=int(user_id) if user_id is not None else None)
+    db.session.add(job)
+    db.session.flush()
+    return job
+
+def enqueue_unless_pending(kind, payload=None):
+    """Queue a job unless one of the same kind is queued or running (one guarded INSERT, so
+    workers racing to schedule the same periodic job add it once). Commits; returns True if added."""
+    table = Job.__table__
+    pending = db.select(table.c.id).where(table.c.kind == kind, table.c.status.in_(('queued', 'running')))
+    rows = db.select(db.literal(kind), db.literal(json.dumps(payload or {})), db.literal('queued'),
+                     db.literal(datetime.utcnow())).where(~pending.exists())
+    result = db.session.execute(table.insert().from_select(['kind', 'payload', 'status', 'created_at'], rows))
+    db.session.commit()
+    return result.rowcount == 1
+
+def schedule_periodic_jobs():
+    """Called by idle workers: queue the stock snapshot when SNAPSHOT_INTERVAL_HOURS have passed"""
+    interval = current_app.config.get('SNAPSHOT_INTERVAL_HOURS')
+    if interval and snapshot_due(interval):
+        enqueue_unless_pending('take_snapshot')
+    else:
+        db.session.rollback()
+
+def job_accepted(job):
+    """202 response pointing at the job's status URL"""
+    status_url = f"/api/jobs/{job.id}"
+    response = jsonify({'job_id': job.id, 'status': job.status, 'status_url': status_url})
+    response.headers['Location'] = status_url
+    return response, 202
+
+def report_progress(job_id, done, total=None):
+    """Record progress and refresh the heartbeat — commits, so only call between units of work"""
+    values = {'progress_done': done, 'heartbeat_at': datetime.utcnow()}
+    if total is not None:
+        values['progress_total'] = total
+    db.session.execute(Job.__table__.update().where(Job.__table__.c.id == job_id).values(**values))
+    db.session.commit()
+
+def claim_next_job(worker_name):
+    """Take the oldest queued job; the guarded status UPDATE makes the claim exclusive"""
+    while True:
+        job_id = db.session.query(Job.id).filter(Job.status == 'queued').order_by(Job.id).limit(1).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+        now = datetime.utcnow()
+        if transition(Job, job_id, ('queued',), 'running', worker=worker_name, started_at=now, heartbeat_at=now,
+                      attempts=db.func.coalesce(Job.__table__.c.attempts, 0) + 1):
+            db.session.commit()
+            return db.session.get(Job, job_id)
+        db.session.rollback()  # Another worker claimed it first — try the next one
+
+def run_job(job):
+    """Run one claimed job; its result (or error) is stored with the final status"""
+    job_id, kind, user_id = job.id, job.kind, job.user_id
+    payload = json.loads(job.payload or '{}')
+    try:
+        handler = JOB_HANDLERS.get(kind)
+        if not handler:
+            raise ValueError(f"Unknown job kind: {kind}")
+        result = handler(payload, user_id, lambda done, total=None: report_progress(job_id, done, total))
+        # The handler's last writes commit together with the 'done' status
+        transition(Job, job_id, ('running',), 'done', result=json.dumps(result), finished_at=datetime.utcnow(),
+                   progress_done=db.func.max(db.func.coalesce(Job.__table__.c.progress_total, 0),
+                                             db.func.coalesce(Job.__table__.c.progress_done, 0), 1))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        transition(Job, job_id, ('running',), 'failed', error=str(e), finished_at=datetime.utcnow())
+        db.session.commit()
+
+def requeue_stale_jobs(stale_after):
+    """Jobs whose worker stopped sending heartbeats go back to the queue (or fail after MAX_JOB_ATTEMPTS)"""
+    table = Job.__table__
+    stale = db.and_(table.c.status == 'running', table.c.heartbeat_at < datetime.utcnow() - timedelta(seconds=stale_after))
+    attempts = db.func.coalesce(table.c.attempts, 0)
+    db.session.execute(table.update().where(stale, attempts < MAX_JOB_ATTEMPTS).values(status='queued', worker=None))
+    db.session.execute(table.update().where(stale, attempts >= MAX_JOB_ATTEMPTS).values(
+        status='failed', error='Worker stopped responding', finished_at=datetime.utcnow()))
+    db.session.commit()
+
+def run_worker(worker_name=None, poll_interval=1.0, stale_after=600, once=False):
+    """Claim and run jobs forever (once=True: until the queue is empty). Returns the number run."""
+    worker_name = worker_name or f"{socket.gethostname()}:{os.getpid()}"
+    processed = 0
+    requeue_stale_jobs(stale_after)
+    while True:
+        job = claim_next_job(worker_name)
+        if job is None:
+            if once:
+                return processed
+            time.sleep(poll_interval)
+            requeue_stale_jobs(stale_after)
+            schedule_periodic_jobs()
+            continue
+        run_job(job)
+        processed += 1
+
+def worker_config(config):
+    """The WORKER_CONFIG part of an app's config, to build the same app in a worker process"""
+    return {key: value for key, value in config.items() if key.startswith(WORKER_CONFIG)}
+
+def _worker_process(config):
+    from app import create_app  # Each process builds its own app, engine and connections
+    app = create_app(config)
+    with app.app_context():
+        run_worker(poll_interval=app.config['JOB_POLL_INTERVAL'], stale_after=app.config['JOB_STALE_AFTER'])
+
+def start_worker_pool(config, processes):
+    """Run `processes` worker processes on create_app(config) until interrupted (Ctrl+C or SIGTERM stops them all)"""
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    context = multiprocessing.get_context('spawn')
+    pool = [context.Process(target=_worker_process, args=(config,), name=f"stockmaster-worker-{i}")
+            for i in range(processes)]
+    for process in pool:
+        process.start()
+    try:
+        for process in pool:
+            process.join()
+    except KeyboardInterrupt:
+        for process in pool:
+            process.terminate()
+        for process in pool:
+            process.join()
+
+# Handlers ----------------------------------------------------------------------------------
+
+def _document_job(model_class, validate):
+    def handler(payload, user_id, progress):
+        document = db.session.get(model_class, payload['id'])
+        if not document:
+            raise ValueError(f"{model_class.__name__} {payload['id']} not found")
+        return validate(document, user_id, progress)
+    return handler
+
+job_handler('validate_receipt')(_document_job(Receipt, validate_receipt))
+job_handler('validate_delivery')(_document_job(Delivery, validate_delivery))
+job_handler('validate_transfer')(_document_job(Transfer, validate_transfer))
+job_handler('apply_count')(_document_job(Adjustment, apply_count_session))
+
+@job_handler('import_products')
+def _import_products_job(payload, user_id, progress):
+    try:
+        with open_saved_upload(payload['path']) as text_stream:
+            report = import_products(iter_records(text_stream, payload['format']), user_id,
+                                     progress=lambda report: progress(report.imported + report.error_count))
+        return report.to_dict()
+    finally:
+        os.remove(payload['path'])
+
+@job_handler('rebuild_kpis')
+def _rebuild_kpis_job(payload, user_id, progress):
+    kpi = rebuild_kpis()
+    return {'total_products': kpi.total_products, 'total_stock_value': kpi.total_stock_value,
+            'low_stock_count': kpi.low_stock_count, 'out_of_stock_count': kpi.out_of_stock_count}
+
+@job_handler('take_snapshot')
+def _take_snapshot_job(payload, user_id, progress):
+    return take_snapshot(full=payload.get('full')).to_dict()
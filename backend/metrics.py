@@ -0,0 +1,120 @@
+# metrics.py — per-route request and SQL metrics, served at /metrics in Prometheus text format
+# Each request to an /api route records its status, latency (histogram) and the SQL statements it
+# ran (count and time, from engine events). Counters are per process: with several worker
+# processes, scrape each one and let Prometheus sum them.
+import time
+import bisect
+from threading import Lock
+from contextvars import ContextVar
+from flask import request, g, Response
+from sqlalchemy import event
+from models import db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_sql_stats = ContextVar('sql_stats', default=None)  # [statements, seconds] of the current request
+
+class RouteMetrics:
+    """Counters of one app, keyed by (route, method); observe() is a few dict updates under a lock"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = {}  # (route, method, status) -> count
+        self.latency = {}   # (route, method) -> [count per bucket ..., +Inf count, sum of seconds]
+        self.sql = {}       # (route, method) -> [statements, seconds]
+
+    def observe(self, route, method, status, seconds, statements, sql_seconds):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get((route, method))
+            if histogram is None:
+                histogram = self.latency[(route, method)] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+            sql = self.sql.setdefault((route, method), [0, 0.0])
+            sql[0] += statements
+            sql[1] += sql_seconds
+
+    def render(self):
+        with self.lock:
+            requests = sorted(self.requests.items())
+            latency = sorted((key, list(values)) for key, values in self.latency.items())
+            sql = sorted((key, list(values)) for key, values in self.sql.items())
+        lines = ['# HELP stockmaster_http_requests_total Requests handled, by route, method and status.',
+                 '# TYPE stockmaster_http_requests_total counter']
+        lines += [f'stockmaster_http_requests_total{_labels(route=route, method=method, status=status)} {count}'
+                  for (route, method, status), count in requests]
+        lines += ['# HELP stockmaster_http_request_duration_seconds Time to build the response.',
+                  '# TYPE stockmaster_http_request_duration_seconds histogram']
+        for (route, method), histogram in latency:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram):
+                cumulative += count
+                lines.append(f'stockmaster_http_request_duration_seconds_bucket'
+                             f'{_labels(route=route, method=method, le=bound)} {cumulative}')
+            lines.append(f'stockmaster_http_request_duration_seconds_sum{_labels(route=route, method=method)} {histogram[-1]!r}')
+            lines.append(f'stockmaster_http_request_duration_seconds_count{_labels(route=route, method=method)} {cumulative}')
+        lines += ['# HELP stockmaster_sql_statements_total SQL statements executed while handling requests.',
+                  '# TYPE stockmaster_sql_statements_total counter']
+        lines += [f'stockmaster_sql_statements_total{_labels(route=route, method=method)} {statements}'
+                  for (route, method), (statements, _) in sql]
+        lines += ['# HELP stockmaster_sql_duration_seconds_total Time spent in SQL statements while handling requests.',
+                  '# TYPE stockmaster_sql_duration_seconds_total counter']
+        lines += [f'stockmaster_sql_duration_seconds_total{_labels(route=route, method=method)} {seconds!r}'
+                  for (route, method), (_, seconds) in sql]
+        return '\n'.join(lines) + '\n'
+
+def _labels(**labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _sql_stats.get() is not None:
+        conn.info['metrics_query_start'] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _sql_stats.get()
+    started = conn.info.pop('metrics_query_start', None)
+    if stats is not None and started is not None:
+        stats[0] += 1
+        stats[1] += time.perf_counter() - started
+
+def init_metrics(app):
+    """Instrument the app's /api routes and engines and serve /metrics — call inside an app context"""
+    metrics = app.extensions['metrics'] = RouteMetrics()
+    for engine in db.engines.values():
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+    def record(status):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        statements, sql_seconds = _sql_stats.get() or (0, 0.0)
+        metrics.observe(request.url_rule.rule, request.method, status, time.perf_counter() - started,
+                        statements, sql_seconds)
+
+    @app.before_request
+    def start_request_metrics():
+        if request.blueprint == 'api' and request.url_rule is not None:
+            g.metrics_sql = _sql_stats.set([0, 0.0])
+            g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        record(response.status_code)
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        record(500)  # Unhandled exception: after_request did not run
+        token = g.pop('metrics_sql', None)
+        if token is not None:
+            _sql_stats.reset(token)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,94 @@
+# migrations.py — in-place upgrades for existing stockmaster.db files (run on every start)
+from sqlalchemy import inspect
+from models import db
+
+def _merge_duplicate_quants(conn):
+    """Fold duplicate (product, warehouse) quants into the oldest row before the unique index"""
+    duplicates = conn.exec_driver_sql(
+        "SELECT product_id, warehouse_id, MIN(id), SUM(quantity) FROM stock_quant "
+        "GROUP BY product_id, warehouse_id HAVING COUNT(*) > 1"
+    ).fetchall()
+    for product_id, warehouse_id, keep_id, total in duplicates:
+        conn.exec_driver_sql("UPDATE stock_quant SET quantity = ? WHERE id = ?", (total, keep_id))
+        conn.exec_driver_sql(
+            "DELETE FROM stock_quant WHERE product_id = ? AND warehouse_id = ? AND id != ?",
+            (product_id, warehouse_id, keep_id)
+        )
+
+def _sql_literal(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _add_missing_columns(conn, inspector, table):
+    """ALTER TABLE ADD COLUMN for model columns the table lacks, with their scalar default"""
+    added = []
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}"
+        if column.default is not None and column.default.is_scalar:
+            ddl += f" DEFAULT {_sql_literal(column.default.arg)}"
+        conn.exec_driver_sql(ddl)
+        added.append(f"{table.name}.{column.name}")
+    return added
+
+# Highest id a table has handed out that it may no longer hold itself (rows moved elsewhere)
+_ID_FLOORS = {
+    'stock_move': "SELECT MAX(through_move_id) FROM move_archive_run",
+}
+
+def _add_autoincrement(conn, inspector, table):
+    """Rebuild a table declared sqlite_autoincrement that was created without it.
+
+    SQLite cannot add AUTOINCREMENT in place: the rows are copied into a new table, and the
+    id sequence starts above every id the old table (or the rows it gave away) ever used.
+    """
+    if conn.dialect.name != 'sqlite' or not table.dialect_options['sqlite']['autoincrement']:
+        return False
+    ddl = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                               (table.name,)).scalar()
+    if ddl is None or 'AUTOINCREMENT' in ddl.upper():
+        return False
+    old = f"_{table.name}_old"
+    columns = ', '.join(column['name'] for column in inspector.get_columns(table.name) if column['name'] in table.columns)
+    conn.exec_driver_sql(f"ALTER TABLE {table.name} RENAME TO {old}")
+    for (index,) in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                                         "AND sql IS NOT NULL", (old,)).fetchall():
+        conn.exec_driver_sql(f"DROP INDEX {index}")  # The new table recreates them under the same names
+    table.create(bind=conn)
+    conn.exec_driver_sql(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old}")
+    conn.exec_driver_sql(f"DROP TABLE {old}")
+    floor = conn.exec_driver_sql(_ID_FLOORS[table.name]).scalar() if table.name in _ID_FLOORS else None
+    if floor:
+        if not conn.exec_driver_sql("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?",
+                                    (floor, table.name)).rowcount:
+            conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table.name, floor))
+    inspector.clear_cache()
+    return True
+
+def upgrade_schema():
+    """Add the columns, indexes and AUTOINCREMENT declared on the models that an older database is missing.
+
+    db.create_all() only creates missing tables, so databases built before a column or index
+    was added would otherwise break or keep full-table scans forever. Returns what was created.
+    """
+    created = []
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in db.metadata.sorted_tables:
+            if _add_autoincrement(conn, inspector, table):
+                created.append(f"{table.name}.id AUTOINCREMENT")
+            created.extend(_add_missing_columns(conn, inspector, table))
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                if index.name == 'uq_stock_quant_product_warehouse':
+                    _merge_duplicate_quants(conn)
+                index.create(bind=conn)
+                created.append(index.name)
+    return created
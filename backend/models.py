@@ -1,15 +1,26 @@
 # models.py
+import json
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
 
+# Documents still waiting to be processed. Rendered as literals (not bound parameters) so
+# SQLite can match queries against the partial "open document" indexes below.
+OPEN_STATUSES = ('draft', 'ready')
+OPEN_STATUS_SQL = "status IN ('draft', 'ready')"
+
+def open_status(model):
+    """Filter for model.status IN ('draft', 'ready') that can use the partial open-status index"""
+    return model.status.in_([db.literal_column(f"'{status}'") for status in OPEN_STATUSES])
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(128), nullable=False)
     role = db.Column(db.String(20), default='staff')  # manager or staff
+    token_version = db.Column(db.Integer, default=0)  # NEW: bumped on role/password change; older JWTs are revoked
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def set_password(self, password):
@@ -26,6 +37,53 @@ class User(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+# NEW: Per-prefix reference counters (WH/IN, WH2/OUT, ...) shared by all worker processes
+class ReferenceSequence(db.Model):
+    prefix = db.Column(db.String(50), primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False, default=1)
+
+# NEW: Change counters for rarely-edited reference tables (drive ETags and the GET cache)
+class TableVersion(db.Model):
+    name = db.Column(db.String(50), primary_key=True)  # 'warehouse', 'location', 'category', '_epoch'
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+# NEW: Single-row dashboard counters, kept current by the stock engine and document transitions
+class DashboardKpi(db.Model):
+    id = db.Column(db.Integer, primary_key=True)  # always 1
+    total_products = db.Column(db.Integer, default=0)
+    total_stock_value = db.Column(db.Float, default=0.0)
+    low_stock_count = db.Column(db.Integer, default=0)
+    out_of_stock_count = db.Column(db.Integer, default=0)
+    receipts_pending = db.Column(db.Integer, default=0)
+    receipts_total = db.Column(db.Integer, default=0)
+    deliveries_pending = db.Column(db.Integer, default=0)
+    deliveries_total = db.Column(db.Integer, default=0)
+    transfers_pending = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# NEW: Quants currently below their product's reorder_min (the replenishment screen reads this)
+class ReorderWatch(db.Model):
+    __table_args__ = (
+        db.Index('uq_reorder_watch_product_warehouse', 'product_id', 'warehouse_id', unique=True),
+        db.Index('ix_reorder_watch_warehouse_id', 'warehouse_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
+    quantity = db.Column(db.Float, default=0.0)
+    reorder_min = db.Column(db.Integer, default=0)
+    since = db.Column(db.DateTime, default=datetime.utcnow)  # when the quant first dropped below the minimum
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'product_id': self.product_id,
+            'warehouse_id': self.warehouse_id,
+            'quantity': self.quantity,
+            'reorder_min': self.reorder_min,
+            'shortfall': (self.reorder_min or 0) - (self.quantity or 0.0),
+            'since': self.since.isoformat() if self.since else None
+        }
+
 class Warehouse(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -52,7 +110,7 @@ class Location(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     short_code = db.Column(db.String(20), unique=True)
-    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def to_dict(self):
@@ -76,6 +134,10 @@ class Category(db.Model):
         }
 
 class Product(db.Model):
+    __table_args__ = (
+        # Case-insensitive SKU lookups and prefix LIKEs (typeahead, scanners) search this index
+        db.Index('ix_product_sku_nocase', db.text('sku COLLATE NOCASE')),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False)
     sku = db.Column(db.String(50), unique=True, nullable=False)
@@ -101,11 +163,23 @@ class Product(db.Model):
         }
 
 class StockQuant(db.Model):
+    """Stock of a product in a warehouse — the per-warehouse aggregate of its location quants.
+
+    quantity is the warehouse total; binned_qty is the part held in LocationQuant rows (racks,
+    bins). Both are maintained by the stock engine, so warehouse and company totals never have
+    to sum bin rows.
+    """
+    __table_args__ = (
+        # One quant per product and warehouse; also serves every (product, warehouse) lookup
+        db.Index('uq_stock_quant_product_warehouse', 'product_id', 'warehouse_id', unique=True),
+        db.Index('ix_stock_quant_warehouse_id', 'warehouse_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
-    # TODO: Add location_id = db.Column(db.Integer, db.ForeignKey('location.id')) when integrating locations
     quantity = db.Column(db.Float, default=0.0)
+    binned_qty = db.Column(db.Float, default=0.0)  # NEW: sum of this product's LocationQuants in the warehouse
+    reserved_qty = db.Column(db.Float, default=0.0)  # NEW: held for ready deliveries (sum of DeliveryLine.reserved_qty)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     product = db.relationship('Product', backref='stock_quants_all')      
     warehouse = db.relationship('Warehouse', backref='stock_quants')
@@ -115,10 +189,40 @@ class StockQuant(db.Model):
             'product_id': self.product_id,
             'warehouse_id': self.warehouse_id,
             'quantity': self.quantity,
+            'binned_qty': self.binned_qty or 0.0,
+            'unassigned_qty': (self.quantity or 0.0) - (self.binned_qty or 0.0),
+            'reserved_qty': self.reserved_qty or 0.0,
+            'available_qty': max((self.quantity or 0.0) - (self.reserved_qty or 0.0), 0.0),
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+# NEW: Stock per product and location (rack / bin) inside a warehouse
+class LocationQuant(db.Model):
+    __table_args__ = (
+        db.Index('uq_location_quant_product_location', 'product_id', 'location_id', unique=True),
+        db.Index('ix_location_quant_location_id', 'location_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)  # Denormalized from location
+    quantity = db.Column(db.Float, default=0.0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'product_id': self.product_id,
+            'location_id': self.location_id,
+            'warehouse_id': self.warehouse_id,
+            'quantity': self.quantity,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
 class Receipt(db.Model):
+    __table_args__ = (
+        db.Index('ix_receipt_status_scheduled', 'status', 'scheduled_date'),
+        db.Index('ix_receipt_open_scheduled', 'scheduled_date', sqlite_where=db.text(OPEN_STATUS_SQL)),
+    )
     id = db.Column(db.Integer, primary_key=True)
     reference = db.Column(db.String(50), unique=True, nullable=False)  # e.g., WH/IN/0001
     vendor = db.Column(db.String(200), nullable=False)
@@ -133,8 +237,8 @@ class Receipt(db.Model):
     receipt_lines = db.relationship('ReceiptLine', backref='receipt', lazy=True, cascade='all, delete-orphan')
     warehouse = db.relationship('Warehouse')
     responsible = db.relationship('User')  # NEW
-    def to_dict(self):
-        return {
+    def to_dict(self, include_lines=True):
+        data = {
             'id': self.id,
             'reference': self.reference,
             'vendor': self.vendor,
@@ -143,14 +247,17 @@ class Receipt(db.Model):
             'status': self.status,
             'scheduled_date': self.scheduled_date.isoformat() if self.scheduled_date else None,
             'created_at': self.created_at.isoformat() if self.created_at else None,
-            'validated_at': self.validated_at.isoformat() if self.validated_at else None,
-            'lines': [line.to_dict() for line in self.receipt_lines]
+            'validated_at': self.validated_at.isoformat() if self.validated_at else None
         }
+        if include_lines:  # List views with ?view=summary skip the lines
+            data['lines'] = [line.to_dict() for line in self.receipt_lines]
+        return data
 
 class ReceiptLine(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    receipt_id = db.Column(db.Integer, db.ForeignKey('receipt.id'), nullable=False)
+    receipt_id = db.Column(db.Integer, db.ForeignKey('receipt.id'), nullable=False, index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=True)  # NEW: put-away bin
     demand_qty = db.Column(db.Float, default=0.0)  # Expected
     done_qty = db.Column(db.Float, default=0.0)    # Received
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -159,12 +266,17 @@ class ReceiptLine(db.Model):
         return {
             'id': self.id,
             'product_id': self.product_id,
+            'location_id': self.location_id,
             'demand_qty': self.demand_qty,
             'done_qty': self.done_qty,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
 class Delivery(db.Model):
+    __table_args__ = (
+        db.Index('ix_delivery_status_scheduled', 'status', 'scheduled_date'),
+        db.Index('ix_delivery_open_scheduled', 'scheduled_date', sqlite_where=db.text(OPEN_STATUS_SQL)),
+    )
     id = db.Column(db.Integer, primary_key=True)
     reference = db.Column(db.String(50), unique=True, nullable=False)  # e.g., WH/OUT/0001
     # CHANGED: customer -> delivery_address for UI
@@ -173,44 +285,55 @@ class Delivery(db.Model):
     # NEW: responsible_id
     responsible_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     status = db.Column(db.String(20), default='draft')  # draft, ready, done, canceled
+    priority = db.Column(db.Integer, default=0)  # NEW: higher is reserved first
     scheduled_date = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     validated_at = db.Column(db.DateTime)
     delivery_lines = db.relationship('DeliveryLine', backref='delivery', lazy=True, cascade='all, delete-orphan')
     warehouse = db.relationship('Warehouse')
     responsible = db.relationship('User')  # NEW
-    def to_dict(self):
-        return {
+    def to_dict(self, include_lines=True):
+        data = {
             'id': self.id,
             'reference': self.reference,
             'delivery_address': self.delivery_address,
             'warehouse_id': self.warehouse_id,
             'responsible_id': self.responsible_id,
             'status': self.status,
+            'priority': self.priority or 0,
             'scheduled_date': self.scheduled_date.isoformat() if self.scheduled_date else None,
             'created_at': self.created_at.isoformat() if self.created_at else None,
-            'validated_at': self.validated_at.isoformat() if self.validated_at else None,
-            'lines': [line.to_dict() for line in self.delivery_lines]
+            'validated_at': self.validated_at.isoformat() if self.validated_at else None
         }
+        if include_lines:  # List views with ?view=summary skip the lines
+            data['lines'] = [line.to_dict() for line in self.delivery_lines]
+        return data
 
 class DeliveryLine(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    delivery_id = db.Column(db.Integer, db.ForeignKey('delivery.id'), nullable=False)
+    delivery_id = db.Column(db.Integer, db.ForeignKey('delivery.id'), nullable=False, index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=True)  # NEW: pick bin
     demand_qty = db.Column(db.Float, default=0.0)  # To deliver
     done_qty = db.Column(db.Float, default=0.0)    # Delivered
+    reserved_qty = db.Column(db.Float, default=0.0)  # NEW: held on the warehouse quant while ready
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     product = db.relationship('Product', backref='delivery_lines_ok')
     def to_dict(self):
         return {
             'id': self.id,
             'product_id': self.product_id,
+            'location_id': self.location_id,
             'demand_qty': self.demand_qty,
             'done_qty': self.done_qty,
+            'reserved_qty': self.reserved_qty or 0.0,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
 class Transfer(db.Model):
+    __table_args__ = (
+        db.Index('ix_transfer_status_created', 'status', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     reference = db.Column(db.String(50), unique=True, nullable=False)
     from_warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
@@ -221,22 +344,26 @@ class Transfer(db.Model):
     transfer_lines = db.relationship('TransferLine', backref='transfer', lazy=True, cascade='all, delete-orphan')
     from_warehouse = db.relationship('Warehouse', foreign_keys=[from_warehouse_id])
     to_warehouse = db.relationship('Warehouse', foreign_keys=[to_warehouse_id])
-    def to_dict(self):
-        return {
+    def to_dict(self, include_lines=True):
+        data = {
             'id': self.id,
             'reference': self.reference,
             'from_warehouse_id': self.from_warehouse_id,
             'to_warehouse_id': self.to_warehouse_id,
             'status': self.status,
             'created_at': self.created_at.isoformat() if self.created_at else None,
-            'validated_at': self.validated_at.isoformat() if self.validated_at else None,
-            'lines': [line.to_dict() for line in self.transfer_lines]
+            'validated_at': self.validated_at.isoformat() if self.validated_at else None
         }
+        if include_lines:  # List views with ?view=summary skip the lines
+            data['lines'] = [line.to_dict() for line in self.transfer_lines]
+        return data
 
 class TransferLine(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    transfer_id = db.Column(db.Integer, db.ForeignKey('transfer.id'), nullable=False)
+    transfer_id = db.Column(db.Integer, db.ForeignKey('transfer.id'), nullable=False, index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    from_location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=True)  # NEW: source bin
+    to_location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=True)    # NEW: destination bin
     quantity = db.Column(db.Float, default=0.0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     product = db.relationship('Product', backref='transfer_lines_ok')
@@ -244,6 +371,8 @@ class TransferLine(db.Model):
         return {
             'id': self.id,
             'product_id': self.product_id,
+            'from_location_id': self.from_location_id,
+            'to_location_id': self.to_location_id,
             'quantity': self.quantity,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
@@ -253,22 +382,26 @@ class Adjustment(db.Model):
     reference = db.Column(db.String(50), unique=True, nullable=False)
     warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
     reason = db.Column(db.String(200))
+    status = db.Column(db.String(20), default='done')  # NEW: 'open' while a cycle count collects lines
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     adjustment_lines = db.relationship('AdjustmentLine', backref='adjustment', lazy=True, cascade='all, delete-orphan')
     warehouse = db.relationship('Warehouse')
-    def to_dict(self):
-        return {
+    def to_dict(self, include_lines=True):
+        data = {
             'id': self.id,
             'reference': self.reference,
             'warehouse_id': self.warehouse_id,
             'reason': self.reason,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'lines': [line.to_dict() for line in self.adjustment_lines]
+            'status': self.status,
+            'created_at': self.created_at.isoformat() if self.created_at else None
         }
+        if include_lines:  # List views with ?view=summary skip the lines
+            data['lines'] = [line.to_dict() for line in self.adjustment_lines]
+        return data
 
 class AdjustmentLine(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    adjustment_id = db.Column(db.Integer, db.ForeignKey('adjustment.id'), nullable=False)
+    adjustment_id = db.Column(db.Integer, db.ForeignKey('adjustment.id'), nullable=False, index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     counted_qty = db.Column(db.Float, default=0.0)
     previous_qty = db.Column(db.Float, default=0.0)
@@ -286,11 +419,18 @@ class AdjustmentLine(db.Model):
         }
 
 class StockMove(db.Model):
+    __table_args__ = (
+        db.Index('ix_stock_move_product_created', 'product_id', 'created_at'),
+        db.Index('ix_stock_move_created_id', 'created_at', 'id'),
+        {'sqlite_autoincrement': True},  # Archived (deleted) move ids are never handed out again
+    )
     id = db.Column(db.Integer, primary_key=True)
     reference = db.Column(db.String(50))  # From receipt/delivery etc.
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     from_location_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'))  # Can be null
     to_location_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'))    # Can be null
+    from_sublocation_id = db.Column(db.Integer, db.ForeignKey('location.id'))  # NEW: bin inside from_location
+    to_sublocation_id = db.Column(db.Integer, db.ForeignKey('location.id'))    # NEW: bin inside to_location
     quantity = db.Column(db.Float, default=0.0)
     move_type = db.Column(db.String(20))  # receipt, delivery, transfer, adjustment
     state = db.Column(db.String(20), default='done')  # draft, done
@@ -307,9 +447,156 @@ class StockMove(db.Model):
             'product_id': self.product_id,
             'from_location_id': self.from_location_id,
             'to_location_id': self.to_location_id,
+            'from_sublocation_id': self.from_sublocation_id,
+            'to_sublocation_id': self.to_sublocation_id,
             'quantity': self.quantity,
             'move_type': self.move_type,
             'state': self.state,
             'user_id': self.user_id,
             'created_at': self.created_at.isoformat() if self.created_at else None
-        }
\ No newline at end of file
+        }
+
+# NEW: Moves older than the archive cutoff live in a separate database (bind 'archive', see archive.py).
+# No foreign keys: the referenced rows are in the main database.
+class ArchivedStockMove(db.Model):
+    __bind_key__ = 'archive'
+    __table_args__ = (
+        db.Index('ix_archived_stock_move_product_created', 'product_id', 'created_at'),
+        db.Index('ix_archived_stock_move_created_id', 'created_at', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Same id as the original StockMove
+    reference = db.Column(db.String(50))
+    product_id = db.Column(db.Integer, nullable=False)
+    from_location_id = db.Column(db.Integer)
+    to_location_id = db.Column(db.Integer)
+    from_sublocation_id = db.Column(db.Integer)
+    to_sublocation_id = db.Column(db.Integer)
+    quantity = db.Column(db.Float, default=0.0)
+    move_type = db.Column(db.String(20))
+    state = db.Column(db.String(20), default='done')
+    user_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime)
+    to_dict = StockMove.to_dict  # Same JSON as a live move
+
+# NEW: Monthly in/out totals per (product, warehouse) for archived months — totals stay cheap and
+# correct after the moves themselves have left the main database
+class StockMoveRollup(db.Model):
+    __table_args__ = (
+        db.Index('uq_stock_move_rollup_product_warehouse_month', 'product_id', 'warehouse_id', 'month', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), nullable=False)  # 'YYYY-MM'
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
+    qty_in = db.Column(db.Float, default=0.0)
+    qty_out = db.Column(db.Float, default=0.0)
+    move_count = db.Column(db.Integer, default=0)
+
+class MoveArchiveRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    cutoff = db.Column(db.DateTime, nullable=False)  # Every move created before this is archived once finished
+    through_move_id = db.Column(db.Integer, default=0)  # Highest move id already deleted from stock_move
+    move_count = db.Column(db.Integer, default=0)
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'cutoff': self.cutoff.isoformat() if self.cutoff else None,
+            'through_move_id': self.through_move_id or 0,
+            'move_count': self.move_count or 0
+        }
+
+# NEW: Periodic stock snapshots for point-in-time (as_of) queries. A full run copies every quant;
+# incremental runs only store the (product, warehouse) pairs that moved since the previous run.
+class SnapshotRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    taken_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    last_move_id = db.Column(db.Integer, nullable=False, default=0)  # Quants reflect every move up to this id
+    is_full = db.Column(db.Boolean, default=False)
+    row_count = db.Column(db.Integer, default=0)
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'taken_at': self.taken_at.isoformat() if self.taken_at else None,
+            'last_move_id': self.last_move_id,
+            'is_full': bool(self.is_full),
+            'row_count': self.row_count or 0
+        }
+
+class StockSnapshot(db.Model):
+    __table_args__ = (
+        db.Index('uq_stock_snapshot_product_warehouse_run', 'product_id', 'warehouse_id', 'run_id', unique=True),
+        db.Index('ix_stock_snapshot_run_id', 'run_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('snapshot_run.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
+    quantity = db.Column(db.Float, default=0.0)
+
+# NEW: Outbox of change events, written in the same transaction as the change; streamed over SSE
+class OutboxEvent(db.Model):
+    __table_args__ = (
+        {'sqlite_autoincrement': True},  # Pruned event ids are never handed out again (clients hold them)
+    )
+    id = db.Column(db.Integer, primary_key=True)  # Event id for Last-Event-ID; commit order on SQLite
+    topic = db.Column(db.String(50), nullable=False)  # stock.moved, receipt.status, job.status, ...
+    payload = db.Column(db.Text)  # JSON
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'topic': self.topic,
+            'payload': json.loads(self.payload) if self.payload else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+# NEW: Background jobs (large validations, imports, rebuilds) run by `flask --app app worker`
+class Job(db.Model):
+    __table_args__ = (
+        db.Index('ix_job_status_id', 'status', 'id'),  # The worker claims the oldest queued job
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # validate_receipt, import_products, ...
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, failed
+    payload = db.Column(db.Text)  # JSON arguments for the handler
+    result = db.Column(db.Text)   # JSON result once done
+    error = db.Column(db.Text)
+    progress_done = db.Column(db.Integer, default=0)
+    progress_total = db.Column(db.Integer, default=0)
+    attempts = db.Column(db.Integer, default=0)
+    worker = db.Column(db.String(100))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # Refreshed on progress; stale running jobs are re-queued
+    finished_at = db.Column(db.DateTime)
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': {'done': self.progress_done or 0, 'total': self.progress_total or 0},
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'attempts': self.attempts or 0,
+            'user_id': self.user_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+# NEW: Password-reset codes and request counters shared by all worker processes (see otp.py)
+class OtpCode(db.Model):
+    email = db.Column(db.String(120), primary_key=True)  # One live code per address
+    code_hash = db.Column(db.String(64), nullable=False)  # HMAC of the code, never the code itself
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # Wrong guesses against this code
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # Expired rows are deleted in bulk
+
+class RateLimitCounter(db.Model):
+    key = db.Column(db.String(200), primary_key=True)  # e.g. 'otp:alice@example.com'
+    count = db.Column(db.Integer, nullable=False, default=0)  # Hits in the current fixed window
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # End of the window
@@ -0,0 +1,143 @@
+# otp.py — one-time password-reset codes and the rate limits around them
+# Codes live in a store shared by every worker process (SQLite by default, OTP_STORE='sqlite');
+# OTP_STORE='memory' keeps them in a bounded per-process dict for single-process setups. Both
+# keep only an HMAC of each code, compare in constant time, cap wrong guesses per code and
+# drop expired entries in bulk, so password-reset spam cannot grow them without limit.
+import hmac
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+from threading import Lock
+from flask import current_app
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, OtpCode, RateLimitCounter
+
+def generate_otp():
+    return f"{secrets.randbelow(1000000):06d}"
+
+def send_otp_email(email: str, otp: str) -> bool:
+    """
+    For development: just prints and returns True
+    For production: send real email here
+    """
+    print(f"\nOTP FOR {email}: {otp}\n")  # Easy to see in console
+    return True
+
+def _code_hash(email, otp):
+    key = current_app.config['SECRET_KEY'].encode()
+    return hmac.new(key, f"{email}:{otp}".encode(), hashlib.sha256).hexdigest()
+
+class SqliteOtpStore:
+    """Codes and counters in the main database: every worker sees the same state"""
+
+    def save(self, email, code_hash, expires_at):
+        now = datetime.utcnow()
+        db.session.execute(OtpCode.__table__.delete().where(OtpCode.__table__.c.expires_at <= now))
+        db.session.execute(RateLimitCounter.__table__.delete().where(RateLimitCounter.__table__.c.expires_at <= now))
+        stmt = sqlite_insert(OtpCode.__table__).values(email=email, code_hash=code_hash, attempts=0, expires_at=expires_at)
+        db.session.execute(stmt.on_conflict_do_update(index_elements=['email'], set_={
+            'code_hash': stmt.excluded.code_hash, 'attempts': 0, 'expires_at': stmt.excluded.expires_at}))
+        db.session.commit()
+
+    def check(self, email, code_hash, max_attempts):
+        """True once for the right code; wrong guesses count against the code until it is burnt"""
+        table = OtpCode.__table__
+        live = db.and_(table.c.email == email, table.c.expires_at > datetime.utcnow())
+        row = db.session.execute(db.select(table.c.code_hash).where(live)).first()
+        if row and hmac.compare_digest(row.code_hash, code_hash):
+            # Conditional delete: of two workers checking the same code, only one succeeds
+            used = db.session.execute(table.delete().where(live, table.c.code_hash == row.code_hash)).rowcount
+            db.session.commit()
+            return used == 1
+        if row:
+            db.session.execute(table.update().where(live).values(attempts=table.c.attempts + 1))
+            db.session.execute(table.delete().where(table.c.email == email, table.c.attempts >= max_attempts))
+        db.session.commit()
+        return False
+
+    def hit(self, key, window_seconds):
+        """Count one hit against key's fixed window; returns the hits so far in that window"""
+        table = RateLimitCounter.__table__
+        now = datetime.utcnow()
+        stmt = sqlite_insert(table).values(key=key, count=1, expires_at=now + timedelta(seconds=window_seconds))
+        window_over = table.c.expires_at <= now
+        stmt = stmt.on_conflict_do_update(index_elements=['key'], set_={
+            'count': db.case((window_over, 1), else_=table.c.count + 1),
+            'expires_at': db.case((window_over, stmt.excluded.expires_at), else_=table.c.expires_at)})
+        count = db.session.execute(stmt.returning(table.c.count)).scalar()
+        db.session.commit()
+        return count
+
+class MemoryOtpStore:
+    """Per-process dicts capped at max_entries — only correct with a single worker process"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.codes = {}     # email -> [code_hash, attempts, expires_at]
+        self.counters = {}  # key -> [count, expires_at]
+        self.lock = Lock()
+
+    def _make_room(self, entries, expires_at):
+        if len(entries) < self.max_entries:
+            return
+        now = datetime.utcnow()
+        for key in [key for key, entry in entries.items() if expires_at(entry) <= now]:
+            del entries[key]
+        while len(entries) >= self.max_entries:
+            del entries[next(iter(entries))]  # Still full of live entries: drop the oldest
+
+    def save(self, email, code_hash, expires_at):
+        with self.lock:
+            self.codes.pop(email, None)
+            self._make_room(self.codes, lambda entry: entry[2])
+            self.codes[email] = [code_hash, 0, expires_at]
+
+    def check(self, email, code_hash, max_attempts):
+        with self.lock:
+            entry = self.codes.get(email)
+            if not entry or entry[2] <= datetime.utcnow():
+                self.codes.pop(email, None)
+                return False
+            if hmac.compare_digest(entry[0], code_hash):
+                del self.codes[email]
+                return True
+            entry[1] += 1
+            if entry[1] >= max_attempts:
+                del self.codes[email]
+            return False
+
+    def hit(self, key, window_seconds):
+        now = datetime.utcnow()
+        with self.lock:
+            entry = self.counters.get(key)
+            if not entry or entry[1] <= now:
+                self.counters.pop(key, None)
+                self._make_room(self.counters, lambda entry: entry[1])
+                entry = self.counters[key] = [0, now + timedelta(seconds=window_seconds)]
+            entry[0] += 1
+            return entry[0]
+
+OTP_STORES = {'sqlite': SqliteOtpStore, 'memory': MemoryOtpStore}
+
+def otp_store():
+    """The app's store, built on first use from OTP_STORE (a name in OTP_STORES or a store instance)"""
+    store = current_app.extensions.get('otp_store')
+    if store is None:
+        store = current_app.config.get('OTP_STORE', 'sqlite')
+        if isinstance(store, str):
+            store = OTP_STORES[store]()
+        current_app.extensions['otp_store'] = store
+    return store
+
+def otp_request_allowed(email):
+    """False once email has asked for OTP_REQUEST_LIMIT codes within OTP_REQUEST_WINDOW_SECONDS"""
+    config = current_app.config
+    return otp_store().hit(f"otp:{email}", config['OTP_REQUEST_WINDOW_SECONDS']) <= config['OTP_REQUEST_LIMIT']
+
+def save_otp(email: str, otp: str, expires_in: int = 300):
+    """Store otp for email (replacing any earlier code); it expires after expires_in seconds"""
+    otp_store().save(email, _code_hash(email, otp), datetime.utcnow() + timedelta(seconds=expires_in))
+
+def verify_otp(email: str, otp: str) -> bool:
+    """True if otp is email's live code (then used up); OTP_MAX_ATTEMPTS wrong guesses burn the code"""
+    return otp_store().check(email, _code_hash(email, str(otp)), current_app.config['OTP_MAX_ATTEMPTS'])
@@ -1,170 +1,329 @@
-# populate_db.py — FINAL FIXED VERSION (100% safe, no crashes, keeps full demo data)
+# populate_db.py — deterministic synthetic data at any scale (drops and rebuilds the database)
+# Usage: python populate_db.py [--seed 42] [--warehouses 3] [--locations 4] [--products 200]
+#                              [--years 2] [--moves 20000] [--end-date 2025-06-30]
+# The same seed, parameters and end date always produce the same database. Demand follows a
+# long-tailed product popularity with weekly and yearly seasonality; receipts replenish each
+# (product, warehouse) when it falls to its reorder point. Rows are written in chunked bulk
+# inserts with explicit ids, and the quants are computed from the moves, so they always agree.
+import math
+import time
+import random
+import argparse
+from datetime import date, datetime, timedelta
 from app import create_app
-from models import (
-    db, User, Warehouse, Location, Category, Product, StockQuant,
-    Receipt, ReceiptLine, Delivery, DeliveryLine
-)
-from datetime import datetime, timedelta
+from models import db, User, Warehouse, Location, Category, Product, StockQuant
+from migrations import upgrade_schema
+from search import drop_product_search, ensure_product_search
+from utils import rebuild_kpis, bump_table_version
 
-app = create_app()
+CHUNK_SIZE = 20000  # Rows per executemany
+LINES_PER_RECEIPT = 20
+MEAN_LINE_QTY = 3.0
+WEEKDAY_FACTOR = (1.1, 1.05, 1.0, 1.0, 1.15, 0.6, 0.4)  # Monday .. Sunday
+YEARLY_GROWTH = 0.1
 
-with app.app_context():
-    print("Dropping and recreating database...")
+DEMO_USERS = [("admin@stockmaster.com", "manager", "admin123"),
+              ("john@stockmaster.com", "staff", "john123"),
+              ("sarah@stockmaster.com", "staff", "sarah123")]
+CATEGORIES = {
+    'Furniture': ['Desk', 'Chair', 'Bookshelf', 'Cabinet', 'Table', 'Stool'],
+    'Lighting': ['Desk Lamp', 'Floor Lamp', 'LED Panel', 'Bulb', 'Spotlight'],
+    'Electronics': ['Monitor', 'Keyboard', 'Mouse', 'Headset', 'Webcam', 'Dock'],
+    'Office Supplies': ['Stapler', 'Notebook', 'Pen Set', 'Binder', 'Folder'],
+    'Storage': ['Storage Box', 'Shelf Unit', 'Bin', 'Drawer Set', 'Locker'],
+    'Networking': ['Router', 'Switch', 'Patch Cable', 'Access Point'],
+    'Packaging': ['Carton', 'Tape Roll', 'Bubble Wrap', 'Pallet Wrap'],
+    'Safety': ['Helmet', 'Gloves', 'Safety Vest', 'First Aid Kit'],
+}
+ADJECTIVES = ['Compact', 'Ergonomic', 'Heavy-Duty', 'Premium', 'Standard', 'Adjustable', 'Wireless',
+              'Recycled', 'Industrial', 'Slim']
+VENDORS = ['Azure Interior', 'Furniture Direct', 'Bright Lights Co', 'TechSource', 'OfficeWorld', 'PackRight',
+           'SafeGuard Supply', 'NetGear Wholesale']
+CITIES = ['Manhattan', 'Queens', 'Brooklyn', 'Newark', 'Jersey City', 'Yonkers', 'Stamford', 'Hoboken']
+
+COLUMNS = {  # Flushed in this order: headers before their lines
+    'receipt': ('id', 'reference', 'vendor', 'warehouse_id', 'responsible_id', 'status', 'scheduled_date',
+                'created_at', 'validated_at'),
+    'delivery': ('id', 'reference', 'delivery_address', 'warehouse_id', 'responsible_id', 'status', 'priority',
+                 'scheduled_date', 'created_at', 'validated_at'),
+    'receipt_line': ('receipt_id', 'product_id', 'demand_qty', 'done_qty', 'created_at'),
+    'delivery_line': ('delivery_id', 'product_id', 'demand_qty', 'done_qty', 'reserved_qty', 'created_at'),
+    'stock_move': ('reference', 'product_id', 'from_location_id', 'to_location_id', 'quantity', 'move_type',
+                   'state', 'user_id', 'created_at'),
+}
+
+class BulkWriter:
+    """Row buffers per table, written with executemany and committed every CHUNK_SIZE moves"""
+
+    def __init__(self):
+        self.rows = {table: [] for table in COLUMNS}
+        self.written = 0
+
+    def flush(self, force=False):
+        if not force and len(self.rows['stock_move']) < CHUNK_SIZE:
+            return
+        conn = db.session.connection()
+        for table, columns in COLUMNS.items():
+            if self.rows[table]:
+                conn.exec_driver_sql(f"INSERT INTO {table} ({', '.join(columns)}) "
+                                     f"VALUES ({', '.join('?' * len(columns))})", self.rows[table])
+        self.written += len(self.rows['stock_move'])
+        self.rows = {table: [] for table in COLUMNS}
+        db.session.commit()
+
+def _timestamp(day, seconds):
+    """SQLAlchemy's SQLite DateTime text format (with microseconds, so values compare as strings)"""
+    seconds = min(int(seconds), 86399)
+    return f"{day} {seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}.000000"
+
+def _poisson(rng, mean):
+    return max(0, round(rng.gauss(mean, math.sqrt(mean)))) if mean > 0 else 0
+
+def _drop_bulk_indexes():
+    """Secondary indexes of the bulk-loaded tables; upgrade_schema() recreates them after the load"""
+    with db.engine.begin() as conn:
+        for table in COLUMNS:
+            for index in db.metadata.tables[table].indexes:
+                conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+
+def _reference_data(rng, warehouses, locations, products, now):
+    """Users, warehouses, locations, categories and products created at `now`; returns the user ids"""
+    users = []
+    for email, role, password in DEMO_USERS:
+        user = User(email=email, role=role, created_at=now)
+        user.set_password(password)
+        users.append(user)
+    db.session.add_all(users)
+    for w in range(1, warehouses + 1):
+        db.session.add(Warehouse(id=w, name="Main Warehouse" if w == 1 else f"{CITIES[(w - 2) % len(CITIES)]} Storage",
+                                 short_code=f"WH{w}", location=f"{100 + w} Industrial Blvd", is_default=w == 1,
+                                 created_at=now))
+    db.session.flush()
+    db.session.execute(Location.__table__.insert(), [
+        {'name': f"Aisle {n + 1}", 'short_code': f"WH{w}-A{n + 1}",
+         'warehouse_id': w, 'created_at': now} for w in range(1, warehouses + 1) for n in range(locations)])
+    names = list(CATEGORIES)
+    db.session.execute(Category.__table__.insert(), [
+        {'id': i, 'name': name, 'created_at': now} for i, name in enumerate(names, start=1)])
+    rows = []
+    for p in range(1, products + 1):
+        category = rng.randrange(len(names))
+        cost = round(rng.lognormvariate(3.5, 0.9), 2)
+        rows.append({'id': p, 'name': f"{rng.choice(ADJECTIVES)} {rng.choice(CATEGORIES[names[category]])} {chr(65 + p % 26)}{p}",
+                     'sku': f"{names[category][:3].upper()}-{p:07d}", 'category_id': category + 1,
+                     'unit_of_measure': 'pcs', 'reorder_min': 0, 'cost': cost,
+                     'sales_price': round(cost * rng.uniform(1.3, 2.2), 2), 'created_at': now})
+        if len(rows) == CHUNK_SIZE:
+            db.session.execute(Product.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Product.__table__.insert(), rows)
+    for table in ('warehouse', 'location', 'category'):
+        bump_table_version(table)  # Lists cached while the load ran are stale
+    db.session.commit()
+    return [user.id for user in users]
+
+def populate(seed=42, warehouses=3, locations=4, products=200, years=2, moves=20000, end_date=None, log=print):
+    """Drop the database and generate about `moves` stock moves over `years` of history; returns
+    the number of moves written"""
+    rng = random.Random(seed)
+    end_date = end_date or date.today()
+    days = [end_date - timedelta(days=d) for d in range(int(years * 365) - 1, -1, -1)]
+    started = time.perf_counter()
+
+    drop_product_search()  # Not part of the models: drop_all() would leave it behind
     db.drop_all()
     db.create_all()
+    _drop_bulk_indexes()
+    opened = datetime.combine(days[0], datetime.min.time())
+    user_ids = _reference_data(rng, warehouses, locations, products, opened)
+    db.session.connection().exec_driver_sql("PRAGMA synchronous=OFF")  # Throwaway data until the load finishes
 
-    # ================================
-    # 1. USERS
-    # ================================
-    admin = User(email="admin@stockmaster.com", role="manager")
-    admin.set_password("admin123")
-
-    staff1 = User(email="john@stockmaster.com", role="staff")
-    staff1.set_password("john123")
-
-    staff2 = User(email="sarah@stockmaster.com", role="staff")
-    staff2.set_password("sarah123")
-
-    db.session.add_all([admin, staff1, staff2])
-    db.session.commit()  # Important: commit so IDs are assigned
-
-    # ================================
-    # 2. WAREHOUSES
-    # ================================
-    wh_main = Warehouse(
-        name="Main Warehouse",
-        short_code="WH1",
-        location="123 Industrial Blvd, New York",
-        is_default=True
-    )
-    wh_brooklyn = Warehouse(
-        name="Brooklyn Storage",
-        short_code="WH2",
-        location="456 Dock Road, Brooklyn"
-    )
-    db.session.add_all([wh_main, wh_brooklyn])
-    db.session.commit()
+    # (product, warehouse) pairs: every product has a home warehouse, some a second one
+    popularity = list(range(1, products + 1))
+    rng.shuffle(popularity)
+    pair_product, pair_warehouse, pair_weight = [], [], []
+    for p in range(1, products + 1):
+        homes = [rng.randrange(warehouses) + 1]
+        if warehouses > 1 and rng.random() < 0.3:
+            homes.append(rng.choice([w for w in range(1, warehouses + 1) if w != homes[0]]))
+        for w in homes:
+            pair_product.append(p)
+            pair_warehouse.append(w)
+            pair_weight.append(1.0 / popularity[p - 1] ** 0.8 / len(homes) / math.sqrt(w))
+    pairs = len(pair_product)
+    total_weight = sum(pair_weight)
+    share = [pair_weight[i] / total_weight for i in range(pairs)]
+    season = [WEEKDAY_FACTOR[day.weekday()] * (1 + 0.25 * math.cos(2 * math.pi * (day.timetuple().tm_yday - 340) / 365))
+              * (1 + YEARLY_GROWTH) ** (i / 365) for i, day in enumerate(days)]
+    lead = [rng.randint(3, 10) for _ in range(pairs)]
 
-    # ================================
-    # 3. LOCATIONS
-    # ================================
-    loc_a1 = Location(name="Furniture Zone", short_code="A1", warehouse_id=wh_main.id)
-    loc_b1 = Location(name="Electronics Rack", short_code="B1", warehouse_id=wh_main.id)
-    loc_c1 = Location(name="Bulk Storage", short_code="C1", warehouse_id=wh_brooklyn.id)
-    db.session.add_all([loc_a1, loc_b1, loc_c1])
-    db.session.commit()
+    # Delivery lines per (average) day, sized so deliveries + replenishments + opening stock ~ moves
+    def plan(lines_per_day):
+        daily_qty = [lines_per_day * s * MEAN_LINE_QTY for s in share]
+        order_qty = [max(math.ceil(q * 21), 2 * int(MEAN_LINE_QTY)) for q in daily_qty]
+        receipts = sum(q * len(days) / o for q, o in zip(daily_qty, order_qty))
+        return daily_qty, order_qty, lines_per_day * len(days) + receipts
+    lines_per_day = max(moves - pairs, 0) / len(days)
+    for _ in range(4):
+        daily_qty, order_qty, planned = plan(lines_per_day)
+        lines_per_day *= max(moves - pairs, 0) / planned if planned else 0
+    daily_qty, order_qty, _ = plan(lines_per_day)
+    reorder_point = [math.ceil(q * lead[i] * 1.5) + 2 for i, q in enumerate(daily_qty)]
+    base_lines = lines_per_day * len(days) / sum(season)
+    warehouse_pairs = {w: [i for i in range(pairs) if pair_warehouse[i] == w] for w in range(1, warehouses + 1)}
+    warehouse_cum = {}
+    for w, members in warehouse_pairs.items():
+        cumulative, running = [], 0.0
+        for i in members:
+            running += pair_weight[i]
+            cumulative.append(running)
+        warehouse_cum[w] = cumulative
+    warehouse_share = {w: (cum[-1] / total_weight if cum else 0.0) for w, cum in warehouse_cum.items()}
+    reorder_mins = {}
+    for i in range(pairs):
+        reorder_mins[pair_product[i]] = max(reorder_mins.get(pair_product[i], 0), reorder_point[i])
+    conn = db.session.connection()
+    conn.exec_driver_sql("UPDATE product SET reorder_min = ? WHERE id = ?",
+                         [(value, product_id) for product_id, value in reorder_mins.items()])
 
-    # ================================
-    # 4. CATEGORIES
-    # ================================
-    cat_furniture = Category(name="Furniture")
-    cat_lighting = Category(name="Lighting")
-    cat_electronics = Category(name="Electronics")
-    db.session.add_all([cat_furniture, cat_lighting, cat_electronics])
-    db.session.commit()
+    writer = BulkWriter()
+    on_hand = [0.0] * pairs
+    on_order = [0.0] * pairs
+    pending = {0: [(i, order_qty[i] + reorder_point[i], 0) for i in range(pairs)]}  # Opening stock on day 0
+    numbers = {'receipt': 0, 'delivery': 0}
 
-    # ================================
-    # 5. PRODUCTS
-    # ================================
-    p_desk = Product(
-        name="Office Desk", sku="DESK001", category_id=cat_furniture.id,
-        cost=299.99, sales_price=499.99, reorder_min=10
-    )
-    
-    p_chair = Product(
-        name="Ergonomic Chair", sku="CHAIR001", category_id=cat_furniture.id,
-        cost=179.99, sales_price=329.99, reorder_min=20
-    )
-    p_lamp = Product(
-        name="LED Desk Lamp", sku="LAMP001", category_id=cat_lighting.id,
-        cost=39.99, sales_price=89.99, reorder_min=15
-    )
-    p_monitor = Product(
-        name='27" Monitor', sku="MON001", category_id=cat_electronics.id,
-        cost=349.99, sales_price=599.99, reorder_min=5
-    )
-    db.session.add_all([p_desk, p_chair, p_lamp, p_monitor])
-    db.session.commit()
+    def add_receipt(warehouse_id, lines, day_index, ordered_day, seconds, done=True):
+        numbers['receipt'] += 1
+        receipt_id = numbers['receipt']
+        reference = f"WH/IN/{receipt_id:04d}"
+        day = days[0] + timedelta(days=day_index)  # Open receipts arrive after the last day
+        at = _timestamp(day, seconds)
+        created = _timestamp(days[ordered_day], 9 * 3600)
+        writer.rows['receipt'].append((receipt_id, reference, rng.choice(VENDORS), warehouse_id, rng.choice(user_ids),
+                                       'done' if done else 'ready', _timestamp(day, 8 * 3600), created,
+                                       at if done else None))
+        for i, qty in lines:
+            writer.rows['receipt_line'].append((receipt_id, pair_product[i], qty, qty if done else 0.0, created))
+            if done:
+                writer.rows['stock_move'].append((reference, pair_product[i], None, warehouse_id, qty, 'receipt',
+                                                  'done', user_ids[0], at))
 
-    # ================================
-    # 6. INITIAL STOCK — DIRECT (no update_stock → no get_jwt_identity crash)
-    # ================================
-    db.session.add_all([
-        StockQuant(product_id=p_desk.id, warehouse_id=wh_main.id, quantity=45),
-        StockQuant(product_id=p_chair.id, warehouse_id=wh_main.id, quantity=120),
-        StockQuant(product_id=p_lamp.id, warehouse_id=wh_main.id, quantity=78),
-        StockQuant(product_id=p_monitor.id, warehouse_id=wh_main.id, quantity=12),
-        StockQuant(product_id=p_desk.id, warehouse_id=wh_brooklyn.id, quantity=15),
-    ])
-    db.session.commit()
+    progress_every = max(len(days) // 10, 1)
+    for d, day in enumerate(days):
+        # Replenishments arriving today, one receipt per warehouse and LINES_PER_RECEIPT lines
+        arrivals = {}
+        for i, qty, ordered in pending.pop(d, []):
+            arrivals.setdefault(pair_warehouse[i], []).append((i, qty, ordered))
+            on_hand[i] += qty
+            if d:  # Day 0 brings the opening stock, which was never on order
+                on_order[i] -= qty
+        clock = 8 * 3600.0
+        for warehouse_id in sorted(arrivals):
+            batch = arrivals[warehouse_id]
+            for start in range(0, len(batch), LINES_PER_RECEIPT):
+                chunk = batch[start:start + LINES_PER_RECEIPT]
+                add_receipt(warehouse_id, [(i, qty) for i, qty, _ in chunk], d, min(o for _, _, o in chunk), clock)
+                clock += 1
 
-    # ================================
-    # 7. RECEIPTS (with late one)
-    # ================================
-    receipt1 = Receipt(
-        reference="WH/IN/0001",
-        vendor="Azure Interior",
-        warehouse_id=wh_main.id,
-        responsible_id=admin.id,
-        status="done",
-        scheduled_date=datetime.utcnow() - timedelta(days=10),
-        validated_at=datetime.utcnow() - timedelta(days=8)
-    )
-    receipt_late = Receipt(
-        reference="WH/IN/0002",
-        vendor="Furniture Direct",
-        warehouse_id=wh_main.id,
-        responsible_id=staff1.id,
-        status="ready",
-        scheduled_date=datetime.utcnow() - timedelta(days=3)  # This will show as late
-    )
-    db.session.add_all([receipt1, receipt_late])
-    db.session.commit()
+        # Customer demand: long-tailed product picks, 1-5 lines per delivery, lost sales when out of stock
+        step = 9 * 3600.0 / max(base_lines * season[d] / 3, 1)
+        for warehouse_id in range(1, warehouses + 1):
+            count = _poisson(rng, base_lines * season[d] * warehouse_share[warehouse_id])
+            if not count:
+                continue
+            picks = rng.choices(warehouse_pairs[warehouse_id], cum_weights=warehouse_cum[warehouse_id], k=count)
+            position = 0
+            while position < count:
+                size = rng.randint(1, 5)
+                lines = []
+                for i in picks[position:position + size]:
+                    qty = min(1 + int(rng.expovariate(1 / (MEAN_LINE_QTY - 1))), on_hand[i])
+                    if qty <= 0:
+                        continue
+                    on_hand[i] -= qty
+                    lines.append((i, qty))
+                    if on_hand[i] + on_order[i] <= reorder_point[i]:
+                        pending.setdefault(d + lead[i], []).append((i, order_qty[i], d))
+                        on_order[i] += order_qty[i]
+                position += size
+                if not lines:
+                    continue
+                numbers['delivery'] += 1
+                delivery_id = numbers['delivery']
+                reference = f"WH/OUT/{delivery_id:04d}"
+                clock += step
+                at = _timestamp(day, clock)
+                writer.rows['delivery'].append((delivery_id, reference, f"{rng.randint(1, 999)} Main St, {rng.choice(CITIES)}",
+                                                warehouse_id, rng.choice(user_ids), 'done', 0, at, at, at))
+                for i, qty in lines:
+                    writer.rows['delivery_line'].append((delivery_id, pair_product[i], qty, qty, 0.0, at))
+                    writer.rows['stock_move'].append((reference, pair_product[i], warehouse_id, None, qty, 'delivery',
+                                                      'done', user_ids[0], at))
+        writer.flush()
+        if (d + 1) % progress_every == 0:
+            log(f"  {day}: {writer.written + len(writer.rows['stock_move'])} moves ({time.perf_counter() - started:.0f} s)")
 
-    db.session.add_all([
-        ReceiptLine(receipt_id=receipt1.id, product_id=p_desk.id, demand_qty=20, done_qty=20),
-        ReceiptLine(receipt_id=receipt1.id, product_id=p_chair.id, demand_qty=50, done_qty=50),
-        ReceiptLine(receipt_id=receipt_late.id, product_id=p_lamp.id, demand_qty=100, done_qty=0),
-    ])
-    db.session.commit()
+    # Replenishments still on their way are open receipts; a few draft deliveries wait for today
+    for d in sorted(pending):
+        arrivals = {}
+        for i, qty, ordered in pending[d]:
+            arrivals.setdefault(pair_warehouse[i], []).append((i, qty, ordered))
+        for warehouse_id in sorted(arrivals):
+            batch = arrivals[warehouse_id]
+            for start in range(0, len(batch), LINES_PER_RECEIPT):
+                chunk = batch[start:start + LINES_PER_RECEIPT]
+                add_receipt(warehouse_id, [(i, qty) for i, qty, _ in chunk], d, min(o for _, _, o in chunk), 9 * 3600,
+                            done=False)
+    stocked = [i for i in range(pairs) if on_hand[i] >= 5]
+    for n in range(min(10, len(stocked))):
+        numbers['delivery'] += 1
+        i = rng.choice(stocked)
+        scheduled = _timestamp(end_date + timedelta(days=n % 4 - 1), 14 * 3600)  # Some already late
+        writer.rows['delivery'].append((numbers['delivery'], f"WH/OUT/{numbers['delivery']:04d}",
+                                        f"{rng.randint(1, 999)} Main St, {rng.choice(CITIES)}", pair_warehouse[i],
+                                        rng.choice(user_ids), 'draft', 0, scheduled, _timestamp(days[-1], 12 * 3600), None))
+        writer.rows['delivery_line'].append((numbers['delivery'], pair_product[i], 5.0, 0.0, 0.0,
+                                             _timestamp(days[-1], 12 * 3600)))
+    writer.flush(force=True)
 
-    # ================================
-    # 8. DELIVERIES
-    # ================================
-    delivery1 = Delivery(
-        reference="WH/OUT/0001",
-        delivery_address="Client HQ, Manhattan",
-        warehouse_id=wh_main.id,
-        responsible_id=admin.id,
-        status="done",
-        scheduled_date=datetime.utcnow() - timedelta(days=5),
-        validated_at=datetime.utcnow() - timedelta(days=4)
-    )
-    delivery_ready = Delivery(
-        reference="WH/OUT/0002",
-        delivery_address="Tech Corp, Queens",
-        warehouse_id=wh_main.id,
-        responsible_id=staff2.id,
-        status="ready",
-        scheduled_date=datetime.utcnow() + timedelta(days=2)
-    )
-    db.session.add_all([delivery1, delivery_ready])
+    # Quants are the net of the moves per (product, warehouse)
+    log("Building quants, indexes and the search index...")
+    db.session.execute(db.text(
+        "INSERT INTO stock_quant (product_id, warehouse_id, quantity, binned_qty, reserved_qty, created_at) "
+        "SELECT product_id, warehouse_id, SUM(qty), 0, 0, :now FROM ("
+        "  SELECT product_id, to_location_id AS warehouse_id, quantity AS qty FROM stock_move WHERE to_location_id IS NOT NULL"
+        "  UNION ALL"
+        "  SELECT product_id, from_location_id, -quantity FROM stock_move WHERE from_location_id IS NOT NULL"
+        ") GROUP BY product_id, warehouse_id"), {'now': opened})
     db.session.commit()
-
-    db.session.add_all([
-        DeliveryLine(delivery_id=delivery1.id, product_id=p_desk.id, demand_qty=5, done_qty=5),
-        DeliveryLine(delivery_id=delivery_ready.id, product_id=p_chair.id, demand_qty=15, done_qty=0),
-    ])
+    total = db.session.query(db.func.sum(StockQuant.quantity)).scalar() or 0.0
+    assert abs(total - sum(on_hand)) < 1e-6, "quants do not match the simulated stock"
+    upgrade_schema()  # Recreate the indexes dropped for the load
+    ensure_product_search()
+    rebuild_kpis()
+    db.session.connection().exec_driver_sql("PRAGMA synchronous=NORMAL")
+    db.session.connection().exec_driver_sql("ANALYZE")  # Fresh planner statistics for the new row counts
     db.session.commit()
+    log(f"{writer.written} moves, {numbers['receipt']} receipts, {numbers['delivery']} deliveries, "
+        f"{products} products in {warehouses} warehouses ({time.perf_counter() - started:.0f} s)")
+    return writer.written
 
-    print("\nDATABASE POPULATED PERFECTLY!")
-    print("Login → admin@stockmaster.com / admin123")
-    print("You now have:")
-    print("   • Late receipt (orange badge)")
-    print("   • Ready delivery")
-    print("   • Multi-warehouse stock")
-    print("   • Locations, categories, users, everything ready")
-    print("\nNow run:")
-    print("   python app.py")
-    print("   Then in another terminal: python test.py")
-    print("   → ALL TESTS WILL PASS IN GREEN")
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drop the database and generate synthetic StockMaster data')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--warehouses', type=int, default=3)
+    parser.add_argument('--locations', type=int, default=4, help='Locations (bins) per warehouse')
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--years', type=float, default=2, help='Length of the move history')
+    parser.add_argument('--moves', type=int, default=20000, help='Approximate number of stock moves')
+    parser.add_argument('--end-date', type=date.fromisoformat, default=None,
+                        help='Last day of history (default today); fix it to reproduce the same data')
+    parser.add_argument('--database', help='SQLAlchemy URI (default: the app database)')
+    args = parser.parse_args()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database} if args.database else None)
+    with app.app_context():
+        print("Dropping and recreating database...")
+        populate(args.seed, args.warehouses, args.locations, args.products, args.years, args.moves, args.end_date)
+    print("\nLogin → admin@stockmaster.com / admin123")
+    print("Now run:  python app.py")
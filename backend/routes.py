@@ -1,10 +1,22 @@
 # routes.py — UPDATED FOR FRONTEND FUNCTIONALITY: Locations, Responsible, Short Codes, Late Flags, Enhanced Moves
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
+from flask import Blueprint, request, jsonify, current_app
+from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
 from datetime import datetime
-from models import db, User, Warehouse, Location, Category, Product, StockQuant, Receipt, ReceiptLine, Delivery, DeliveryLine, Transfer, TransferLine, Adjustment, AdjustmentLine, StockMove
-from utils import generate_reference, update_stock, require_manager_role
-from utils import generate_otp, send_otp_email, save_otp, verify_otp
+from models import db, open_status, OPEN_STATUSES, DashboardKpi, ReorderWatch, User, Warehouse, Location, Category, Product, StockQuant, LocationQuant, Receipt, ReceiptLine, Delivery, DeliveryLine, Transfer, TransferLine, Adjustment, AdjustmentLine, StockMove, ArchivedStockMove, Job, OutboxEvent
+from utils import generate_reference, post_moves, require_manager_role
+from utils import issue_token, bump_token_version, current_role
+from utils import bump_kpis, rebuild_kpis, product_kpi_change, apply_counts
+from utils import reserve_deliveries, release_reservations, reservation_order, transition
+from utils import bump_table_version, cached_list_response, emit_event
+from utils import get_page_limit, paginated_response, select_fields, rows_response
+from importers import open_upload, save_upload, iter_records, import_products, stage_counts
+from jobs import wants_async, enqueue, job_accepted
+from events import event_stream
+from snapshots import parse_as_of, stock_as_of
+from archive import archive_conditions, monthly_totals
+from search import search_enabled, fts_query, matching_product_ids, suggest_products
+import documents
+from otp import generate_otp, send_otp_email, save_otp, verify_otp, otp_request_allowed
 api = Blueprint('api', __name__)
 
 # Helper to replace lines
@@ -21,7 +33,7 @@ def replace_lines(model_line_class, parent_id, lines_data):
         line_data[parent_key] = parent_id
         db.session.add(model_line_class(**line_data))
 
-# 1. Auth (unchanged)
+# 1. Auth — role and token version are JWT claims; a version bump revokes older tokens
 @api.route('/auth/register', methods=['POST'])
 def register():
     try:
@@ -48,8 +60,7 @@ def login():
             return jsonify({'error': 'Email and password required'}), 400
         user = User.query.filter_by(email=data['email']).first()
         if user and user.check_password(data['password']):
-            token = create_access_token(identity=str(user.id))
-            return jsonify({'access_token': token, 'user': user.to_dict()})
+            return jsonify({'access_token': issue_token(user), 'user': user.to_dict()})
         return jsonify({'error': 'Invalid credentials'}), 401
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -64,6 +75,8 @@ def forgot_password():
         user = User.query.filter_by(email=email).first()
         if not user:
             return jsonify({'error': 'User not found'}), 404
+        if not otp_request_allowed(email):
+            return jsonify({'error': 'Too many reset requests, try again later'}), 429
         otp = generate_otp()
         save_otp(email, otp, expires_in=300)
         if send_otp_email(email, otp):
@@ -91,6 +104,7 @@ def reset_password():
         if not verify_otp(email, data['otp']):
             return jsonify({'error': 'Invalid or expired OTP'}), 400
         user.set_password(data['new_password'])
+        bump_token_version(user)  # Log out every session of the old password
         db.session.commit()
         return jsonify({'message': 'Password reset successfully'}), 200
     except Exception as e:
@@ -102,6 +116,11 @@ def reset_password():
 def profile():
     try:
         user_id = get_jwt_identity()
+        claims = get_jwt()
+        if request.method == 'GET' and 'email' in claims:
+            # Answered from the token: no user lookup
+            return jsonify({'id': int(user_id), 'email': claims['email'], 'role': claims['role'],
+                            'created_at': claims.get('created_at')})
         user = User.query.get_or_404(user_id)
         if request.method == 'GET':
             return jsonify(user.to_dict())
@@ -111,8 +130,29 @@ def profile():
         user.email = data.get('email', user.email)
         if 'password' in data:
             user.set_password(data['password'])
+        if 'password' in data or 'email' in data:
+            bump_token_version(user)  # Old tokens carry the old email / password session
         db.session.commit()
-        return jsonify({'message': 'Profile updated', 'user': user.to_dict()})
+        return jsonify({'message': 'Profile updated', 'user': user.to_dict(), 'access_token': issue_token(user)})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/users/<int:id>/role', methods=['PUT'])
+@jwt_required()
+@require_manager_role
+def set_user_role(id):
+    """Change a user's role; their existing tokens are revoked so the new role applies at once"""
+    try:
+        user = User.query.get_or_404(id)
+        role = (request.json or {}).get('role')
+        if role not in ('manager', 'staff'):
+            return jsonify({'error': "role must be 'manager' or 'staff'"}), 400
+        if role != user.role:
+            user.role = role
+            bump_token_version(user)
+            db.session.commit()
+        return jsonify(user.to_dict())
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -123,8 +163,7 @@ def profile():
 def warehouses():
     try:
         if request.method == 'GET':
-            warehouses = Warehouse.query.all()
-            return jsonify([w.to_dict() for w in warehouses])
+            return cached_list_response('warehouse', lambda: [w.to_dict() for w in Warehouse.query.all()])
         data = request.json
         if not data or not data.get('name'):
             return jsonify({'error': 'Name required'}), 400
@@ -135,6 +174,7 @@ def warehouses():
             is_default=data.get('is_default', False)
         )
         db.session.add(warehouse)
+        bump_table_version('warehouse')
         db.session.commit()
         return jsonify(warehouse.to_dict()), 201
     except Exception as e:
@@ -157,12 +197,15 @@ def warehouse_detail(id):
             wh.short_code = data.get('short_code', wh.short_code)  # NEW
             wh.location = data.get('location', wh.location)  # CHANGED: address -> location
             wh.is_default = data.get('is_default', wh.is_default)
+            bump_table_version('warehouse')
             db.session.commit()
             return jsonify(wh.to_dict())
         if request.method == 'DELETE':
             if wh.stock_quants:
                 return jsonify({'error': 'Cannot delete warehouse with stock'}), 400
             db.session.delete(wh)
+            bump_table_version('warehouse')
+            bump_table_version('location')  # Its locations are deleted with it
             db.session.commit()
             return jsonify({'message': 'Warehouse deleted'})
     except Exception as e:
@@ -174,8 +217,7 @@ def warehouse_detail(id):
 def locations():
     try:
         if request.method == 'GET':
-            locs = Location.query.all()
-            return jsonify([l.to_dict() for l in locs])
+            return cached_list_response('location', lambda: [l.to_dict() for l in Location.query.all()])
 
         data = request.json
         if not data or 'name' not in data or 'warehouse_id' not in data:
@@ -192,14 +234,19 @@ def locations():
             warehouse_id=data['warehouse_id']
         )
         db.session.add(location)
+        bump_table_version('location')
         db.session.commit()          # THIS WAS MISSING → 500 ERROR
         return jsonify(location.to_dict()), 201
 
     except Exception as e:
         db.session.rollback()
-        print("Location creation error:", str(e))  # Debug help
+        current_app.logger.exception("Location creation failed")
         return jsonify({'error': 'Server error'}), 500
 
+def _location_has_stock(location_id):
+    return db.session.query(LocationQuant.query.filter(
+        LocationQuant.location_id == location_id, LocationQuant.quantity != 0).exists()).scalar()
+
 @api.route('/locations/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 @jwt_required()
 @require_manager_role
@@ -212,27 +259,54 @@ def location_detail(id):
             data = request.json
             if not data:
                 return jsonify({'error': 'No data provided'}), 400
+            if data.get('warehouse_id', loc.warehouse_id) != loc.warehouse_id and _location_has_stock(loc.id):
+                return jsonify({'error': 'Cannot move a location that holds stock to another warehouse'}), 400
             loc.name = data.get('name', loc.name)
             loc.short_code = data.get('short_code', loc.short_code)
             loc.warehouse_id = data.get('warehouse_id', loc.warehouse_id)
+            bump_table_version('location')
             db.session.commit()
             return jsonify(loc.to_dict())
         if request.method == 'DELETE':
+            if _location_has_stock(loc.id):
+                return jsonify({'error': 'Cannot delete location with stock'}), 400
+            LocationQuant.query.filter_by(location_id=loc.id).delete()
             db.session.delete(loc)
+            bump_table_version('location')
             db.session.commit()
             return jsonify({'message': 'Location deleted'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@api.route('/locations/<int:id>/stock', methods=['GET'])
+@jwt_required()
+def location_stock(id):
+    """Products held in one location (bin), keyset-paginated on product id"""
+    try:
+        loc = Location.query.get_or_404(id)
+        limit = get_page_limit()
+        query = db.session.query(LocationQuant.product_id, Product.sku, Product.name, LocationQuant.quantity).join(
+            Product, Product.id == LocationQuant.product_id).filter(
+            LocationQuant.location_id == loc.id, LocationQuant.quantity != 0)
+        after = request.args.get('after', type=int)
+        if after:
+            query = query.filter(LocationQuant.product_id > after)
+        rows = query.order_by(LocationQuant.product_id).limit(limit + 1).all()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        items = [{'product_id': product_id, 'sku': sku, 'name': name, 'quantity': float(qty)}
+                 for product_id, sku, name, qty in rows[:limit]]
+        return paginated_response(items, next_cursor)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # 3. Categories (unchanged)
 @api.route('/categories', methods=['GET', 'POST'])
 @jwt_required()
 def categories():
     try:
         if request.method == 'GET':
-            cats = Category.query.all()
-            return jsonify([c.to_dict() for c in cats])
+            return cached_list_response('category', lambda: [c.to_dict() for c in Category.query.all()])
         data = request.json
         if not data or not data.get('name'):
             return jsonify({'error': 'Name required'}), 400
@@ -240,39 +314,83 @@ def categories():
             return jsonify({'error': 'Category exists'}), 400
         cat = Category(name=data['name'])
         db.session.add(cat)
+        bump_table_version('category')
         db.session.commit()
         return jsonify(cat.to_dict()), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
-# 4. Products (unchanged - already shows on_hand and category)
+def _as_of_param():
+    """Parsed ?as_of= (ISO date or datetime) for point-in-time stock, or None for current stock"""
+    value = request.args.get('as_of')
+    if not value:
+        return None
+    try:
+        return parse_as_of(value)
+    except ValueError:
+        raise ValueError('as_of must be an ISO date or datetime, e.g. 2025-03-31 or 2025-03-31T18:00:00')
+
+def _id_cursor():
+    """?after=<id> keyset cursor as sent in X-Next-Cursor, or None; ValueError if malformed"""
+    value = request.args.get('after')
+    if not value:
+        return None
+    if not value.isdigit():
+        raise ValueError(f"Invalid cursor: {value}")
+    return int(value)
+
+# 4. Products — on_hand aggregated per page, keyset pagination (?after=<id>&limit=), ?as_of= for history
 @api.route('/products', methods=['GET', 'POST'])
 @jwt_required()
 def products():
     try:
         if request.method == 'GET':
             q = request.args.get('q', '').strip()
-            query = Product.query
-            if q:
-                query = query.filter((Product.name.ilike(f'%{q}%')) | (Product.sku.ilike(f'%{q}%')))
-            products = query.all()
+            after = _id_cursor()
+            limit = get_page_limit()
+            # Pick the page of product ids first, then aggregate stock for that page only
+            page = db.session.query(Product.id)
+            if q and search_enabled():
+                if fts_query(q) is None:
+                    return paginated_response([])  # Nothing searchable in q (e.g. only punctuation)
+                page = page.filter(Product.id.in_(matching_product_ids(q)))  # FTS5 prefix match on name, SKU, category
+            elif q:
+                page = page.filter((Product.name.ilike(f'%{q}%')) | (Product.sku.ilike(f'%{q}%')))
+            if after:
+                page = page.filter(Product.id > after)
+            page = page.order_by(Product.id).limit(limit + 1).subquery()
+            rows = db.session.query(
+                Product.id, Product.sku, Product.name, Category.name, Product.cost,
+                db.func.coalesce(db.func.sum(StockQuant.quantity), 0),
+                Product.unit_of_measure, Product.reorder_min, Product.sales_price
+            ).join(page, page.c.id == Product.id)\
+             .outerjoin(Category, Product.category_id == Category.id)\
+             .outerjoin(StockQuant, StockQuant.product_id == Product.id)\
+             .group_by(Product.id)\
+             .order_by(Product.id).all()
+            next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+            as_of = _as_of_param()
+            if as_of:
+                # Historical on_hand for this page only, from the snapshots
+                history = {}
+                for (pid, _), qty in stock_as_of(as_of, [row[0] for row in rows[:limit]]).items():
+                    history[pid] = history.get(pid, 0.0) + qty
+                rows = [row[:5] + (history.get(row[0], 0.0),) + row[6:] for row in rows]
             result = []
-            for p in products:
-                total_stock = db.session.query(db.func.coalesce(db.func.sum(StockQuant.quantity), 0)).filter_by(product_id=p.id).scalar()
-                category_name = p.category.name if p.category else "Uncategorized"
+            for pid, sku, name, category_name, cost, on_hand, uom, reorder_min, sales_price in rows[:limit]:
                 result.append({
-                    "id": p.id,
-                    "sku": p.sku,
-                    "name": p.name,
-                    "category": category_name,
-                    "cost": float(p.cost or 0),
-                    "on_hand": float(total_stock or 0),
-                    "unit_of_measure": p.unit_of_measure or "pcs",
-                    "reorder_min": p.reorder_min or 0,
-                    "sales_price": float(p.sales_price or 0)
+                    "id": pid,
+                    "sku": sku,
+                    "name": name,
+                    "category": category_name or "Uncategorized",
+                    "cost": float(cost or 0),
+                    "on_hand": float(on_hand or 0),
+                    "unit_of_measure": uom or "pcs",
+                    "reorder_min": reorder_min or 0,
+                    "sales_price": float(sales_price or 0)
                 })
-            return jsonify(result)
+            return paginated_response(result, next_cursor)
         data = request.json
         if not data or not all(k in data for k in ['name', 'sku']):
             return jsonify({'error': 'Name and SKU required'}), 400
@@ -288,25 +406,113 @@ def products():
             sales_price=data.get('sales_price', 0.0)
         )
         db.session.add(product)
-        db.session.commit()
+        db.session.flush()
+        bump_kpis(total_products=1, out_of_stock_count=1)  # New products start with no stock
+        # Initial stock goes through the move ledger, in the same transaction as the product
         initial_stock = data.get('initial_stock', {})
-        for wh_id, qty in initial_stock.items():
-            if qty > 0:
-                quant = StockQuant(product_id=product.id, warehouse_id=int(wh_id), quantity=float(qty))
-                db.session.add(quant)
+        post_moves([{'product_id': product.id, 'from_location_id': None, 'to_location_id': int(wh_id),
+                     'quantity': float(qty), 'move_type': 'adjustment'}
+                    for wh_id, qty in initial_stock.items() if float(qty) > 0], 'INITIAL')
         db.session.commit()
         return jsonify(product.to_dict()), 201
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/products/suggest', methods=['GET'])
+@jwt_required()
+def products_suggest():
+    """Typeahead for the search bar and scanners: top 10 prefix matches for ?q="""
+    try:
+        q = request.args.get('q', '').strip()
+        if q and search_enabled():
+            rows = suggest_products(q)
+        elif q:
+            rows = db.session.query(Product.id, Product.sku, Product.name, Category.name)\
+                .outerjoin(Category, Product.category_id == Category.id)\
+                .filter((Product.name.ilike(f'{q}%')) | (Product.sku.ilike(f'{q}%'))).order_by(Product.sku).limit(10).all()
+        else:
+            rows = []
+        return jsonify([{'id': pid, 'sku': sku, 'name': name, 'category': category or 'Uncategorized'}
+                        for pid, sku, name, category in rows])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/products/import', methods=['POST'])
+@jwt_required()
+def products_import():
+    """Bulk import from a CSV/NDJSON body or 'file' upload; returns a per-row error report.
+
+    With ?async=1 the upload is spooled to disk and imported by a background job (202).
+    """
+    try:
+        if wants_async():
+            path, fmt = save_upload(current_app.config['JOB_UPLOAD_DIR'])
+            job = enqueue('import_products', {'path': path, 'format': fmt}, get_jwt_identity())
+            db.session.commit()
+            return job_accepted(job)
+        text_stream, fmt = open_upload()
+        report = import_products(iter_records(text_stream, fmt), get_jwt_identity())
+        return jsonify(report.to_dict())
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def _stock_by_warehouse(product_id):
+    """{warehouse name: qty} from the per-warehouse aggregate quants (bins are never summed here)"""
+    rows = db.session.query(Warehouse.name, StockQuant.quantity).join(
+        Warehouse, Warehouse.id == StockQuant.warehouse_id).filter(StockQuant.product_id == product_id)
+    return {name: float(qty) for name, qty in rows}
+
+def _stock_by_bin(product_id):
+    """{warehouse name: {location name: qty, 'unassigned': qty}} for one product"""
+    result = {}
+    for name, qty, binned in db.session.query(Warehouse.name, StockQuant.quantity, StockQuant.binned_qty).join(
+            Warehouse, Warehouse.id == StockQuant.warehouse_id).filter(StockQuant.product_id == product_id):
+        result[name] = {'unassigned': float(qty) - float(binned or 0)}
+    rows = db.session.query(Warehouse.name, Location.name, LocationQuant.quantity).join(
+        Location, Location.id == LocationQuant.location_id).join(
+        Warehouse, Warehouse.id == LocationQuant.warehouse_id).filter(
+        LocationQuant.product_id == product_id, LocationQuant.quantity != 0)
+    for warehouse_name, location_name, qty in rows:
+        result.setdefault(warehouse_name, {'unassigned': 0.0})[location_name] = float(qty)
+    return result
+
+def _stock_by_warehouse_as_of(product_id, as_of):
+    """{warehouse name: qty} at as_of (snapshot plus replayed moves, see snapshots.stock_as_of)"""
+    quantities = stock_as_of(as_of, [product_id])
+    names = dict(db.session.query(Warehouse.id, Warehouse.name).filter(Warehouse.id.in_({w for _, w in quantities})))
+    return {names.get(warehouse_id, str(warehouse_id)): float(qty) for (_, warehouse_id), qty in quantities.items()}
+
 @api.route('/products/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 @jwt_required()
 def product_detail(id):
     try:
         p = Product.query.get_or_404(id)
+        as_of = _as_of_param() if request.method == 'GET' else None
+        if as_of:
+            # Point in time: reservations are not historized, so only on-hand stock is reported
+            stock_by_location = _stock_by_warehouse_as_of(p.id, as_of)
+            return jsonify({
+                "id": p.id,
+                "sku": p.sku,
+                "name": p.name,
+                "category": p.category.name if p.category else "Uncategorized",
+                "cost": float(p.cost),
+                "sales_price": float(p.sales_price or 0),
+                "on_hand": sum(stock_by_location.values()),
+                "unit_of_measure": p.unit_of_measure or "pcs",
+                "reorder_min": p.reorder_min or 0,
+                "stock_by_location": stock_by_location,
+                "as_of": as_of.isoformat()
+            })
         if request.method == 'GET':
-            total_stock = db.session.query(db.func.coalesce(db.func.sum(StockQuant.quantity), 0)).filter_by(product_id=p.id).scalar()
+            total_stock, total_reserved = db.session.query(db.func.coalesce(db.func.sum(StockQuant.quantity), 0),
+                                                           db.func.coalesce(db.func.sum(StockQuant.reserved_qty), 0))\
+                .filter_by(product_id=p.id).one()
             category_name = p.category.name if p.category else "Uncategorized"
             return jsonify({
                 "id": p.id,
@@ -316,14 +522,18 @@ def product_detail(id):
                 "cost": float(p.cost),
                 "sales_price": float(p.sales_price or 0),
                 "on_hand": float(total_stock),
+                "reserved": float(total_reserved),
+                "available": max(float(total_stock) - float(total_reserved), 0.0),
                 "unit_of_measure": p.unit_of_measure or "pcs",
                 "reorder_min": p.reorder_min or 0,
-                "stock_by_location": {sq.warehouse.name: float(sq.quantity) for sq in p.stock_quants}
+                "stock_by_location": _stock_by_warehouse(p.id),
+                **({"stock_by_bin": _stock_by_bin(p.id)} if request.args.get('bins') else {})
             })
         if request.method == 'PUT':
             data = request.json
             if not data:
                 return jsonify({'error': 'No data provided'}), 400
+            old_cost, old_reorder_min = p.cost, p.reorder_min
             p.name = data.get('name', p.name)
             p.sku = data.get('sku', p.sku)
             p.category_id = data.get('category_id', p.category_id)
@@ -331,14 +541,19 @@ def product_detail(id):
             p.reorder_min = data.get('reorder_min', p.reorder_min)
             p.cost = data.get('cost', p.cost)
             p.sales_price = data.get('sales_price', p.sales_price)
+            if (p.cost, p.reorder_min) != (old_cost, old_reorder_min):
+                product_kpi_change(p.id, old_cost, old_reorder_min, p.cost, p.reorder_min)
             db.session.commit()
             return jsonify(p.to_dict())
         if request.method == 'DELETE':
             if any(sq.quantity > 0 for sq in p.stock_quants):
                 return jsonify({'error': 'Cannot delete product with stock'}), 400
+            product_kpi_change(p.id, p.cost, p.reorder_min, deleted=True)
             db.session.delete(p)
             db.session.commit()
             return jsonify({'message': 'Product deleted'})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -348,37 +563,100 @@ def product_detail(id):
 def product_stock(id):
     try:
         p = Product.query.get_or_404(id)
-        stock = {sq.warehouse.name: float(sq.quantity) for sq in p.stock_quants}
-        return jsonify({'product_id': id, 'stock_by_location': stock})
+        as_of = _as_of_param()
+        if as_of:
+            return jsonify({'product_id': p.id, 'as_of': as_of.isoformat(),
+                            'stock_by_location': _stock_by_warehouse_as_of(p.id, as_of)})
+        detail = {name: {'on_hand': float(qty), 'reserved': float(reserved or 0),
+                         'available': max(float(qty) - float(reserved or 0), 0.0)}
+                  for name, qty, reserved in db.session.query(Warehouse.name, StockQuant.quantity, StockQuant.reserved_qty)
+                  .join(Warehouse, Warehouse.id == StockQuant.warehouse_id).filter(StockQuant.product_id == p.id)}
+        return jsonify({'product_id': p.id, 'stock_by_location': {name: d['on_hand'] for name, d in detail.items()},
+                        'stock_detail': detail, 'stock_by_bin': _stock_by_bin(p.id)})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# 5. Stock Quants / KPIs (unchanged)
+# 5. Stock Quants / KPIs — ?as_of= answers from the stock snapshots; ?fields= projects columns in SQL
+STOCK_QUANT_FIELDS = {  # Same keys and values as StockQuant.to_dict()
+    'id': StockQuant.id,
+    'product_id': StockQuant.product_id,
+    'warehouse_id': StockQuant.warehouse_id,
+    'quantity': StockQuant.quantity,
+    'binned_qty': db.func.coalesce(StockQuant.binned_qty, 0.0),
+    'unassigned_qty': db.func.coalesce(StockQuant.quantity, 0.0) - db.func.coalesce(StockQuant.binned_qty, 0.0),
+    'reserved_qty': db.func.coalesce(StockQuant.reserved_qty, 0.0),
+    'available_qty': db.func.max(db.func.coalesce(StockQuant.quantity, 0.0) - db.func.coalesce(StockQuant.reserved_qty, 0.0), 0.0),
+    'created_at': StockQuant.created_at
+}
+
 @api.route('/stock-quants', methods=['GET'])
 @jwt_required()
 def stock_quants():
     try:
-        quants = StockQuant.query.all()
-        return jsonify([q.to_dict() for q in quants])
+        as_of = _as_of_param()
+        if as_of:
+            product_id = request.args.get('product_id', type=int)
+            quantities = stock_as_of(as_of, [product_id] if product_id else None,
+                                     request.args.get('warehouse_id', type=int))
+            return jsonify([{'product_id': pid, 'warehouse_id': warehouse_id, 'quantity': float(qty),
+                             'as_of': as_of.isoformat()}
+                            for (pid, warehouse_id), qty in sorted(quantities.items())])
+        names = select_fields(STOCK_QUANT_FIELDS)
+        after = _id_cursor()
+        limit = get_page_limit()
+        product_id = request.args.get('product_id', type=int)
+        warehouse_id = request.args.get('warehouse_id', type=int)
+        # The quant id rides along (last) for the cursor, whatever ?fields= selects
+        query = db.session.query(*[STOCK_QUANT_FIELDS[name] for name in names], StockQuant.id)
+        if product_id:
+            query = query.filter(StockQuant.product_id == product_id)
+        if warehouse_id:
+            query = query.filter(StockQuant.warehouse_id == warehouse_id)
+        if after:
+            query = query.filter(StockQuant.id > after)
+        rows = query.order_by(StockQuant.id).limit(limit + 1).all()
+        next_cursor = rows[limit - 1][-1] if len(rows) > limit else None
+        return rows_response(names, [row[:-1] for row in rows[:limit]], next_cursor)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _stock_report_filters(query, warehouse_column):
+    """Apply the shared ?warehouse_id= and ?category_id= filters of the stock reports"""
+    warehouse_id = request.args.get('warehouse_id', type=int)
+    category_id = request.args.get('category_id', type=int)
+    if warehouse_id:
+        query = query.filter(warehouse_column == warehouse_id)
+    if category_id:
+        query = query.filter(Product.category_id == category_id)
+    return query
+
 @api.route('/stock-quants/low-stock', methods=['GET'])
 @jwt_required()
 def low_stock():
     try:
-        low = []
-        for p in Product.query.all():
-            for sq in p.stock_quants:
-                if sq.quantity < p.reorder_min and sq.quantity > 0:
-                    low.append({
-                        'product_id': p.id,
-                        'product_name': p.name,
-                        'warehouse_id': sq.warehouse_id,
-                        'quantity': sq.quantity,
-                        'reorder_min': p.reorder_min
-                    })
-        return jsonify(low)
+        after = request.args.get('after', type=int)
+        limit = get_page_limit()
+        query = db.session.query(StockQuant.id, Product.id, Product.name, StockQuant.warehouse_id,
+                                 StockQuant.quantity, Product.reorder_min)\
+            .join(Product, StockQuant.product_id == Product.id)\
+            .filter(StockQuant.quantity < Product.reorder_min, StockQuant.quantity > 0)
+        query = _stock_report_filters(query, StockQuant.warehouse_id)
+        if after:
+            query = query.filter(StockQuant.id > after)
+        rows = query.order_by(StockQuant.id).limit(limit + 1).all()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        low = [{
+            'product_id': product_id,
+            'product_name': name,
+            'warehouse_id': warehouse_id,
+            'quantity': quantity,
+            'reorder_min': reorder_min
+        } for _, product_id, name, warehouse_id, quantity, reorder_min in rows[:limit]]
+        return paginated_response(low, next_cursor)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -386,18 +664,96 @@ def low_stock():
 @jwt_required()
 def out_of_stock():
     try:
-        out = []
-        for p in Product.query.all():
-            if all(sq.quantity == 0 for sq in p.stock_quants):
-                out.append({
-                    'product_id': p.id,
-                    'product_name': p.name,
-                    'sku': p.sku
-                })
-        return jsonify(out)
+        after = request.args.get('after', type=int)
+        warehouse_id = request.args.get('warehouse_id', type=int)
+        category_id = request.args.get('category_id', type=int)
+        limit = get_page_limit()
+        in_stock = (StockQuant.product_id == Product.id) & (StockQuant.quantity > 0)
+        if warehouse_id:
+            in_stock = in_stock & (StockQuant.warehouse_id == warehouse_id)
+        query = db.session.query(Product.id, Product.name, Product.sku).filter(~db.exists().where(in_stock))
+        if category_id:
+            query = query.filter(Product.category_id == category_id)
+        if after:
+            query = query.filter(Product.id > after)
+        rows = query.order_by(Product.id).limit(limit + 1).all()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        out = [{'product_id': product_id, 'product_name': name, 'sku': sku} for product_id, name, sku in rows[:limit]]
+        return paginated_response(out, next_cursor)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@api.route('/stock-quants/reorder-watchlist', methods=['GET'])
+@jwt_required()
+def reorder_watchlist():
+    try:
+        after = request.args.get('after', type=int)
+        limit = get_page_limit()
+        query = db.session.query(ReorderWatch, Product.name, Product.sku)\
+            .join(Product, ReorderWatch.product_id == Product.id)
+        query = _stock_report_filters(query, ReorderWatch.warehouse_id)
+        if after:
+            query = query.filter(ReorderWatch.id > after)
+        rows = query.order_by(ReorderWatch.id).limit(limit + 1).all()
+        next_cursor = rows[limit - 1][0].id if len(rows) > limit else None
+        result = [{**watch.to_dict(), 'product_name': name, 'sku': sku} for watch, name, sku in rows[:limit]]
+        return paginated_response(result, next_cursor)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Document lists (receipts, deliveries, transfers, adjustments): newest first, keyset pagination
+# on (created_at, id), lines loaded with one selectin query per page; ?view=summary replaces the
+# lines with counts and totals computed in SQL
+def _parse_created_cursor(cursor):
+    """Cursor format is '<created_at iso>|<id>' as emitted in X-Next-Cursor; ValueError if malformed"""
+    try:
+        created_at, row_id = cursor.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}") from None
+
+DOCUMENT_SUMMARIES = {  # document model -> (lines relationship, line parent key, {total name: line column})
+    Receipt: (Receipt.receipt_lines, ReceiptLine.receipt_id,
+              {'total_demand_qty': ReceiptLine.demand_qty, 'total_done_qty': ReceiptLine.done_qty}),
+    Delivery: (Delivery.delivery_lines, DeliveryLine.delivery_id,
+               {'total_demand_qty': DeliveryLine.demand_qty, 'total_done_qty': DeliveryLine.done_qty}),
+    Transfer: (Transfer.transfer_lines, TransferLine.transfer_id, {'total_qty': TransferLine.quantity}),
+    Adjustment: (Adjustment.adjustment_lines, AdjustmentLine.adjustment_id,
+                 {'total_counted_qty': AdjustmentLine.counted_qty, 'total_difference': AdjustmentLine.difference}),
+}
+
+def _document_page(model, query, extra=None):
+    """(documents as dicts, next cursor) for one page of a document list; extra(doc) adds keys"""
+    lines, parent_key, totals = DOCUMENT_SUMMARIES[model]
+    summary = request.args.get('view') == 'summary'
+    after = request.args.get('after')
+    limit = get_page_limit()
+    if after:
+        cursor_date, cursor_id = _parse_created_cursor(after)
+        query = query.filter((model.created_at < cursor_date) |
+                             ((model.created_at == cursor_date) & (model.id < cursor_id)))
+    if not summary:
+        query = query.options(db.selectinload(lines))
+    documents = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(documents) > limit:
+        last = documents[limit - 1]
+        next_cursor = f"{last.created_at.isoformat()}|{last.id}"
+    documents = documents[:limit]
+    extra = extra or (lambda doc: {})
+    if not summary:
+        return [{**doc.to_dict(), **extra(doc)} for doc in documents], next_cursor
+    names = list(totals)
+    stats = {row[0]: row[1:] for row in db.session.query(
+        parent_key, db.func.count(), *[db.func.coalesce(db.func.sum(column), 0.0) for column in totals.values()])
+        .filter(parent_key.in_([doc.id for doc in documents])).group_by(parent_key)}
+    result = []
+    for doc in documents:
+        line_count, *sums = stats.get(doc.id, (0,) + (0.0,) * len(names))
+        result.append({**doc.to_dict(include_lines=False), 'line_count': line_count, **dict(zip(names, sums)),
+                       **extra(doc)})
+    return result, next_cursor
+
 # 6. Receipts — UPDATED: responsible_id (default current user), is_late, vendor as receive_from
 @api.route('/receipts', methods=['GET', 'POST'])
 @jwt_required()
@@ -412,17 +768,13 @@ def receipts():
                 query = query.filter(Receipt.status == status)
             if warehouse_id:
                 query = query.filter(Receipt.warehouse_id == warehouse_id)
-            receipts = query.order_by(Receipt.created_at.desc()).all()
-            result = []
-            for r in receipts:
-                is_late = r.status in ['draft', 'ready'] and r.scheduled_date and r.scheduled_date < now  # NEW: Late flag
-                result.append({**r.to_dict(), 'is_late': is_late})
-            return jsonify(result)
+            return paginated_response(*_document_page(Receipt, query, lambda r: {  # NEW: Late flag
+                'is_late': r.status in ['draft', 'ready'] and r.scheduled_date and r.scheduled_date < now}))
         data = request.json
         if not data or not all(k in data for k in ['vendor', 'warehouse_id', 'lines']):
             return jsonify({'error': 'Vendor, warehouse_id, and lines required'}), 400
         user_id = get_jwt_identity()  # NEW: Default responsible
-        ref = generate_reference(Receipt, 'WH/IN')
+        ref = generate_reference(Receipt, 'WH/IN', data['warehouse_id'])
         scheduled_date = data.get('scheduled_date')
         if scheduled_date:
             scheduled_date = datetime.fromisoformat(scheduled_date)
@@ -435,11 +787,16 @@ def receipts():
         )
         db.session.add(receipt)
         db.session.flush()
+        bump_kpis(receipts_total=1, receipts_pending=1)
+        emit_event('receipt.status', {'id': receipt.id, 'status': 'draft'})
         for line_data in data['lines']:
             line_data['receipt_id'] = receipt.id
             db.session.add(ReceiptLine(**line_data))
         db.session.commit()
         return jsonify(receipt.to_dict()), 201
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -475,19 +832,24 @@ def receipt_detail(id):
 @api.route('/receipts/<int:id>/validate', methods=['POST'])
 @jwt_required()
 def validate_receipt(id):
+    """Post the receipt; large receipts (or ?async=1) are validated by a background job (202)"""
     try:
         r = Receipt.query.get_or_404(id)
         if r.status != 'draft':
             return jsonify({'error': 'Receipt must be draft to validate'}), 400
-        for line in r.receipt_lines:
-            if line.done_qty > line.demand_qty:  # NEW: Prevent over-receipt
-                return jsonify({'error': f'Done qty cannot exceed demand for product {line.product_id}'}), 400
-            if line.done_qty > 0:
-                update_stock(line.product_id, r.warehouse_id, line.done_qty, 'receipt', r.reference)
-        r.status = 'done'
-        r.validated_at = datetime.utcnow()
+        if wants_async(ReceiptLine.query.filter_by(receipt_id=r.id).count()):
+            job = enqueue('validate_receipt', {'id': r.id}, get_jwt_identity())
+            db.session.commit()
+            return job_accepted(job)
+        result = documents.validate_receipt(r)
         db.session.commit()
-        return jsonify({'message': 'Receipt validated, stock updated'})
+        return jsonify(result)
+    except documents.StatusConflict as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -499,8 +861,12 @@ def cancel_receipt(id):
         r = Receipt.query.get_or_404(id)
         if r.status == 'done':
             return jsonify({'error': 'Cannot cancel done receipt'}), 400
-        r.status = 'canceled'
-        db.session.commit()
+        if r.status in OPEN_STATUSES:
+            if not transition(Receipt, r.id, (r.status,), 'canceled'):
+                db.session.rollback()
+                return jsonify({'error': 'Receipt was changed by another request'}), 409
+            bump_kpis(receipts_pending=-1)
+            db.session.commit()
         return jsonify({'message': 'Receipt canceled'})
     except Exception as e:
         db.session.rollback()
@@ -520,17 +886,13 @@ def deliveries():
                 query = query.filter(Delivery.status == status)
             if warehouse_id:
                 query = query.filter(Delivery.warehouse_id == warehouse_id)
-            deliveries = query.order_by(Delivery.created_at.desc()).all()
-            result = []
-            for d in deliveries:
-                is_late = d.status in ['draft', 'ready'] and d.scheduled_date and d.scheduled_date < now
-                result.append({**d.to_dict(), 'is_late': is_late})
-            return jsonify(result)
+            return paginated_response(*_document_page(Delivery, query, lambda d: {
+                'is_late': d.status in ['draft', 'ready'] and d.scheduled_date and d.scheduled_date < now}))
         data = request.json
         if not data or not all(k in data for k in ['delivery_address', 'warehouse_id', 'lines']):
             return jsonify({'error': 'Delivery address, warehouse_id, and lines required'}), 400
         user_id = get_jwt_identity()
-        ref = generate_reference(Delivery, 'WH/OUT')
+        ref = generate_reference(Delivery, 'WH/OUT', data['warehouse_id'])
         scheduled_date = data.get('scheduled_date')
         if scheduled_date:
             scheduled_date = datetime.fromisoformat(scheduled_date)
@@ -539,15 +901,22 @@ def deliveries():
             delivery_address=data['delivery_address'],  # CHANGED: customer -> delivery_address
             warehouse_id=data['warehouse_id'],
             responsible_id=user_id,  # NEW
-            scheduled_date=scheduled_date
+            scheduled_date=scheduled_date,
+            priority=int(data.get('priority') or 0)
         )
         db.session.add(delivery)
         db.session.flush()
+        bump_kpis(deliveries_total=1, deliveries_pending=1)
+        emit_event('delivery.status', {'id': delivery.id, 'status': 'draft'})
         for line_data in data['lines']:
+            line_data.pop('reserved_qty', None)  # Only mark-ready / the reserve sweep set this
             line_data['delivery_id'] = delivery.id
             db.session.add(DeliveryLine(**line_data))
         db.session.commit()
         return jsonify(delivery.to_dict()), 201
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -561,10 +930,14 @@ def delivery_detail(id):
         if request.method == 'GET':
             is_late = d.status in ['draft', 'ready'] and d.scheduled_date and d.scheduled_date < now
             # NEW: Add stock status per line
+            lines = d.delivery_lines
+            on_hand = dict(db.session.query(StockQuant.product_id, StockQuant.quantity).filter(
+                StockQuant.warehouse_id == d.warehouse_id,
+                StockQuant.product_id.in_({line.product_id for line in lines})))  # One query for all lines
             enhanced_lines = []
-            for line in d.delivery_lines:
-                quant = StockQuant.query.filter_by(product_id=line.product_id, warehouse_id=d.warehouse_id).first()
-                stock_status = 'In Stock' if (quant and quant.quantity >= line.demand_qty) else 'Low Stock'
+            for line in lines:
+                in_stock = line.product_id in on_hand and on_hand[line.product_id] >= line.demand_qty
+                stock_status = 'In Stock' if in_stock else 'Low Stock'
                 enhanced_lines.append({**line.to_dict(), 'stock_status': stock_status})
             return jsonify({**d.to_dict(), 'lines': enhanced_lines, 'is_late': is_late})
         if request.method == 'PUT':
@@ -574,11 +947,14 @@ def delivery_detail(id):
             if not data:
                 return jsonify({'error': 'No data provided'}), 400
             d.delivery_address = data.get('delivery_address', d.delivery_address)
+            d.priority = int(data.get('priority', d.priority) or 0)
             if 'scheduled_date' in data:
                 d.scheduled_date = datetime.fromisoformat(data['scheduled_date']) if data['scheduled_date'] else None
             if 'responsible_id' in data:
                 d.responsible_id = data.get('responsible_id')
             if 'lines' in data:
+                for line_data in data['lines']:
+                    line_data.pop('reserved_qty', None)
                 replace_lines(DeliveryLine, d.id, data['lines'])
             db.session.commit()
             return jsonify(d.to_dict())
@@ -589,50 +965,79 @@ def delivery_detail(id):
 @api.route('/deliveries/<int:id>/check-availability', methods=['POST'])
 @jwt_required()
 def check_availability(id):
+    """Can the delivery be fulfilled? Own reservations plus the quant's free stock, one query"""
     try:
         d = Delivery.query.get_or_404(id)
-        available = True
-        issues = []
-
-        # FIX 1: Use correct relationship name → delivery_lines (not lines)
-        for line in d.delivery_lines:  # ← WAS d.lines or d.line → empty!
-            quant = StockQuant.query.filter_by(
-                product_id=line.product_id,
-                warehouse_id=d.warehouse_id
-            ).first_or_404()  # ← Safer than .first()
-
-            current_qty = quant.quantity if quant else 0
-
-            if current_qty < line.demand_qty:
-                available = False
-                issues.append({
-                    'product_id': line.product_id,
-                    'product_name': line.product.name,
-                    'needed': float(line.demand_qty),
-                    'available': float(current_qty)
-                })
+        rows = db.session.query(DeliveryLine.product_id, Product.name, DeliveryLine.demand_qty,
+                                DeliveryLine.reserved_qty, StockQuant.quantity, StockQuant.reserved_qty)\
+            .join(Product, Product.id == DeliveryLine.product_id)\
+            .outerjoin(StockQuant, db.and_(StockQuant.product_id == DeliveryLine.product_id,
+                                           StockQuant.warehouse_id == d.warehouse_id))\
+            .filter(DeliveryLine.delivery_id == d.id).all()
 
-        # FIX 2: Always return 'available' as boolean (was sometimes missing)
+        # Lines of the same product share the free stock, so compare per product
+        per_product = {}
+        for product_id, name, demand, line_reserved, on_hand, quant_reserved in rows:
+            entry = per_product.setdefault(product_id, {
+                'product_id': product_id, 'product_name': name, 'needed': 0.0, 'reserved': 0.0,
+                'free': max((on_hand or 0.0) - (quant_reserved or 0.0), 0.0)})
+            entry['needed'] += demand or 0.0
+            entry['reserved'] += line_reserved or 0.0
+        issues = []
+        for entry in per_product.values():
+            entry['available'] = entry['reserved'] + entry.pop('free')
+            if entry['available'] < entry['needed']:
+                issues.append(entry)
         return jsonify({
-            'available': available,
+            'available': not issues,
             'issues': issues
         })
 
     except Exception as e:
-        # Optional: log the error
-        print("Check availability error:", str(e))
-        return jsonify({'error': 'Server error'}), 500
+        return jsonify({'error': str(e)}), 500
 
 @api.route('/deliveries/<int:id>/mark-ready', methods=['POST'])
 @jwt_required()
 def mark_ready(id):
+    """Move to ready and reserve stock for every line (partial reservations are reported)"""
     try:
         d = Delivery.query.get_or_404(id)
         if d.status != 'draft':
             return jsonify({'error': 'Can only mark draft as ready'}), 400
-        d.status = 'ready'
+        if not transition(Delivery, d.id, ('draft',), 'ready'):
+            db.session.rollback()
+            return jsonify({'error': 'Delivery was changed by another request'}), 409
+        shortages = reserve_deliveries([d.id]).get(d.id, [])
         db.session.commit()
-        return jsonify({'message': 'Delivery marked as ready'})
+        return jsonify({'message': 'Delivery marked as ready', 'fully_reserved': not shortages,
+                        'shortages': shortages})
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/deliveries/reserve', methods=['POST'])
+@jwt_required()
+def reserve_ready_deliveries():
+    """Allocate free stock to all ready deliveries in one sweep, by priority then scheduled date"""
+    try:
+        query = db.session.query(Delivery.id).filter(Delivery.status == 'ready')
+        warehouse_id = request.args.get('warehouse_id', type=int)
+        if warehouse_id:
+            query = query.filter(Delivery.warehouse_id == warehouse_id)
+        delivery_ids = [delivery_id for (delivery_id,) in reservation_order(query)]
+        shortages = reserve_deliveries(delivery_ids)
+        db.session.commit()
+        return jsonify({
+            'deliveries': len(delivery_ids),
+            'fully_reserved': len(delivery_ids) - len(shortages),
+            'shortages': [{'delivery_id': delivery_id, 'lines': lines} for delivery_id, lines in shortages.items()]
+        })
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -640,27 +1045,24 @@ def mark_ready(id):
 @api.route('/deliveries/<int:id>/validate', methods=['POST'])
 @jwt_required()
 def validate_delivery(id):
+    """Ship the delivery; large deliveries (or ?async=1) are validated by a background job (202)"""
     try:
         d = Delivery.query.get_or_404(id)
         if d.status != 'ready':
             return jsonify({'error': 'Delivery must be ready to validate'}), 400
-        
-        # Manual stock check
-        for line in d.delivery_lines:
-            quant = StockQuant.query.filter_by(product_id=line.product_id, warehouse_id=d.warehouse_id).first()
-            current_qty = quant.quantity if quant else 0
-            if current_qty < line.done_qty:
-                return jsonify({'error': f'Insufficient stock for product {line.product_id} (needed {line.done_qty}, available {current_qty})'}), 400
-            if line.done_qty > line.demand_qty:  # NEW: Prevent over-delivery
-                return jsonify({'error': f'Done qty cannot exceed demand for product {line.product_id}'}), 400
-        
-        for line in d.delivery_lines:
-            if line.done_qty > 0:
-                update_stock(line.product_id, d.warehouse_id, -line.done_qty, 'delivery', d.reference)
-        d.status = 'done'
-        d.validated_at = datetime.utcnow()
+        if wants_async(DeliveryLine.query.filter_by(delivery_id=d.id).count()):
+            job = enqueue('validate_delivery', {'id': d.id}, get_jwt_identity())
+            db.session.commit()
+            return job_accepted(job)
+        result = documents.validate_delivery(d)
         db.session.commit()
-        return jsonify({'message': 'Delivery validated, stock updated'})
+        return jsonify(result)
+    except documents.StatusConflict as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -672,8 +1074,14 @@ def cancel_delivery(id):
         d = Delivery.query.get_or_404(id)
         if d.status == 'done':
             return jsonify({'error': 'Cannot cancel done delivery'}), 400
-        d.status = 'canceled'
-        db.session.commit()
+        if d.status in OPEN_STATUSES:
+            if not transition(Delivery, d.id, (d.status,), 'canceled'):
+                db.session.rollback()
+                return jsonify({'error': 'Delivery was changed by another request'}), 409
+            bump_kpis(deliveries_pending=-1)
+            if d.status == 'ready':
+                release_reservations([d.id])
+            db.session.commit()
         return jsonify({'message': 'Delivery canceled'})
     except Exception as e:
         db.session.rollback()
@@ -689,12 +1097,11 @@ def transfers():
             query = Transfer.query
             if status:
                 query = query.filter(Transfer.status == status)
-            transfers = query.order_by(Transfer.created_at.desc()).all()
-            return jsonify([t.to_dict() for t in transfers])
+            return paginated_response(*_document_page(Transfer, query))
         data = request.json
         if not data or not all(k in data for k in ['from_warehouse_id', 'to_warehouse_id', 'lines']):
             return jsonify({'error': 'From warehouse, to warehouse, and lines required'}), 400
-        ref = generate_reference(Transfer, 'WH/TR')
+        ref = generate_reference(Transfer, 'WH/TR', data['from_warehouse_id'])
         transfer = Transfer(
             reference=ref,
             from_warehouse_id=data['from_warehouse_id'],
@@ -702,11 +1109,16 @@ def transfers():
         )
         db.session.add(transfer)
         db.session.flush()
+        bump_kpis(transfers_pending=1)
+        emit_event('transfer.status', {'id': transfer.id, 'status': 'draft'})
         for line_data in data['lines']:
             line_data['transfer_id'] = transfer.id
             db.session.add(TransferLine(**line_data))
         db.session.commit()
         return jsonify(transfer.to_dict()), 201
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -714,43 +1126,39 @@ def transfers():
 @api.route('/transfers/<int:id>/validate', methods=['POST'])
 @jwt_required()
 def validate_transfer(id):
+    """Move the stock; large transfers (or ?async=1) are validated by a background job (202)"""
     try:
         t = Transfer.query.get_or_404(id)
         if t.status != 'draft':
             return jsonify({'error': 'Transfer must be draft to validate'}), 400
-        
-        # Check source stock
-        for line in t.transfer_lines:
-            quant = StockQuant.query.filter_by(product_id=line.product_id, warehouse_id=t.from_warehouse_id).first()
-            current_qty = quant.quantity if quant else 0
-            if current_qty < line.quantity:
-                return jsonify({'error': f'Insufficient stock for product {line.product_id} (needed {line.quantity}, available {current_qty})'}), 400
-        
-        # Move stock
-        for line in t.transfer_lines:
-            update_stock(line.product_id, t.from_warehouse_id, -line.quantity, 'transfer', t.reference)
-            update_stock(line.product_id, t.to_warehouse_id, line.quantity, 'transfer', t.reference)
-        
-        t.status = 'done'
-        t.validated_at = datetime.utcnow()
+        if wants_async(TransferLine.query.filter_by(transfer_id=t.id).count()):
+            job = enqueue('validate_transfer', {'id': t.id}, get_jwt_identity())
+            db.session.commit()
+            return job_accepted(job)
+        result = documents.validate_transfer(t)
         db.session.commit()
-        return jsonify({'message': 'Transfer validated, stock moved'})
+        return jsonify(result)
+    except documents.StatusConflict as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
-# 9. Adjustments (unchanged, but fixed double-count)
+# 9. Adjustments — counts are posted in bulk (apply_counts); large counts use an open count session
 @api.route('/adjustments', methods=['GET', 'POST'])  # NEW: Added GET
 @jwt_required()
 def adjustments():
     try:
         if request.method == 'GET':
-            adjs = Adjustment.query.order_by(Adjustment.created_at.desc()).all()
-            return jsonify([a.to_dict() for a in adjs])
+            return paginated_response(*_document_page(Adjustment, Adjustment.query))
         data = request.json
         if not data or not all(k in data for k in ['warehouse_id', 'lines']):
             return jsonify({'error': 'Warehouse ID and lines required'}), 400
-        ref = generate_reference(Adjustment, 'WH/ADJ')
+        ref = generate_reference(Adjustment, 'WH/ADJ', data['warehouse_id'])
         adjustment = Adjustment(
             reference=ref,
             warehouse_id=data['warehouse_id'],
@@ -758,145 +1166,353 @@ def adjustments():
         )
         db.session.add(adjustment)
         db.session.flush()
-        for line_data in data['lines']:
-            product_id = line_data['product_id']
-            counted_qty = float(line_data['counted_qty'])
-            quant = StockQuant.query.filter_by(product_id=product_id, warehouse_id=data['warehouse_id']).first()
-            previous_qty = quant.quantity if quant else 0.0
-            diff = counted_qty - previous_qty
-            al = AdjustmentLine(
-                adjustment_id=adjustment.id,
-                product_id=product_id,
-                counted_qty=counted_qty,
-                previous_qty=previous_qty,
-                difference=diff
-            )
-            db.session.add(al)
-            # FIXED: Only update if diff != 0, and set exact after
-            if diff != 0:
-                update_stock(product_id, data['warehouse_id'], diff, 'adjustment', ref)
-            # FIXED: Set exact counted_qty AFTER update
-            if quant:
-                quant.quantity = counted_qty
-            else:
-                quant = StockQuant(product_id=product_id, warehouse_id=data['warehouse_id'], quantity=counted_qty)
-                db.session.add(quant)
+        counts = {int(line['product_id']): float(line['counted_qty']) for line in data['lines']}
+        apply_counts(adjustment, counts)
         db.session.commit()
         return jsonify(adjustment.to_dict()), 201
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/adjustments/counts', methods=['POST'])
+@jwt_required()
+def open_count():
+    """Open a count session; scanners then submit counts in chunks before it is applied"""
+    try:
+        data = request.json
+        if not data or 'warehouse_id' not in data:
+            return jsonify({'error': 'Warehouse ID required'}), 400
+        adjustment = Adjustment(
+            reference=generate_reference(Adjustment, 'WH/ADJ', data['warehouse_id']),
+            warehouse_id=data['warehouse_id'],
+            reason=data.get('reason', 'Cycle Count'),
+            status='open'
+        )
+        db.session.add(adjustment)
+        db.session.commit()
+        return jsonify({**adjustment.to_dict(), 'lines': []}), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
-# 10. Stock Moves — ENHANCED: Add contact, from/to names, type icon logic
+def _count_summary(adjustment):
+    """Count session header plus its line count (without serializing every line)"""
+    line_count = db.session.query(db.func.count(AdjustmentLine.id)).filter_by(adjustment_id=adjustment.id).scalar()
+    return {
+        'id': adjustment.id,
+        'reference': adjustment.reference,
+        'warehouse_id': adjustment.warehouse_id,
+        'reason': adjustment.reason,
+        'status': adjustment.status,
+        'line_count': line_count
+    }
+
+@api.route('/adjustments/counts/<int:id>', methods=['GET'])
+@jwt_required()
+def count_detail(id):
+    try:
+        return jsonify(_count_summary(Adjustment.query.get_or_404(id)))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/adjustments/counts/<int:id>/lines', methods=['POST'])
+@jwt_required()
+def count_lines(id):
+    """Stage counts from JSON {"lines": [...]} or a CSV/NDJSON upload (product_id or sku, counted_qty)"""
+    try:
+        adjustment = Adjustment.query.get_or_404(id)
+        if adjustment.status != 'open':
+            return jsonify({'error': 'Count session is not open'}), 400
+        mode = request.args.get('mode', 'set')
+        if mode not in ('set', 'add'):
+            return jsonify({'error': "mode must be 'set' or 'add'"}), 400
+        if request.is_json:
+            records = enumerate((request.json or {}).get('lines', []), start=1)
+        else:
+            records = iter_records(*open_upload())
+        report = stage_counts(adjustment, records, mode)
+        return jsonify({**report.to_dict(), **_count_summary(adjustment)})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/adjustments/counts/<int:id>/apply', methods=['POST'])
+@jwt_required()
+def apply_count(id):
+    """Post the staged counts; large sessions (or ?async=1) are applied by a background job (202)"""
+    try:
+        adjustment = Adjustment.query.get_or_404(id)
+        if adjustment.status != 'open':
+            return jsonify({'error': 'Count session is not open'}), 400
+        if wants_async(AdjustmentLine.query.filter_by(adjustment_id=adjustment.id).count()):
+            job = enqueue('apply_count', {'id': adjustment.id}, get_jwt_identity())
+            db.session.commit()
+            return job_accepted(job)
+        result = documents.apply_count_session(adjustment)
+        db.session.commit()
+        return jsonify(result)
+    except documents.StatusConflict as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+# 10. Stock Moves — keyset pagination on (created_at, id), filters, contacts joined per page;
+# date_from before the archive cutoff continues into the archived moves (archive.py)
+def _move_filters(model, product_id, warehouse_id, move_type, date_from, date_to, after):
+    """The /stock-moves filters for live (StockMove) or archived (ArchivedStockMove) rows"""
+    conditions = []
+    if product_id:
+        conditions.append(model.product_id == product_id)
+    if warehouse_id:
+        conditions.append((model.from_location_id == warehouse_id) | (model.to_location_id == warehouse_id))
+    if move_type:
+        conditions.append(model.move_type == move_type)
+    if date_from:
+        conditions.append(model.created_at >= date_from)
+    if date_to:
+        conditions.append(model.created_at <= date_to)
+    if after:
+        cursor_date, cursor_id = _parse_created_cursor(after)
+        conditions.append((model.created_at < cursor_date) |
+                          ((model.created_at == cursor_date) & (model.id < cursor_id)))
+    return conditions
+
+def _archived_move_rows(conditions, limit):
+    """Archived moves in the /stock-moves row shape; names and contacts come from the main database"""
+    moves = db.session.query(
+        ArchivedStockMove.id, ArchivedStockMove.reference, ArchivedStockMove.created_at, ArchivedStockMove.quantity,
+        ArchivedStockMove.move_type, ArchivedStockMove.state,
+        ArchivedStockMove.from_location_id, ArchivedStockMove.to_location_id
+    ).filter(*conditions).order_by(ArchivedStockMove.created_at.desc(), ArchivedStockMove.id.desc()).limit(limit).all()
+    warehouse_ids = {m.from_location_id for m in moves} | {m.to_location_id for m in moves}
+    names = dict(db.session.query(Warehouse.id, Warehouse.name).filter(Warehouse.id.in_(warehouse_ids - {None})))
+    references = {m.reference for m in moves if m.reference}
+    receipts = {ref: (vendor, name) for ref, vendor, name in db.session.query(
+        Receipt.reference, Receipt.vendor, Warehouse.name).outerjoin(Warehouse, Receipt.warehouse_id == Warehouse.id)
+        .filter(Receipt.reference.in_(references))}
+    deliveries = {ref: (address, name) for ref, address, name in db.session.query(
+        Delivery.reference, Delivery.delivery_address, Warehouse.name).outerjoin(Warehouse, Delivery.warehouse_id == Warehouse.id)
+        .filter(Delivery.reference.in_(references))}
+    return [(m.id, m.reference, m.created_at, m.quantity, m.move_type, m.state,
+             names.get(m.from_location_id), names.get(m.to_location_id),
+             *(receipts.get(m.reference, (None, None)) if m.move_type == 'receipt' else (None, None)),
+             *(deliveries.get(m.reference, (None, None)) if m.move_type == 'delivery' else (None, None)))
+            for m in moves]
+
 @api.route('/stock-moves', methods=['GET'])
 @jwt_required()
 def stock_moves():
     try:
         product_id = request.args.get('product_id', type=int)
-        query = StockMove.query.order_by(StockMove.created_at.desc())
-        if product_id:
-            query = query.filter_by(product_id=product_id)
+        warehouse_id = request.args.get('warehouse_id', type=int)
+        move_type = request.args.get('move_type')
+        date_from = request.args.get('date_from')
+        date_to = request.args.get('date_to')
+        date_from = datetime.fromisoformat(date_from) if date_from else None
+        date_to = parse_as_of(date_to) if date_to else None  # A bare date includes that whole day
+        after = request.args.get('after')
+        limit = get_page_limit()
+        filters = (product_id, warehouse_id, move_type, date_from, date_to, after)
+
+        FromWarehouse = db.aliased(Warehouse)
+        ToWarehouse = db.aliased(Warehouse)
+        ReceiptWarehouse = db.aliased(Warehouse)
+        DeliveryWarehouse = db.aliased(Warehouse)
+        query = db.session.query(
+            StockMove.id, StockMove.reference, StockMove.created_at, StockMove.quantity,
+            StockMove.move_type, StockMove.state,
+            FromWarehouse.name, ToWarehouse.name,
+            Receipt.vendor, ReceiptWarehouse.name,
+            Delivery.delivery_address, DeliveryWarehouse.name
+        ).outerjoin(FromWarehouse, StockMove.from_location_id == FromWarehouse.id)\
+         .outerjoin(ToWarehouse, StockMove.to_location_id == ToWarehouse.id)\
+         .outerjoin(Receipt, (StockMove.move_type == 'receipt') & (Receipt.reference == StockMove.reference))\
+         .outerjoin(ReceiptWarehouse, Receipt.warehouse_id == ReceiptWarehouse.id)\
+         .outerjoin(Delivery, (StockMove.move_type == 'delivery') & (Delivery.reference == StockMove.reference))\
+         .outerjoin(DeliveryWarehouse, Delivery.warehouse_id == DeliveryWarehouse.id)\
+         .filter(*_move_filters(StockMove, *filters))
 
-        moves = query.limit(100).all()  # ← correct variable name
+        rows = query.order_by(StockMove.created_at.desc(), StockMove.id.desc()).limit(limit + 1).all()
+        archived = archive_conditions(date_from)
+        if len(rows) <= limit and archived is not None:
+            # Archived moves are all older than the live ones: the page continues into the archive
+            rows += _archived_move_rows(_move_filters(ArchivedStockMove, *filters) + archived, limit + 1 - len(rows))
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = f"{last[2].isoformat()}|{last[0]}"
 
         result = []
-        for move in moves:  # ← WAS "for m in moves" or "for l in locs" → bug!
-            from_loc = move.from_location.name if move.from_location else 'Vendor'
-            to_loc = move.to_location.name if move.to_location else 'Customer'
+        for (move_id, reference, created_at, quantity, mtype, state, from_name, to_name,
+             vendor, receipt_wh, delivery_address, delivery_wh) in rows[:limit]:
+            from_loc = from_name or 'Vendor'
+            to_loc = to_name or 'Customer'
             contact = ''
-
-            if move.move_type == 'receipt':
-                receipt = Receipt.query.filter_by(reference=move.reference).first()
-                if receipt:
-                    contact = receipt.vendor
-                    from_loc = 'Vendor'
-                    to_loc = receipt.warehouse.name
-            elif move.move_type == 'delivery':
-                delivery = Delivery.query.filter_by(reference=move.reference).first()
-                if delivery:
-                    contact = delivery.delivery_address
-                    from_loc = delivery.warehouse.name
-                    to_loc = 'Customer'
+            if vendor is not None:
+                contact = vendor
+                from_loc = 'Vendor'
+                to_loc = receipt_wh
+            elif delivery_address is not None:
+                contact = delivery_address
+                from_loc = delivery_wh
+                to_loc = 'Customer'
 
             result.append({
-                'id': move.id,
-                'reference': move.reference or 'SYSTEM',
-                'date': move.created_at.isoformat(),
+                'id': move_id,
+                'reference': reference or 'SYSTEM',
+                'date': created_at.isoformat(),
                 'contact': contact,
                 'from': from_loc,
                 'to': to_loc,
-                'quantity': float(move.quantity),
-                'move_type': move.move_type,
-                'status': move.state or 'done'
+                'quantity': float(quantity),
+                'move_type': mtype,
+                'status': state or 'done'
             })
 
-        return jsonify(result)
+        return paginated_response(result, next_cursor)
 
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        print("Stock moves error:", str(e))
+        current_app.logger.exception("Stock moves listing failed")
         return jsonify({'error': str(e)}), 500
 
+MOVE_FIELDS = ['id', 'reference', 'product_id', 'from_location_id', 'to_location_id', 'from_sublocation_id',
+               'to_sublocation_id', 'quantity', 'move_type', 'state', 'user_id', 'created_at']  # StockMove.to_dict()
+
 @api.route('/stock-moves/product/<int:product_id>', methods=['GET'])
 @jwt_required()
 def stock_moves_by_product(product_id):
+    """A product's moves, newest first, keyset-paginated like /stock-moves (?date_from=, ?after=, ?limit=,
+    ?fields=, ?format=rows)"""
     try:
-        moves = StockMove.query.filter_by(product_id=product_id).order_by(StockMove.created_at.desc()).all()
-        return jsonify([m.to_dict() for m in moves])
+        date_from = request.args.get('date_from')
+        date_from = datetime.fromisoformat(date_from) if date_from else None
+        limit = get_page_limit()
+        names = select_fields(dict.fromkeys(MOVE_FIELDS))
+        filters = (product_id, None, None, date_from, None, request.args.get('after'))
+
+        def page(model, conditions, size):
+            # created_at and id ride along (last) for the cursor, whatever ?fields= selects
+            return db.session.query(*[getattr(model, name) for name in names], model.created_at, model.id)\
+                .filter(*_move_filters(model, *filters), *conditions)\
+                .order_by(model.created_at.desc(), model.id.desc()).limit(size).all()
+
+        rows = page(StockMove, [], limit + 1)
+        archived = archive_conditions(date_from)
+        if len(rows) <= limit and archived is not None:
+            rows += page(ArchivedStockMove, archived, limit + 1 - len(rows))  # Older than every live move
+        next_cursor = None
+        if len(rows) > limit:
+            created_at, move_id = rows[limit - 1][-2:]
+            next_cursor = f"{created_at.isoformat()}|{move_id}"
+        return rows_response(names, [row[:-2] for row in rows[:limit]], next_cursor)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# 11. Dashboard — UPDATED: Late counts, to_receive/to_deliver (pending), total operations
+@api.route('/stock-moves/monthly', methods=['GET'])
+@jwt_required()
+def stock_moves_monthly():
+    """Monthly in/out totals (?product_id=, ?warehouse_id=), archived months included"""
+    try:
+        return jsonify(monthly_totals(request.args.get('product_id', type=int),
+                                      request.args.get('warehouse_id', type=int)))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 11. Dashboard — counters come from the maintained KPI row; only "late" depends on the clock
 @api.route('/dashboard/summary', methods=['GET'])
 @jwt_required()
 def dashboard_summary():
     try:
         now = datetime.utcnow()
-        total_products = Product.query.count()
-        total_stock_value = db.session.query(db.func.coalesce(db.func.sum(StockQuant.quantity * Product.cost), 0))\
-            .join(Product, StockQuant.product_id == Product.id).scalar() or 0.0
-        low_count = db.session.query(db.func.count(Product.id.distinct()))\
-            .join(StockQuant).filter(StockQuant.quantity < Product.reorder_min).scalar() or 0
-        out_count = Product.query.filter(
-            ~db.exists().where((StockQuant.product_id == Product.id) & (StockQuant.quantity > 0))
-        ).count()
-        
-        # Receipts: to_receive (draft+ready), late (scheduled < now and not done)
-        pending_receipts = Receipt.query.filter(Receipt.status.in_(['draft', 'ready'])).count()
+        kpi = DashboardKpi.query.get(1) or rebuild_kpis()
+        # Late counts change with time alone, so they are read from the partial open-status indexes
         late_receipts = Receipt.query.filter(
-            Receipt.status.in_(['draft', 'ready']),
+            open_status(Receipt),
             Receipt.scheduled_date < now,
             Receipt.scheduled_date.isnot(None)
         ).count()
-        total_receipt_ops = Receipt.query.count()
-        
-        # Deliveries: similar
-        pending_deliveries = Delivery.query.filter(Delivery.status.in_(['draft', 'ready'])).count()
         late_deliveries = Delivery.query.filter(
-            Delivery.status.in_(['draft', 'ready']),
+            open_status(Delivery),
             Delivery.scheduled_date < now,
             Delivery.scheduled_date.isnot(None)
         ).count()
-        total_delivery_ops = Delivery.query.count()
-        
-        pending_transfers = Transfer.query.filter(Transfer.status == 'draft').count()
         
         return jsonify({
-            'totalProducts': total_products,
-            'totalStockValue': round(float(total_stock_value), 2),
-            'lowStockCount': low_count,
-            'outOfStockCount': out_count,
+            'totalProducts': kpi.total_products,
+            'totalStockValue': round(float(kpi.total_stock_value or 0.0), 2),
+            'lowStockCount': kpi.low_stock_count,
+            'outOfStockCount': kpi.out_of_stock_count,
             # Receipts
-            'receiptsToReceive': pending_receipts,
+            'receiptsToReceive': kpi.receipts_pending,
             'lateReceipts': late_receipts,
-            'totalReceiptOperations': total_receipt_ops,
+            'totalReceiptOperations': kpi.receipts_total,
             # Deliveries
-            'deliveriesToDeliver': pending_deliveries,
+            'deliveriesToDeliver': kpi.deliveries_pending,
             'lateDeliveries': late_deliveries,
-            'totalDeliveryOperations': total_delivery_ops,
-            'pendingTransfers': pending_transfers
+            'totalDeliveryOperations': kpi.deliveries_total,
+            'pendingTransfers': kpi.transfers_pending
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@api.route('/dashboard/rebuild', methods=['POST'])
+@jwt_required()
+@require_manager_role
+def dashboard_rebuild():
+    """Recompute KPI counters and the reorder watchlist in the background (202)"""
+    try:
+        job = enqueue('rebuild_kpis', {}, get_jwt_identity())
+        db.session.commit()
+        return job_accepted(job)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+# 12. Background jobs — status and progress of work queued by the endpoints above
+@api.route('/jobs/<int:id>', methods=['GET'])
+@jwt_required()
+def job_detail(id):
+    try:
+        job = Job.query.get_or_404(id)
+        if job.user_id != int(get_jwt_identity()) and current_role() != 'manager':
+            return jsonify({'error': 'Not your job'}), 403
+        return jsonify(job.to_dict())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 13. Live events — SSE feed of the outbox (stock moves, status changes); replaces polling
+@api.route('/events/stream', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])  # EventSource cannot send headers: ?jwt=<token>
+def events_stream():
+    try:
+        return event_stream()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/events', methods=['GET'])
+@jwt_required()
+def events():
+    """Outbox events after ?after=<id> as JSON, for clients that cannot hold a stream open"""
+    try:
+        after = request.args.get('after', type=int) or 0
+        limit = get_page_limit()
+        rows = OutboxEvent.query.filter(OutboxEvent.id > after).order_by(OutboxEvent.id).limit(limit + 1).all()
+        next_cursor = rows[limit - 1].id if len(rows) > limit else None
+        return paginated_response([e.to_dict() for e in rows[:limit]], next_cursor)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 def init_routes(app):
     app.register_blueprint(api, url_prefix='/api')
\ No newline at end of file
@@ -0,0 +1,116 @@
+# search.py — FTS5 full-text index over product name, SKU and category name
+# product_fts is kept in sync by SQLite triggers, so every writer (routes, importers, populate_db,
+# raw SQL) updates it in the same transaction as the product or category row.
+import re
+from flask import current_app
+from models import db
+
+SUGGEST_LIMIT = 10
+SUGGEST_CANDIDATES = 200  # Best-ranked full-text matches re-ranked per suggestion request
+SUGGEST_WEIGHTS = (10.0, 5.0, 1.0)  # bm25 weights of the name, sku and category columns
+
+_SEARCH_DDL = [
+    # prefix='1 2 3': short typeahead prefixes are answered from the prefix index, not a term scan
+    "CREATE VIRTUAL TABLE product_fts USING fts5(name, sku, category, tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN
+         INSERT INTO product_fts(rowid, name, sku, category)
+         VALUES (new.id, new.name, new.sku, (SELECT name FROM category WHERE id = new.category_id));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE OF name, sku, category_id ON product BEGIN
+         DELETE FROM product_fts WHERE rowid = old.id;
+         INSERT INTO product_fts(rowid, name, sku, category)
+         VALUES (new.id, new.name, new.sku, (SELECT name FROM category WHERE id = new.category_id));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN
+         DELETE FROM product_fts WHERE rowid = old.id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_category_rename AFTER UPDATE OF name ON category BEGIN
+         UPDATE product_fts SET category = new.name WHERE rowid IN (SELECT id FROM product WHERE category_id = new.id);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_category_delete AFTER DELETE ON category BEGIN
+         UPDATE product_fts SET category = NULL WHERE rowid IN (SELECT id FROM product WHERE category_id = old.id);
+       END""",
+]
+
+def ensure_product_search():
+    """Create product_fts and its triggers if missing (filled from the current products).
+
+    Returns False when this SQLite build lacks FTS5; searches then fall back to ILIKE.
+    """
+    with db.engine.begin() as conn:
+        if conn.dialect.name != 'sqlite':
+            return False
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_fts'").first()
+        if not exists:
+            try:
+                conn.exec_driver_sql(_SEARCH_DDL[0])
+            except Exception:
+                return False  # No FTS5 in this SQLite build
+            conn.exec_driver_sql(
+                "INSERT INTO product_fts(rowid, name, sku, category) "
+                "SELECT product.id, product.name, product.sku, category.name FROM product "
+                "LEFT JOIN category ON category.id = product.category_id")
+        for ddl in _SEARCH_DDL[1:]:
+            conn.exec_driver_sql(ddl)
+    return True
+
+def drop_product_search():
+    """Drop product_fts and its triggers, e.g. before a bulk load (ensure_product_search refills it)"""
+    with db.engine.begin() as conn:
+        for trigger in ('insert', 'update', 'delete', 'category_rename', 'category_delete'):
+            conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS product_fts_{trigger}")
+        conn.exec_driver_sql("DROP TABLE IF EXISTS product_fts")
+
+def search_enabled():
+    return current_app.extensions.get('product_fts', False)
+
+def fts_query(text):
+    """FTS5 MATCH expression for user input: every word must match as a prefix ("desk ch" -> desk* AND ch*)"""
+    words = re.findall(r'\w+', text.lower())
+    return ' '.join(f'"{word}"*' for word in words) or None
+
+def matching_product_ids(text):
+    """Subquery of product ids matching text, for filtering (e.g. the /products list)"""
+    return db.select(db.literal_column('rowid')).select_from(db.text('product_fts'))\
+        .where(db.text('product_fts MATCH :fts_query').bindparams(fts_query=fts_query(text)))
+
+def _suggest_rank(row, words, typed):
+    """Sort key: SKU prefix hits first, then names matching every word (earliest, shortest first)"""
+    product_id, sku, name, category = row
+    name_words = re.findall(r'\w+', (name or '').lower())
+    sku_hit = (sku or '').lower().startswith(typed)
+    return (not sku_hit, sku if sku_hit else '',
+            sum(not any(word.startswith(w) for word in name_words) for w in words),  # Words matched only via SKU/category
+            not (name_words and name_words[0].startswith(words[0])),
+            len(name or ''), product_id)
+
+def _like_prefix(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def suggest_products(text, limit=SUGGEST_LIMIT):
+    """Best prefix matches: [(id, sku, name, category name)].
+
+    Exact and prefix SKU hits come from the case-insensitive SKU index; full-text matches are
+    ranked by column-weighted bm25 before SUGGEST_CANDIDATES of them are kept. Both sets are then
+    ordered by _suggest_rank.
+    """
+    match = fts_query(text)
+    if not match:
+        return []
+    typed = text.strip().lower()
+    sku_hits = db.session.execute(db.text(
+        "SELECT product.id, product.sku, product.name, category.name FROM product "
+        "LEFT JOIN category ON category.id = product.category_id "
+        "WHERE product.sku LIKE :prefix ESCAPE '\\' ORDER BY product.sku COLLATE NOCASE LIMIT :limit"),
+        {'prefix': _like_prefix(typed), 'limit': limit}).all()
+    candidates = db.session.execute(db.text(
+        "SELECT product.id, product.sku, product.name, candidates.category FROM ("
+        "  SELECT rowid, category FROM product_fts WHERE product_fts MATCH :match"
+        f"  ORDER BY bm25(product_fts, {', '.join(map(str, SUGGEST_WEIGHTS))}) LIMIT :candidates"
+        ") AS candidates JOIN product ON product.id = candidates.rowid"),
+        {'match': match, 'candidates': SUGGEST_CANDIDATES}).all()
+    seen = {row[0] for row in sku_hits}
+    rows = sku_hits + [row for row in candidates if row[0] not in seen]
+    words = re.findall(r'\w+', text.lower())
+    return sorted(rows, key=lambda row: _suggest_rank(row, words, typed))[:limit]
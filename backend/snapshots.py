@@ -0,0 +1,161 @@
+# snapshots.py — periodic stock snapshots and point-in-time (as_of) stock queries
+# "What was on hand on March 31?" = the nearest snapshot run plus a bounded replay of the moves
+# between that run and the requested time, instead of replaying the whole StockMove table.
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from models import db, SnapshotRun, StockSnapshot, StockQuant, StockMove, ArchivedStockMove
+from utils import chunked
+from archive import archive_bounds, archive_conditions
+
+def parse_as_of(value):
+    """Naive UTC datetime for ?as_of= — a bare date (2025-03-31) means the end of that day"""
+    value = value.strip()
+    if len(value) == 10:
+        return datetime.fromisoformat(value) + timedelta(days=1) - timedelta(microseconds=1)
+    as_of = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if as_of.tzinfo:
+        as_of = as_of.astimezone(timezone.utc).replace(tzinfo=None)
+    return as_of
+
+def snapshot_due(interval_hours):
+    last = db.session.query(db.func.max(SnapshotRun.taken_at)).scalar()
+    return last is None or last <= datetime.utcnow() - timedelta(hours=interval_hours)
+
+def _changed_pairs(after_move_id, up_to_move_id):
+    """(product_id, warehouse_id) pairs touched by moves in the id range, as a subquery"""
+    window = db.and_(StockMove.id > after_move_id, StockMove.id <= up_to_move_id)
+    outgoing = db.select(StockMove.product_id, StockMove.from_location_id.label('warehouse_id'))\
+        .where(window, StockMove.from_location_id.isnot(None))
+    incoming = db.select(StockMove.product_id, StockMove.to_location_id.label('warehouse_id'))\
+        .where(window, StockMove.to_location_id.isnot(None))
+    return db.union(outgoing, incoming).subquery()
+
+def take_snapshot(full=None):
+    """Record a snapshot run of the current quants — the caller commits.
+
+    The first run, every SNAPSHOT_FULL_EVERY-th run, or full=True copies every quant; other
+    runs only store pairs touched by moves since the previous run. Everything happens in one
+    INSERT ... SELECT, in the transaction that inserted the run row (on SQLite that INSERT
+    takes the write lock, so the quants and the last move id are read consistently).
+    """
+    previous = SnapshotRun.query.order_by(SnapshotRun.id.desc()).first()
+    if full is None:
+        last_full_id = db.session.query(db.func.max(SnapshotRun.id)).filter(SnapshotRun.is_full.is_(True)).scalar()
+        runs_since_full = SnapshotRun.query.filter(SnapshotRun.id > last_full_id).count() if last_full_id else 0
+        full = last_full_id is None or runs_since_full + 1 >= current_app.config.get('SNAPSHOT_FULL_EVERY', 7)
+        # Moves archived since the previous run are gone from stock_move: the changed pairs are unknown
+        full = full or archive_bounds()[1] > previous.last_move_id
+    run = SnapshotRun(taken_at=datetime.utcnow(), is_full=full, last_move_id=0)
+    db.session.add(run)
+    db.session.flush()
+    # Move ids only grow (AUTOINCREMENT, never reused after archiving): every move after this run
+    # has a higher id, even when the archive has just emptied stock_move
+    run.last_move_id = max(db.session.query(db.func.coalesce(db.func.max(StockMove.id), 0)).scalar(),
+                           archive_bounds()[1])
+
+    rows = db.select(db.literal(run.id), StockQuant.product_id, StockQuant.warehouse_id, StockQuant.quantity)
+    if not full:
+        changed = _changed_pairs(previous.last_move_id, run.last_move_id)
+        rows = rows.join(changed, db.and_(changed.c.product_id == StockQuant.product_id,
+                                          changed.c.warehouse_id == StockQuant.warehouse_id))
+    result = db.session.execute(StockSnapshot.__table__.insert().from_select(
+        ['run_id', 'product_id', 'warehouse_id', 'quantity'], rows))
+    run.row_count = result.rowcount
+    return run
+
+def _id_chunks(ids):
+    return chunked(ids) if ids is not None else [None]
+
+def _snapshot_quantities(run, product_ids, warehouse_id):
+    """Quantities at `run`: newest snapshot row per pair between the last full run and `run`"""
+    base_id = db.session.query(db.func.max(SnapshotRun.id))\
+        .filter(SnapshotRun.is_full.is_(True), SnapshotRun.id <= run.id).scalar() or 0
+    quantities = {}
+    for ids in _id_chunks(product_ids):
+        latest = db.session.query(StockSnapshot.product_id, StockSnapshot.warehouse_id,
+                                  db.func.max(StockSnapshot.run_id).label('run_id'))\
+            .filter(StockSnapshot.run_id.between(base_id, run.id))
+        if ids is not None:
+            latest = latest.filter(StockSnapshot.product_id.in_(ids))
+        if warehouse_id:
+            latest = latest.filter(StockSnapshot.warehouse_id == warehouse_id)
+        latest = latest.group_by(StockSnapshot.product_id, StockSnapshot.warehouse_id).subquery()
+        rows = db.session.query(StockSnapshot.product_id, StockSnapshot.warehouse_id, StockSnapshot.quantity)\
+            .join(latest, db.and_(latest.c.product_id == StockSnapshot.product_id,
+                                  latest.c.warehouse_id == StockSnapshot.warehouse_id,
+                                  latest.c.run_id == StockSnapshot.run_id))
+        for product_id, warehouse_id_, quantity in rows:
+            quantities[(product_id, warehouse_id_)] = quantity or 0.0
+    return quantities
+
+def _current_quantities(product_ids, warehouse_id):
+    quantities = {}
+    for ids in _id_chunks(product_ids):
+        query = db.session.query(StockQuant.product_id, StockQuant.warehouse_id, StockQuant.quantity)
+        if ids is not None:
+            query = query.filter(StockQuant.product_id.in_(ids))
+        if warehouse_id:
+            query = query.filter(StockQuant.warehouse_id == warehouse_id)
+        for product_id, warehouse_id_, quantity in query:
+            quantities[(product_id, warehouse_id_)] = quantity or 0.0
+    return quantities
+
+def _move_window(model, after_id=None, up_to_id=None, after=None, up_to=None):
+    conditions = []
+    if after_id is not None:
+        conditions.append(model.id > after_id)
+    if up_to_id is not None:
+        conditions.append(model.id <= up_to_id)
+    if after is not None:
+        conditions.append(model.created_at > after)
+    if up_to is not None:
+        conditions.append(model.created_at <= up_to)
+    return conditions
+
+def _apply_moves(quantities, window, sign, product_ids, warehouse_id, since):
+    """Add (sign=1) or undo (sign=-1) the net effect of the moves in window; moves archived
+    before the window's start (`since`) are read from the archive database as well."""
+    sources = [(StockMove, [])]
+    archived = archive_conditions(since)
+    if archived is not None:
+        sources.append((ArchivedStockMove, archived))
+    for model, extra in sources:
+        conditions = _move_window(model, **window) + extra
+        for column, direction in ((model.to_location_id, 1), (model.from_location_id, -1)):
+            for ids in _id_chunks(product_ids):
+                query = db.session.query(model.product_id, column, db.func.sum(model.quantity))\
+                    .filter(*conditions).filter(column.isnot(None))
+                if ids is not None:
+                    query = query.filter(model.product_id.in_(ids))
+                if warehouse_id:
+                    query = query.filter(column == warehouse_id)
+                for product_id, warehouse_id_, quantity in query.group_by(model.product_id, column):
+                    key = (product_id, warehouse_id_)
+                    quantities[key] = quantities.get(key, 0.0) + sign * direction * (quantity or 0.0)
+
+def stock_as_of(as_of, product_ids=None, warehouse_id=None):
+    """{(product_id, warehouse_id): quantity} at as_of, optionally limited to products / a warehouse.
+
+    Starts from the latest snapshot run at or before as_of and replays forward the moves between
+    the run and as_of (bounded by the next run's move id). Before the first run, it starts from
+    the first run after as_of (or the live quants) and undoes the moves made since as_of.
+    """
+    product_ids = list(product_ids) if product_ids is not None else None
+    run = SnapshotRun.query.filter(SnapshotRun.taken_at <= as_of).order_by(SnapshotRun.id.desc()).first()
+    if run:
+        quantities = _snapshot_quantities(run, product_ids, warehouse_id)
+        window = {'after_id': run.last_move_id, 'up_to': as_of}
+        next_run = SnapshotRun.query.filter(SnapshotRun.id > run.id).order_by(SnapshotRun.id).first()
+        if next_run:
+            window['up_to_id'] = next_run.last_move_id
+        _apply_moves(quantities, window, 1, product_ids, warehouse_id, since=run.taken_at)
+    else:
+        later = SnapshotRun.query.order_by(SnapshotRun.id).first()
+        if later:
+            quantities = _snapshot_quantities(later, product_ids, warehouse_id)
+            window = {'up_to_id': later.last_move_id, 'after': as_of}
+        else:
+            quantities = _current_quantities(product_ids, warehouse_id)
+            window = {'after': as_of}
+        _apply_moves(quantities, window, -1, product_ids, warehouse_id, since=as_of)
+    return quantities
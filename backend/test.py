@@ -1,7 +1,24 @@
 # test.py — FINAL FIXED & BULLETPROOF (100% PASS GUARANTEED)
 import requests
 import time
-from datetime import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import weakref
+from datetime import date, datetime, timedelta
+from sqlalchemy import text, event
+from app import create_app
+from models import db, StockQuant, StockMove, ArchivedStockMove
+from migrations import upgrade_schema
+from jobs import run_worker, claim_next_job, report_progress, requeue_stale_jobs, worker_config, JOB_HANDLERS
+from utils import rebuild_kpis
+from snapshots import take_snapshot
+from archive import archive_moves
+from events import prune_events
+from otp import MemoryOtpStore
+from populate_db import populate
 
 BASE_URL = "http://localhost:5000/api"
 
@@ -21,6 +38,25 @@ def print_status(name, success):
 def auth_headers(token):
     return {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
 
+def check(name, success):
+    """print_status, then fail the test if the check failed"""
+    print_status(name, success)
+    assert success, name
+
+def manager_headers(client):
+    """Register and log in the manager m@test.com; returns its auth headers"""
+    client.post("/api/auth/register", json={"email": "m@test.com", "password": "m", "role": "manager"})
+    token = client.post("/api/auth/login", json={"email": "m@test.com", "password": "m"}).json["access_token"]
+    return auth_headers(token)
+
+def temp_app(name, **config):
+    """(app, client, manager headers) on a fresh database in a temp directory, removed along with the app"""
+    tmp = tempfile.mkdtemp()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(tmp, name + '.db')}", **config})
+    weakref.finalize(app, shutil.rmtree, tmp, ignore_errors=True)
+    client = app.test_client()
+    return app, client, manager_headers(client)
+
 print("\n" + "="*80)
 print(" STOCKMASTER — FULL API TEST SUITE (FIXED) ".center(80, "="))
 print("="*80 + "\n")
@@ -172,10 +208,932 @@ def test_04_flows():
         if p.get("sku", "").startswith("T"):
             print(f"     {p['name']:20} → On Hand: {p['on_hand']}")
 
+# ===================================================================
+# 5. QUERY PLANS (in-process, temp database — no server needed)
+# ===================================================================
+HOT_QUERIES = {
+    "StockQuant by product+warehouse": "SELECT * FROM stock_quant WHERE product_id = 1 AND warehouse_id = 1",
+    "StockMove by product, newest first": "SELECT * FROM stock_move WHERE product_id = 1 ORDER BY created_at DESC",
+    "Late open receipts": "SELECT COUNT(*) FROM receipt WHERE status IN ('draft', 'ready') AND scheduled_date < '2025-01-01'",
+    "Deliveries by status+date": "SELECT * FROM delivery WHERE status = 'done' AND scheduled_date > '2025-01-01'",
+    "Receipt lines by receipt": "SELECT * FROM receipt_line WHERE receipt_id = 1",
+    "Delivery lines by delivery": "SELECT * FROM delivery_line WHERE delivery_id = 1",
+}
+
+def query_plan(sql):
+    return " ".join(row[-1] for row in db.session.execute(text("EXPLAIN QUERY PLAN " + sql)))
+
+def test_05_query_plans():
+    print("\n5. QUERY PLANS (before/after index migration)")
+    app, _, _ = temp_app("plans")
+    with app.app_context():
+        # Simulate a database created before the index pack: drop every declared index
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                db.session.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        db.session.commit()
+        before = {name: query_plan(sql) for name, sql in HOT_QUERIES.items()}
+        db.session.commit()  # End the read transaction so the new schema is visible
+        created = upgrade_schema()
+        after = {name: query_plan(sql) for name, sql in HOT_QUERIES.items()}
+        check("Migration created indexes", "uq_stock_quant_product_warehouse" in created)
+        for name in HOT_QUERIES:
+            check(f"{name}: scan -> index", "SCAN" in before[name] and "USING" in after[name] and "INDEX" in after[name])
+        check("Migration is idempotent", upgrade_schema() == [])
+
+# ===================================================================
+# 6. CONCURRENCY (in-process, temp database, 16 threads at once)
+# ===================================================================
+THREADS = 16
+
+def run_concurrently(app, headers, urls, json=None):
+    """POST every url (with json as body) from its own thread, all released at the same moment; returns status codes"""
+    barrier = threading.Barrier(len(urls))
+    results = [None] * len(urls)
+    def worker(i, url):
+        client = app.test_client()
+        barrier.wait()
+        results[i] = client.post(url, headers=headers, json=json).status_code
+    threads = [threading.Thread(target=worker, args=(i, url)) for i, url in enumerate(urls)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def test_06_concurrent_validations():
+    print("\n6. CONCURRENT VALIDATIONS (16 threads)")
+    app, client, h = temp_app("stress")
+    wh = client.post("/api/warehouses", json={"name": "Stress", "short_code": "ST"}, headers=h).json["id"]
+    wh2 = client.post("/api/warehouses", json={"name": "Stress 2", "short_code": "ST2"}, headers=h).json["id"]
+    products = [client.post("/api/products", json={"name": f"Stress {i}", "sku": f"STRESS-{i}", "cost": 1,
+                                                   "initial_stock": {str(wh): 1000}}, headers=h).json["id"]
+                for i in range(2)]
+
+    # 16 deliveries of the same products validated at once: every one must land
+    deliveries = []
+    for _ in range(THREADS):
+        d = client.post("/api/deliveries", json={"delivery_address": "x", "warehouse_id": wh, "lines": [
+            {"product_id": pid, "demand_qty": 7, "done_qty": 7} for pid in products]}, headers=h).json["id"]
+        client.post(f"/api/deliveries/{d}/mark-ready", headers=h)
+        deliveries.append(d)
+    codes = run_concurrently(app, h, [f"/api/deliveries/{d}/validate" for d in deliveries])
+    with app.app_context():
+        on_hand = [StockQuant.query.filter_by(product_id=pid, warehouse_id=wh).one().quantity for pid in products]
+        reserved = [StockQuant.query.filter_by(product_id=pid, warehouse_id=wh).one().reserved_qty for pid in products]
+        moves = StockMove.query.filter_by(move_type="delivery").count()
+    check("All 16 validations succeeded", codes == [200] * THREADS)
+    check("No lost updates", on_hand == [1000 - 7 * THREADS] * len(products))
+    check("Reservations released", reserved == [0] * len(products))
+    check("One move per line", moves == THREADS * len(products))
+
+    # Same delivery validated 16 times at once: exactly one wins
+    d = client.post("/api/deliveries", json={"delivery_address": "x", "warehouse_id": wh, "lines": [
+        {"product_id": products[0], "demand_qty": 5, "done_qty": 5}]}, headers=h).json["id"]
+    client.post(f"/api/deliveries/{d}/mark-ready", headers=h)
+    codes = run_concurrently(app, h, [f"/api/deliveries/{d}/validate"] * THREADS)
+    with app.app_context():
+        qty = StockQuant.query.filter_by(product_id=products[0], warehouse_id=wh).one().quantity
+    # Losers see either the committed status (400) or lose the guarded transition (409)
+    check("Double validation blocked", codes.count(200) == 1 and set(codes) <= {200, 400, 409}
+          and qty == 1000 - 7 * THREADS - 5)
+
+    # Oversubscribed transfers: stock never goes negative, nothing is created from thin air
+    available = 1000 - 7 * THREADS
+    per_transfer = available // 10
+    transfers = [client.post("/api/transfers", json={"from_warehouse_id": wh, "to_warehouse_id": wh2, "lines": [
+        {"product_id": products[1], "quantity": per_transfer}]}, headers=h).json["id"] for _ in range(THREADS)]
+    codes = run_concurrently(app, h, [f"/api/transfers/{t}/validate" for t in transfers])
+    with app.app_context():
+        src = StockQuant.query.filter_by(product_id=products[1], warehouse_id=wh).one().quantity
+        dst = StockQuant.query.filter_by(product_id=products[1], warehouse_id=wh2).one().quantity
+    check("Oversubscribed transfers: 10 succeed", codes.count(200) == 10 and codes.count(400) == THREADS - 10)
+    check("Stock conserved and non-negative", src >= 0 and src + dst == available and dst == 10 * per_transfer)
+
+# ===================================================================
+# 7. BACKGROUND JOBS (in-process worker drains the queue)
+# ===================================================================
+def test_07_background_jobs():
+    print("\n7. BACKGROUND JOBS")
+    app, client, h = temp_app("jobs", ASYNC_LINE_THRESHOLD=2)
+    wh = client.post("/api/warehouses", json={"name": "Jobs", "short_code": "JB"}, headers=h).json["id"]
+    pid = client.post("/api/products", json={"name": "Job item", "sku": "JOB-1"}, headers=h).json["id"]
+
+    r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+        {"product_id": pid, "demand_qty": 4, "done_qty": 4}] * 3}, headers=h).json["id"]
+    accepted = client.post(f"/api/receipts/{r}/validate", headers=h)
+    check("Large receipt answered 202 with a job", accepted.status_code == 202 and "job_id" in accepted.json)
+    csv = "sku,name,warehouse_id,initial_qty\n" + "".join(f"JOB-{i},Item {i},{wh},1\n" for i in range(2, 12))
+    imported = client.post("/api/products/import?async=1", data=csv.encode(), headers={**h, "Content-Type": "text/csv"})
+    check("Async import answered 202", imported.status_code == 202)
+    check("Job queued until a worker runs", client.get(accepted.headers["Location"], headers=h).json["status"] == "queued")
+
+    with app.app_context():
+        ran = run_worker(once=True)
+    validate_job = client.get(f"/api/jobs/{accepted.json['job_id']}", headers=h).json
+    import_job = client.get(f"/api/jobs/{imported.json['job_id']}", headers=h).json
+    on_hand = client.get(f"/api/products/{pid}", headers=h).json["on_hand"]
+    check("Worker ran both jobs", ran == 2)
+    check("Validation job done, stock updated", validate_job["status"] == "done" and on_hand == 12)
+    check("Import job reports its result", import_job["status"] == "done" and import_job["result"]["imported"] == 10)
+
+    # A long validation keeps its heartbeat fresh, so another worker does not re-queue it mid-run
+    r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+        {"product_id": pid, "demand_qty": 1, "done_qty": 1}] * 3}, headers=h).json["id"]
+    accepted = client.post(f"/api/receipts/{r}/validate", headers=h)
+    with app.app_context():
+        job = claim_next_job("slow-worker")
+        job_id, user_id = job.id, job.user_id
+        db.session.execute(text("UPDATE job SET heartbeat_at = '2000-01-01 00:00:00' WHERE id = :id"), {"id": job_id})
+        db.session.commit()
+        JOB_HANDLERS["validate_receipt"]({"id": r}, user_id, lambda done, total=None: report_progress(job_id, done, total))
+        requeue_stale_jobs(stale_after=60)
+    check("Validation heartbeat keeps its job running", client.get(accepted.headers["Location"], headers=h).json["status"] == "running")
+
+    # Worker processes are built from the starting app's settings, not create_app() defaults
+    archive_dir = tempfile.mkdtemp()
+    settings = {"JOB_STALE_AFTER": 5, "SNAPSHOT_FULL_EVERY": 2, "ASYNC_LINE_THRESHOLD": 3, "REFERENCE_BLOCK_SIZE": 10,
+                "PER_WAREHOUSE_REFERENCES": True, "SQLITE_BUSY_TIMEOUT_MS": 1000,
+                "ARCHIVE_DATABASE_URI": f"sqlite:///{os.path.join(archive_dir, 'archive.db')}"}
+    configured, _, _ = temp_app("jobs-config", **settings)
+    weakref.finalize(configured, shutil.rmtree, archive_dir, ignore_errors=True)
+    worker_app = create_app(worker_config(configured.config))
+    check("Worker app gets the parent's settings", all(worker_app.config[key] == value for key, value in settings.items())
+          and worker_app.config["SQLALCHEMY_DATABASE_URI"] == configured.config["SQLALCHEMY_DATABASE_URI"]
+          and worker_app.config["SQLALCHEMY_BINDS"] == configured.config["SQLALCHEMY_BINDS"])
+
+# ===================================================================
+# 8. EVENT OUTBOX / SSE REPLAY
+# ===================================================================
+def test_08_event_stream():
+    print("\n8. EVENT OUTBOX & SSE")
+    app, client, h = temp_app("events", EVENT_POLL_INTERVAL=0.05, EVENT_STREAM_MAX_SECONDS=0.3)
+    wh = client.post("/api/warehouses", json={"name": "Events", "short_code": "EV"}, headers=h).json["id"]
+    pid = client.post("/api/products", json={"name": "Event item", "sku": "EV-1"}, headers=h).json["id"]
+    r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+        {"product_id": pid, "demand_qty": 2, "done_qty": 2}]}, headers=h).json["id"]
+    seen = client.get("/api/events", headers=h).json[-1]["id"]
+    client.post(f"/api/receipts/{r}/validate", headers=h)
+
+    events = client.get(f"/api/events?after={seen}", headers=h).json
+    check("Validation wrote status + stock events", [e["topic"] for e in events] == ["receipt.status", "stock.moved"])
+    token = h["Authorization"].split()[1]
+    body = client.get(f"/api/events/stream?jwt={token}", headers={"Last-Event-ID": str(seen)}).get_data(as_text=True)
+    replayed = [int(line[4:]) for line in body.splitlines() if line.startswith("id: ")]
+    check("Reconnect replays only missed events", replayed == [e["id"] for e in events])
+
+    # Pruning every event must not restart the ids a reconnecting client compares against
+    with app.app_context():
+        prune_events(retention_days=-1)
+    r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+        {"product_id": pid, "demand_qty": 1, "done_qty": 1}]}, headers=h).json["id"]
+    client.post(f"/api/receipts/{r}/validate", headers=h)
+    last_seen = events[-1]["id"]
+    body = client.get(f"/api/events/stream?jwt={token}", headers={"Last-Event-ID": str(last_seen)}).get_data(as_text=True)
+    replayed = [int(line[4:]) for line in body.splitlines() if line.startswith("id: ")]
+    check("Reconnect after pruning gets the new events", len(replayed) == 3 and min(replayed) > last_seen)
+    body = client.get(f"/api/events/stream?jwt={token}", headers={"Last-Event-ID": str(max(replayed) + 100)}).get_data(as_text=True)
+    check("Unknown Last-Event-ID gets a reset", f"id: {max(replayed)}\nevent: reset" in body)
+
+# ===================================================================
+# 9. POINT-IN-TIME STOCK (SNAPSHOTS + REPLAY)
+# ===================================================================
+def test_09_stock_as_of():
+    print("\n9. POINT-IN-TIME STOCK")
+    app, client, h = temp_app("snapshots")
+    wh = client.post("/api/warehouses", json={"name": "History", "short_code": "HS"}, headers=h).json["id"]
+    pid, other = [client.post("/api/products", json={"name": f"History {i}", "sku": f"HS-{i}"}, headers=h).json["id"]
+                  for i in (1, 2)]
+
+    def receive(product_id, qty):
+        r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+            {"product_id": product_id, "demand_qty": qty, "done_qty": qty}]}, headers=h).json["id"]
+        client.post(f"/api/receipts/{r}/validate", headers=h)
+        time.sleep(0.01)
+        return datetime.utcnow().isoformat()
+
+    before = datetime.utcnow().isoformat()
+    time.sleep(0.01)
+    after_first = receive(pid, 10)
+    receive(other, 7)
+    with app.app_context():
+        full = take_snapshot().to_dict()
+        db.session.commit()
+    after_second = receive(pid, 5)
+    with app.app_context():
+        incremental = take_snapshot().to_dict()
+        db.session.commit()
+    after_third = receive(pid, 3)
+
+    history = [client.get(f"/api/products/{pid}?as_of={t}", headers=h).json["on_hand"]
+               for t in (before, after_first, after_second, after_third)]
+    check("First run full, next run only stores moved pairs", full["is_full"] and not incremental["is_full"]
+          and full["row_count"] == 2 and incremental["row_count"] == 1)
+    check("on_hand as_of before/between/after snapshots", history == [0, 10, 15, 18])
+    quants = client.get(f"/api/stock-quants?as_of={after_second}&warehouse_id={wh}", headers=h).json
+    check("Stock quants as_of", {q["product_id"]: q["quantity"] for q in quants} == {pid: 15, other: 7})
+    check("Bad as_of rejected", client.get(f"/api/stock-quants?as_of=yesterday", headers=h).status_code == 400)
+
+# ===================================================================
+# 10. MOVE ARCHIVE & MONTHLY ROLLUPS
+# ===================================================================
+def test_10_move_archive():
+    print("\n10. MOVE ARCHIVE")
+    app, client, h = temp_app("archive")
+    wh = client.post("/api/warehouses", json={"name": "Archive", "short_code": "AR"}, headers=h).json["id"]
+    pid = client.post("/api/products", json={"name": "Archived item", "sku": "AR-1"}, headers=h).json["id"]
+    for qty in (10, 5):
+        r = client.post("/api/receipts", json={"vendor": "Old vendor", "warehouse_id": wh, "lines": [
+            {"product_id": pid, "demand_qty": qty, "done_qty": qty}]}, headers=h).json["id"]
+        client.post(f"/api/receipts/{r}/validate", headers=h)
+    with app.app_context():
+        first, second = [m.id for m in StockMove.query.order_by(StockMove.id)]
+        db.session.execute(text("UPDATE stock_move SET created_at = '2024-01-10 12:00:00.000000' WHERE id = :id"), {"id": first})
+        db.session.execute(text("UPDATE stock_move SET created_at = '2024-02-10 12:00:00.000000' WHERE id = :id"), {"id": second})
+        db.session.commit()
+        archived = archive_moves(datetime(2024, 2, 15)).move_count
+        live = StockMove.query.count()
+    check("Moves before the month cutoff archived", archived == 1 and live == 1)
+
+    recent = client.get(f"/api/stock-moves?product_id={pid}", headers=h).json
+    page1 = client.get(f"/api/stock-moves?product_id={pid}&date_from=2024-01-01&limit=1", headers=h)
+    page2 = client.get(f"/api/stock-moves?product_id={pid}&date_from=2024-01-01&limit=1&after={page1.headers['X-Next-Cursor']}", headers=h).json
+    check("Recent history stays live-only", [m["id"] for m in recent] == [second])
+    check("Old dates page into the archive", [m["id"] for m in page1.json + page2] == [second, first]
+          and page2[0]["contact"] == "Old vendor")
+    by_product = client.get(f"/api/stock-moves/product/{pid}?date_from=2024-01-01", headers=h).json
+    check("Product history includes archived moves", [m["id"] for m in by_product] == [second, first])
+    history = [client.get(f"/api/products/{pid}?as_of={t}", headers=h).json["on_hand"]
+               for t in ("2024-01-05", "2024-01-31", "2024-02-29")]
+    check("as_of across the archive cutoff", history == [0, 10, 15])
+    monthly = client.get(f"/api/stock-moves/monthly?product_id={pid}", headers=h).json
+    check("Monthly totals from rollups + live moves",
+          [(m["month"], m["qty_in"]) for m in monthly] == [("2024-01", 10), ("2024-02", 5)])
+
+# ===================================================================
+# 11. FIELD PROJECTION / COMPACT ROWS
+# ===================================================================
+def test_11_field_projection():
+    print("\n11. FIELD PROJECTION")
+    app, client, h = temp_app("fields")
+    wh = client.post("/api/warehouses", json={"name": "Fields", "short_code": "FD"}, headers=h).json["id"]
+    pid = client.post("/api/products", json={"name": "Field item", "sku": "FD-1", "initial_stock": {str(wh): 4}},
+                      headers=h).json["id"]
+    with app.app_context():
+        expected = [q.to_dict() for q in StockQuant.query.order_by(StockQuant.id)]
+    full = client.get("/api/stock-quants", headers=h).json
+    projected = client.get("/api/stock-quants?fields=product_id,quantity", headers=h).json
+    compact = client.get(f"/api/stock-moves/product/{pid}?fields=id,quantity&format=rows", headers=h).json
+    check("Default output unchanged", full == expected)
+    check("fields= returns only those keys", projected == [{"product_id": pid, "quantity": 4.0}])
+    check("format=rows sends field names once", compact["fields"] == ["id", "quantity"] and compact["rows"][0][1] == 4.0)
+    check("Unknown field rejected", client.get("/api/stock-quants?fields=nope", headers=h).status_code == 400)
+
+    # Both lists are keyset-paginated, also with a projection that leaves out the cursor columns
+    for i in range(2, 6):
+        client.post("/api/products", json={"name": f"Field item {i}", "sku": f"FD-{i}", "initial_stock": {str(wh): i}}, headers=h)
+    r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+        {"product_id": pid, "demand_qty": 1, "done_qty": 1}] * 4}, headers=h).json["id"]
+    client.post(f"/api/receipts/{r}/validate", headers=h)
+
+    def all_pages(url):
+        pages, cursor = [], None
+        while True:
+            response = client.get(url + (f"&after={cursor}" if cursor else ""), headers=h)
+            pages.append(response.json)
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                return pages
+    quant_pages = all_pages("/api/stock-quants?limit=2&fields=product_id,quantity")
+    move_pages = all_pages(f"/api/stock-moves/product/{pid}?limit=2&fields=quantity,reference")
+    with app.app_context():
+        moves = [(m.quantity, m.reference) for m in StockMove.query.filter_by(product_id=pid)
+                 .order_by(StockMove.created_at.desc(), StockMove.id.desc())]
+    check("Stock quants come in pages", [len(page) for page in quant_pages] == [2, 2, 1]
+          and [q["quantity"] for page in quant_pages for q in page] == [8, 2, 3, 4, 5])
+    check("Product moves come in pages, newest first", [len(page) for page in move_pages] == [2, 2, 1]
+          and [(m["quantity"], m["reference"]) for page in move_pages for m in page] == moves)
+    check("Invalid quant cursor rejected", client.get("/api/stock-quants?after=x", headers=h).status_code == 400)
+
+# ===================================================================
+# 12. DOCUMENT LISTS (EAGER LINES, SUMMARY VIEW, PAGINATION)
+# ===================================================================
+def test_12_document_lists():
+    print("\n12. DOCUMENT LISTS")
+    app, client, h = temp_app("lists")
+    wh = client.post("/api/warehouses", json={"name": "Lists", "short_code": "LS"}, headers=h).json["id"]
+    pid = client.post("/api/products", json={"name": "List item", "sku": "LS-1"}, headers=h).json["id"]
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(1))
+
+    def receipts_queries(count):
+        while len(client.get("/api/receipts?view=summary&limit=1000", headers=h).json) < count:
+            client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+                {"product_id": pid, "demand_qty": 2, "done_qty": 1}] * 3}, headers=h)
+        statements.clear()
+        receipts = client.get("/api/receipts", headers=h).json
+        return len(statements), receipts
+
+    few, _ = receipts_queries(2)
+    many, receipts = receipts_queries(20)
+    check("Receipt list query count independent of size", few == many and len(receipts[0]["lines"]) == 3)
+    summary = client.get("/api/receipts?view=summary", headers=h).json[0]
+    check("Summary view: counts and totals, no lines", "lines" not in summary and summary["line_count"] == 3
+          and summary["total_demand_qty"] == 6 and summary["total_done_qty"] == 3)
+    first = client.get("/api/receipts?limit=15", headers=h)
+    rest = client.get(f"/api/receipts?limit=15&after={first.headers['X-Next-Cursor']}", headers=h).json
+    ids = [r["id"] for r in first.json + rest]
+    check("Keyset pages cover every receipt once", len(ids) == 20 and len(set(ids)) == 20)
+
+# ===================================================================
+# 13. FULL-TEXT PRODUCT SEARCH / SUGGEST
+# ===================================================================
+def test_13_product_search():
+    print("\n13. PRODUCT SEARCH")
+    app, client, h = temp_app("search")
+    cat = client.post("/api/categories", json={"name": "Furniture"}, headers=h).json["id"]
+    desk = client.post("/api/products", json={"name": "Standing Desk", "sku": "DSK-100", "category_id": cat}, headers=h).json["id"]
+    chair = client.post("/api/products", json={"name": "Desk Chair", "sku": "CHR-200"}, headers=h).json["id"]
+    client.post("/api/products", json={"name": "Lamp", "sku": "LMP-300"}, headers=h)
+
+    def suggest(q):
+        return [p["id"] for p in client.get(f"/api/products/suggest?q={q}", headers=h).json]
+    check("Prefix match on name words", sorted(suggest("des")) == sorted([desk, chair]))
+    check("SKU prefix ranks first", suggest("dsk")[:1] == [desk] and suggest("CHR-2") == [chair])
+    check("Category name is searchable", suggest("furn") == [desk])
+    client.put(f"/api/products/{chair}", json={"name": "Office Chair"}, headers=h)
+    check("Index follows product updates", suggest("desk ch") == [] and suggest("office") == [chair])
+    listed = [p["id"] for p in client.get("/api/products?q=stand", headers=h).json]
+    check("/products?q= uses the index", listed == [desk])
+    punctuation = client.get("/api/products?q=-", headers=h)
+    check("Query without words gives an empty page", punctuation.status_code == 200 and punctuation.json == [])
+
+    with app.app_context():  # Many weaker matches ahead of the exact SKU in rowid order
+        db.session.execute(text("INSERT INTO product (name, sku) VALUES (:name, :sku)"),
+                           [{"name": f"Desk lamp model {i}", "sku": f"DL-{i}"} for i in range(1000, 2000)])
+        db.session.commit()
+    exact = client.post("/api/products", json={"name": "Desk", "sku": "DESK"}, headers=h).json["id"]
+    check("Exact SKU found among many matches", suggest("DESK")[:1] == [exact] and suggest("desk")[:1] == [exact])
+
+# ===================================================================
+# 14. JWT CLAIMS & TOKEN REVOCATION
+# ===================================================================
+def test_14_jwt_claims():
+    print("\n14. JWT CLAIMS")
+    app, client, mh = temp_app("claims")
+    client.post("/api/auth/register", json={"email": "s@test.com", "password": "pw", "role": "staff"})
+    login = lambda: client.post("/api/auth/login", json={"email": "s@test.com", "password": "pw"}).json
+    staff = login()
+    sh = auth_headers(staff["access_token"])
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", lambda conn, cursor, sql, *args: statements.append(sql))
+    client.get("/api/auth/me", headers=mh)  # Warms the token-version cache
+    statements.clear()
+    me = client.get("/api/auth/me", headers=mh).json
+    rebuilt = client.post("/api/dashboard/rebuild", headers=mh).status_code  # 202: queued as a job
+    user_reads = [sql for sql in statements if 'FROM "user"' in sql or "FROM user" in sql]
+    check("Role and identity come from the token", me["role"] == "manager" and rebuilt == 202 and not user_reads)
+    check("Staff denied manager endpoint", client.post("/api/dashboard/rebuild", headers=sh).status_code == 403)
+    client.put(f"/api/users/{staff['user']['id']}/role", json={"role": "manager"}, headers=mh)
+    revoked = client.get("/api/auth/me", headers=sh).status_code
+    promoted = auth_headers(login()["access_token"])
+    check("Role change revokes old tokens", revoked == 401)
+    check("New token carries the new role", client.post("/api/dashboard/rebuild", headers=promoted).status_code == 202)
+
+def test_15_otp_store():
+    print("\n15. SHARED OTP STORE")
+    app, client, _ = temp_app("otp", OTP_REQUEST_LIMIT=2)
+    other_worker = create_app({"SQLALCHEMY_DATABASE_URI": app.config["SQLALCHEMY_DATABASE_URI"],
+                               "OTP_REQUEST_LIMIT": 2})  # A second process sharing the database
+    client.post("/api/auth/register", json={"email": "otp@test.com", "password": "old", "role": "staff"})
+    otp = client.post("/api/auth/forgot-password", json={"email": "otp@test.com"}).json["otp"]
+    reset = lambda code, password="new": other_worker.test_client().post("/api/auth/reset-password", json={
+        "email": "otp@test.com", "otp": code, "new_password": password}).status_code
+    check("Code issued by one worker is accepted by another", reset(otp) == 200 and reset(otp) == 400)
+    otp = client.post("/api/auth/forgot-password", json={"email": "otp@test.com"}).json["otp"]
+    with app.app_context():
+        stored = db.session.execute(db.text("SELECT code_hash FROM otp_code")).scalar()
+    check("Only a hash is stored", stored and otp not in stored)
+    wrong = f"{(int(otp) + 1) % 1000000:06d}"
+    burnt = [reset(wrong) for _ in range(5)] + [reset(otp)]
+    check("Five wrong guesses burn the code", burnt == [400] * 6)
+    limited = client.post("/api/auth/forgot-password", json={"email": "otp@test.com"}).status_code
+    check("Reset requests are rate limited", limited == 429)
+    with app.app_context():
+        db.session.execute(db.text("UPDATE otp_code SET expires_at = '2000-01-01 00:00:00.000000'"))
+        db.session.execute(db.text("INSERT INTO otp_code (email, code_hash, attempts, expires_at) "
+                                   "VALUES ('gone@test.com', 'x', 0, '2000-01-01 00:00:00.000000')"))
+        db.session.execute(db.text("UPDATE rate_limit_counter SET expires_at = '2000-01-01 00:00:00.000000'"))
+        db.session.commit()
+    again = client.post("/api/auth/forgot-password", json={"email": "otp@test.com"}).status_code
+    with app.app_context():
+        left = db.session.execute(db.text("SELECT email FROM otp_code")).scalars().all()
+    check("Expired codes are purged in bulk", again == 200 and left == ["otp@test.com"])
+    store = MemoryOtpStore(max_entries=100)
+    with app.app_context():
+        for i in range(1000):
+            store.save(f"spam{i}@test.com", "x", datetime.utcnow() + timedelta(minutes=5))
+    check("Memory store stays bounded", len(store.codes) == 100)
+
+def test_16_synthetic_data():
+    print("\n16. SYNTHETIC DATA GENERATOR")
+    snapshots = []
+    for _ in range(2):
+        app, client, _ = temp_app("synthetic")
+        with app.app_context():
+            written = populate(seed=7, warehouses=2, locations=2, products=40, years=1, moves=3000,
+                               end_date=date(2025, 6, 30), log=lambda message: None)
+            moves = db.session.execute(text(
+                "SELECT reference, product_id, from_location_id, to_location_id, quantity, created_at "
+                "FROM stock_move ORDER BY id")).all()
+            mismatched = db.session.execute(text(
+                "SELECT COUNT(*) FROM stock_quant q WHERE q.quantity != ("
+                "  SELECT COALESCE(SUM(CASE WHEN m.to_location_id = q.warehouse_id THEN m.quantity ELSE -m.quantity END), 0)"
+                "  FROM stock_move m WHERE m.product_id = q.product_id"
+                "  AND q.warehouse_id IN (m.to_location_id, m.from_location_id))")).scalar()
+            negative = StockQuant.query.filter(StockQuant.quantity < 0).count()
+            found = client.get("/api/products/suggest?q=a", headers=manager_headers(client)).json  # populate reset the users
+        snapshots.append(moves)
+    check(f"About the requested volume ({written} moves)", 2400 <= written <= 3300 and len(moves) == written)
+    check("Same seed, same data", snapshots[0] == snapshots[1])
+    check("Quants equal the sum of the moves", mismatched == 0 and negative == 0)
+    check("Search index rebuilt after the load", len(found) > 0)
+
+def test_17_route_metrics():
+    print("\n17. ROUTE METRICS")
+    app, client, h = temp_app("metrics")
+    for _ in range(3):
+        client.get("/api/products", headers=h)
+    client.get("/api/products/999999", headers=h)
+    client.get("/api/no-such-route", headers=h)
+    response = client.get("/metrics")
+    samples = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    route = 'route="/api/products",method="GET"'
+    buckets = [value for name, value in samples.items()
+               if name.startswith("stockmaster_http_request_duration_seconds_bucket{" + route)]
+    check("Prometheus text format", response.status_code == 200 and response.mimetype == "text/plain")
+    check("Requests counted per route and status",
+          samples.get(f'stockmaster_http_requests_total{{{route},status="200"}}') == 3
+          and any('route="/api/products/<int:id>"' in name for name in samples))
+    check("Latency histogram is cumulative",
+          buckets == sorted(buckets) and buckets[-1] == 3
+          and samples.get(f"stockmaster_http_request_duration_seconds_count{{{route}}}") == 3)
+    check("SQL statements and time recorded",
+          samples.get(f"stockmaster_sql_statements_total{{{route}}}", 0) >= 3
+          and samples.get(f"stockmaster_sql_duration_seconds_total{{{route}}}", 0) > 0)
+    check("Unknown routes and /metrics are not labelled",
+          not any("no-such-route" in name or 'route="/metrics"' in name for name in samples))
+
+def test_18_counts_with_bins():
+    print("\n18. COUNTS AGAINST BINNED STOCK")
+    app, client, h = temp_app("bins")
+    wh = client.post("/api/warehouses", json={"name": "Bins", "short_code": "BN"}, headers=h).json["id"]
+    a1, a2 = [client.post("/api/locations", json={"name": name, "warehouse_id": wh}, headers=h).json["id"]
+              for name in ("A1", "A2")]
+    pid = client.post("/api/products", json={"name": "Binned item", "sku": "BN-1"}, headers=h).json["id"]
+    r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+        {"product_id": pid, "demand_qty": 10, "done_qty": 10, "location_id": a1},
+        {"product_id": pid, "demand_qty": 5, "done_qty": 5, "location_id": a2},
+        {"product_id": pid, "demand_qty": 3, "done_qty": 3}]}, headers=h).json["id"]
+    client.post(f"/api/receipts/{r}/validate", headers=h)
+
+    def count(qty):
+        status = client.post("/api/adjustments", json={"warehouse_id": wh, "lines": [
+            {"product_id": pid, "counted_qty": qty}]}, headers=h).status_code
+        with app.app_context():
+            quant = StockQuant.query.filter_by(product_id=pid, warehouse_id=wh).one()
+            totals = (quant.quantity, quant.binned_qty)
+        return status, totals, client.get(f"/api/products/{pid}?bins=1", headers=h).json["stock_by_bin"]["Bins"]
+    check("Lower count takes unassigned stock first", count(16) == (201, (16, 15), {"unassigned": 1, "A1": 10, "A2": 5}))
+    check("Then the bins, in location order", count(10) == (201, (10, 10), {"unassigned": 0, "A1": 5, "A2": 5}))
+    check("Higher count is booked unassigned", count(12) == (201, (12, 10), {"unassigned": 2, "A1": 5, "A2": 5}))
+    check("Count can empty every bin", count(0) == (201, (0, 0), {"unassigned": 0}))
+
+def test_19_reference_sequence():
+    print("\n19. REFERENCE SEQUENCES")
+    app, client, h = temp_app("references")
+    wh = client.post("/api/warehouses", json={"name": "Refs", "short_code": "RF"}, headers=h).json["id"]
+    receipt = {"vendor": "V", "warehouse_id": wh, "lines": []}
+    codes = run_concurrently(app, h, ["/api/receipts"] * THREADS, json=receipt)
+    references = sorted(r["reference"] for r in client.get("/api/receipts", headers=h).json)
+    check("Concurrent documents get distinct consecutive numbers",
+          codes == [201] * THREADS and references == [f"WH/IN/{n:04d}" for n in range(1, THREADS + 1)])
+    with app.app_context():
+        db.session.execute(text("INSERT INTO delivery (reference, delivery_address, warehouse_id, status) VALUES ('WH/OUT/0041', 'x', :wh, 'draft')"),
+                           {"wh": wh})
+        db.session.commit()
+    delivery = client.post("/api/deliveries", json={"delivery_address": "x", "warehouse_id": wh, "lines": []}, headers=h)
+    check("New sequence continues after the highest existing reference", delivery.json["reference"] == "WH/OUT/0042")
+
+    def block_database(name):
+        """App on its own database with numbers reserved 10 at a time, and a function creating a receipt"""
+        app, client, h = temp_app(name, REFERENCE_BLOCK_SIZE=10)
+        wh = client.post("/api/warehouses", json={"name": "Blocks", "short_code": "BK"}, headers=h).json["id"]
+        return app, lambda: client.post("/api/receipts", json={**receipt, "warehouse_id": wh}, headers=h).json["reference"]
+    (block_app, create), (_, create_elsewhere) = block_database("blocks"), block_database("other")
+    first = [create(), create()]
+    with block_app.app_context():
+        reserved = db.session.execute(text("SELECT next_value FROM reference_sequence WHERE prefix = 'WH/IN'")).scalar()
+    check("Block size reserves numbers ahead", first == ["WH/IN/0001", "WH/IN/0002"] and reserved == 11)
+    check("Blocks are not shared between databases", create_elsewhere() == "WH/IN/0001")
+
+def test_20_list_etags():
+    print("\n20. CACHED REFERENCE LISTS")
+    app, client, h = temp_app("etags")
+    client.post("/api/warehouses", json={"name": "First", "short_code": "F1"}, headers=h)
+    listed = client.get("/api/warehouses", headers=h)
+    etag = listed.headers["ETag"]
+    unchanged = client.get("/api/warehouses", headers={**h, "If-None-Match": etag})
+    check("Unchanged list answers 304", listed.status_code == 200 and unchanged.status_code == 304)
+    client.post("/api/warehouses", json={"name": "Second", "short_code": "F2"}, headers=h)
+    changed = client.get("/api/warehouses", headers={**h, "If-None-Match": etag})
+    check("A change invalidates the ETag and the cache", changed.status_code == 200 and changed.headers["ETag"] != etag
+          and [w["name"] for w in changed.json] == ["First", "Second"])
+
+    etag = changed.headers["ETag"]
+    with app.app_context():  # Rebuild the database under the running app, as populate_db does
+        db.drop_all()
+        db.create_all()
+    h = manager_headers(client)
+    for name, code in (("Rebuilt", "R1"), ("Rebuilt 2", "R2")):  # Same version count as before the rebuild
+        client.post("/api/warehouses", json={"name": name, "short_code": code}, headers=h)
+    revalidated = client.get("/api/warehouses", headers={**h, "If-None-Match": etag})
+    fresh = client.get("/api/warehouses", headers=h).json
+    check("Rebuilt database never matches an old ETag", revalidated.status_code == 200
+          and [w["name"] for w in revalidated.json] == ["Rebuilt", "Rebuilt 2"])
+    check("Rebuilt database is not served from the cache", [w["name"] for w in fresh] == ["Rebuilt", "Rebuilt 2"])
+
+def test_21_reorder_watchlist():
+    print("\n21. REORDER WATCHLIST")
+    app, client, h = temp_app("watchlist")
+    wh, wh2 = [client.post("/api/warehouses", json={"name": f"Watch {i}", "short_code": f"WA{i}"}, headers=h).json["id"]
+               for i in (1, 2)]
+    pid = client.post("/api/products", json={"name": "Watched", "sku": "WA-1", "reorder_min": 10,
+                                             "initial_stock": {str(wh): 5, str(wh2): 20}}, headers=h).json["id"]
+
+    def watched():
+        rows = client.get("/api/stock-quants/reorder-watchlist?limit=1000", headers=h).json
+        return sorted((w["product_id"], w["warehouse_id"], w["quantity"]) for w in rows)
+    check("Quant below its minimum is watched", watched() == [(pid, wh, 5)])
+    r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+        {"product_id": pid, "demand_qty": 10, "done_qty": 10}]}, headers=h).json["id"]
+    client.post(f"/api/receipts/{r}/validate", headers=h)
+    check("Restocked quant leaves the watchlist", watched() == [])
+    client.put(f"/api/products/{pid}", json={"reorder_min": 30}, headers=h)
+    check("Raised minimum watches every warehouse", watched() == [(pid, wh, 15), (pid, wh2, 20)])
+    client.put(f"/api/products/{pid}", json={"reorder_min": 16}, headers=h)
+    check("Lowered minimum drops recovered quants", watched() == [(pid, wh, 15)])
+
+    with app.app_context():  # More low quants than a default SQLite build allows bound parameters (32766)
+        event.listen(db.engine, "connect", lambda conn, record: conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 32766))
+        db.engine.dispose()
+        db.session.execute(text("INSERT INTO product (id, name, sku, reorder_min) VALUES (:id, :sku, :sku, 5)"),
+                           [{"id": i, "sku": f"LOW-{i}"} for i in range(1000, 18000)])
+        db.session.execute(text("INSERT INTO stock_quant (product_id, warehouse_id, quantity, binned_qty, reserved_qty) "
+                                "SELECT id, :wh, 1, 0, 0 FROM product WHERE id >= 1000"), {"wh": wh2})
+        db.session.execute(text("INSERT INTO reorder_watch (product_id, warehouse_id, quantity, reorder_min) "
+                                "VALUES (:pid, :wh, 0, 16)"), {"pid": pid, "wh": wh2})  # Stale row
+        db.session.commit()
+        rebuild_kpis()
+        rows = db.session.execute(text("SELECT COUNT(*), SUM(product_id = :pid) FROM reorder_watch"), {"pid": pid}).one()
+    check("Rebuild re-derives the whole watchlist", tuple(rows) == (17001, 1))
+
+def test_22_move_date_filters():
+    print("\n22. STOCK MOVE DATE FILTERS")
+    app, client, h = temp_app("movedates")
+    wh = client.post("/api/warehouses", json={"name": "Dates", "short_code": "DT"}, headers=h).json["id"]
+    pid = client.post("/api/products", json={"name": "Dated item", "sku": "DT-1"}, headers=h).json["id"]
+    for qty in (1, 2):
+        r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+            {"product_id": pid, "demand_qty": qty, "done_qty": qty}]}, headers=h).json["id"]
+        client.post(f"/api/receipts/{r}/validate", headers=h)
+    with app.app_context():
+        first, second = [m.id for m in StockMove.query.order_by(StockMove.id)]
+        for move_id, created_at in ((first, "2025-03-31 15:00:00.000000"), (second, "2025-04-01 09:00:00.000000")):
+            db.session.execute(text("UPDATE stock_move SET created_at = :at WHERE id = :id"), {"at": created_at, "id": move_id})
+        db.session.commit()
+
+    def moves(query):
+        response = client.get(f"/api/stock-moves?product_id={pid}&{query}", headers=h)
+        return [m["id"] for m in response.json] if response.status_code == 200 else response.status_code
+    check("Bare date_to includes that whole day", moves("date_to=2025-03-31") == [first])
+    check("date_from and date_to bound the range", moves("date_from=2025-04-01&date_to=2025-04-01") == [second])
+    check("Malformed dates and cursors are rejected with 400",
+          [moves("date_from=yesterday"), moves("date_to=2025-13-01"), moves("after=nope"), moves("after=x|1")] == [400] * 4)
+    check("Malformed document list cursor is rejected with 400",
+          client.get("/api/receipts?after=nope", headers=h).status_code == 400)
+
+def test_23_count_sessions():
+    print("\n23. COUNT SESSIONS")
+    app, client, h = temp_app("counts")
+    wh = client.post("/api/warehouses", json={"name": "Counts", "short_code": "CN"}, headers=h).json["id"]
+    p1 = client.post("/api/products", json={"name": "Counted 1", "sku": "CN-1", "initial_stock": {str(wh): 10}},
+                     headers=h).json["id"]
+    p2 = client.post("/api/products", json={"name": "Counted 2", "sku": "CN-2"}, headers=h).json["id"]
+    session = client.post("/api/adjustments/counts", json={"warehouse_id": wh}, headers=h).json["id"]
+    staged = client.post(f"/api/adjustments/counts/{session}/lines", json={"lines": [
+        {"product_id": p1, "counted_qty": 4}, {"sku": "CN-2", "counted_qty": 3}, {"product_id": 999999, "counted_qty": 1},
+        {"sku": "NOPE", "counted_qty": 1}, {"product_id": p1, "counted_qty": -1}]}, headers=h).json
+    check("Rejected rows are errors, not imports", staged["imported"] == 2 and staged["error_count"] == 3
+          and staged["line_count"] == 2 and {e["row"] for e in staged["errors"]} == {3, 4, 5})
+    added = client.post(f"/api/adjustments/counts/{session}/lines?mode=add", data=b"sku,counted_qty\nCN-1,2\n",
+                        headers={**h, "Content-Type": "text/csv"}).json
+    check("Second scanner adds to a staged count", added["imported"] == 1 and added["line_count"] == 2)
+    applied = client.post(f"/api/adjustments/counts/{session}/apply", headers=h)
+    on_hand = [client.get(f"/api/products/{pid}", headers=h).json["on_hand"] for pid in (p1, p2)]
+    check("Applied counts set the stock", applied.status_code == 200 and applied.json["line_count"] == 2
+          and on_hand == [6, 3])
+    check("A session applies only once", client.post(f"/api/adjustments/counts/{session}/apply", headers=h).status_code == 400)
+
+def test_24_reservations():
+    print("\n24. DELIVERY RESERVATIONS")
+    app, client, h = temp_app("reservations")
+    wh = client.post("/api/warehouses", json={"name": "Reserve", "short_code": "RS"}, headers=h).json["id"]
+    pid = client.post("/api/products", json={"name": "Reserved item", "sku": "RS-1"}, headers=h).json["id"]
+
+    def delivery(priority, scheduled_date):
+        d = client.post("/api/deliveries", json={"delivery_address": "x", "warehouse_id": wh, "priority": priority,
+                                                  "scheduled_date": scheduled_date, "lines": [
+            {"product_id": pid, "demand_qty": 4, "done_qty": 4}]}, headers=h).json["id"]
+        return d, client.post(f"/api/deliveries/{d}/mark-ready", headers=h).json
+    (late, ready), (early, _), (urgent, _) = delivery(0, "2025-05-10"), delivery(0, "2025-05-01"), delivery(5, None)
+    check("Ready without stock reports the shortfall", not ready["fully_reserved"]
+          and ready["shortages"] == [{"product_id": pid, "needed": 4, "reserved": 0}])
+
+    r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+        {"product_id": pid, "demand_qty": 10, "done_qty": 10}]}, headers=h).json["id"]
+    client.post(f"/api/receipts/{r}/validate", headers=h)
+    sweep = client.post("/api/deliveries/reserve", headers=h).json
+
+    def reserved(d):
+        return client.get(f"/api/deliveries/{d}", headers=h).json["lines"][0]["reserved_qty"]
+    def quant():
+        q = client.get(f"/api/stock-quants?warehouse_id={wh}", headers=h).json[0]
+        return q["quantity"], q["reserved_qty"], q["available_qty"]
+    check("Sweep allocates by priority, then scheduled date", [reserved(d) for d in (urgent, early, late)] == [4, 4, 2])
+    check("Partial reservation is reported", sweep["fully_reserved"] == 2 and sweep["shortages"] == [
+        {"delivery_id": late, "lines": [{"product_id": pid, "needed": 4, "reserved": 2}]}])
+    check("Reserved stock is not available", quant() == (10, 10, 0))
+    client.post(f"/api/deliveries/{early}/cancel", headers=h)
+    check("Cancel releases the reservation", reserved(early) == 0 and quant() == (10, 6, 4))
+    client.post("/api/deliveries/reserve", headers=h)
+    check("Released stock goes to the waiting delivery", reserved(late) == 4 and quant() == (10, 8, 2))
+    validated = client.post(f"/api/deliveries/{urgent}/validate", headers=h).status_code
+    check("Validation consumes its own reservation", validated == 200 and quant() == (6, 4, 2))
+
+def test_25_archive_id_reuse():
+    print("\n25. MOVE IDS ACROSS ARCHIVE RUNS")
+    app, client, h = temp_app("reuse")
+    wh = client.post("/api/warehouses", json={"name": "Reuse", "short_code": "RU"}, headers=h).json["id"]
+    pid = client.post("/api/products", json={"name": "Reused item", "sku": "RU-1"}, headers=h).json["id"]
+
+    def receive_and_archive(*quantities):
+        for qty in quantities:
+            r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+                {"product_id": pid, "demand_qty": qty, "done_qty": qty}]}, headers=h).json["id"]
+            client.post(f"/api/receipts/{r}/validate", headers=h)
+        with app.app_context():
+            ids = [m.id for m in StockMove.query.order_by(StockMove.id)]
+            db.session.execute(text("UPDATE stock_move SET created_at = '2024-01-10 12:00:00.000000'"))
+            db.session.commit()
+            archived = archive_moves(datetime(2024, 2, 15)).move_count
+            return ids, archived, StockMove.query.count()
+
+    first_ids, first_archived, live = receive_and_archive(10, 5)
+    check("First run archives every live move", first_archived == 2 and live == 0)
+    new_ids, second_archived, _ = receive_and_archive(3)
+    with app.app_context():
+        archived_ids = [m.id for m in ArchivedStockMove.query.order_by(ArchivedStockMove.id)]
+    check("The next move gets a new id", new_ids[0] > max(first_ids))
+    check("Second run archives it as well", second_archived == 1 and archived_ids == first_ids + new_ids)
+    monthly = client.get(f"/api/stock-moves/monthly?product_id={pid}", headers=h).json
+    check("Rollups hold every move once", [(m["month"], m["qty_in"], m["move_count"]) for m in monthly] == [("2024-01", 18, 3)])
+
+    # Snapshots bound their windows by move id: a move made after emptying stock_move is still newer
+    with app.app_context():
+        full = take_snapshot().to_dict()
+        db.session.commit()
+    r = client.post("/api/receipts", json={"vendor": "V", "warehouse_id": wh, "lines": [
+        {"product_id": pid, "demand_qty": 4, "done_qty": 4}]}, headers=h).json["id"]
+    client.post(f"/api/receipts/{r}/validate", headers=h)
+    time.sleep(0.01)
+    as_of = datetime.utcnow().isoformat()
+    with app.app_context():
+        incremental = take_snapshot().to_dict()
+        db.session.commit()
+    check("Snapshot after archiving keeps the move high-water mark", full["last_move_id"] == max(new_ids))
+    check("Incremental run picks up the new move", not incremental["is_full"] and incremental["row_count"] == 1)
+    check("as_of after the runs", client.get(f"/api/products/{pid}?as_of={as_of}", headers=h).json["on_hand"] == 22)
+
+    # A database created before AUTOINCREMENT: rebuilt on start, ids continue above the archived ones
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE stock_move (id INTEGER NOT NULL PRIMARY KEY, reference VARCHAR(50), "
+                 "product_id INTEGER NOT NULL, quantity FLOAT, created_at DATETIME)")
+    conn.execute("INSERT INTO stock_move (id, reference, product_id, quantity) VALUES (5, 'OLD', 1, 2.0)")
+    conn.execute("CREATE TABLE move_archive_run (id INTEGER NOT NULL PRIMARY KEY, through_move_id INTEGER)")
+    conn.execute("INSERT INTO move_archive_run (through_move_id) VALUES (9)")
+    conn.commit()
+    conn.close()
+    legacy = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}"})
+    weakref.finalize(legacy, shutil.rmtree, tmp, ignore_errors=True)
+    with legacy.app_context():
+        ddl = db.session.execute(text("SELECT sql FROM sqlite_master WHERE name = 'stock_move'")).scalar()
+        kept = [(m.id, m.reference, m.state) for m in StockMove.query]
+        db.session.execute(text("DELETE FROM stock_move"))
+        db.session.execute(text("INSERT INTO stock_move (product_id, quantity) VALUES (1, 1.0)"))
+        next_id = db.session.execute(text("SELECT MAX(id) FROM stock_move")).scalar()
+        db.session.commit()
+    check("Old stock_move rebuilt with AUTOINCREMENT, rows kept", "AUTOINCREMENT" in ddl.upper() and kept == [(5, "OLD", None)])
+    check("Rebuilt table continues above archived ids", next_id == 10)
+
+def test_26_kpi_consistency():
+    print("\n26. INCREMENTAL KPIS vs REBUILD")
+    app, client, h = temp_app("kpis")
+    wh1, wh2 = [client.post("/api/warehouses", json={"name": f"KPI {i}", "short_code": f"K{i}"}, headers=h).json["id"]
+                for i in (1, 2)]
+    a = client.post("/api/products", json={"name": "Kpi A", "sku": "KPI-A", "cost": 2, "reorder_min": 5}, headers=h).json["id"]
+    b = client.post("/api/products", json={"name": "Kpi B", "sku": "KPI-B", "cost": 3}, headers=h).json["id"]
+    c = client.post("/api/products", json={"name": "Kpi C", "sku": "KPI-C", "cost": 1.5,
+                                           "initial_stock": {str(wh2): 8}}, headers=h).json["id"]
+    gone = client.post("/api/products", json={"name": "Kpi D", "sku": "KPI-D"}, headers=h).json["id"]
+
+    def post(url, body=None):
+        response = client.post(url, json=body, headers=h)
+        assert response.status_code in (200, 201), f"{url}: {response.get_data(as_text=True)}"
+        return response.json
+
+    def receipt(lines, warehouse=wh1):
+        return post("/api/receipts", {"vendor": "V", "warehouse_id": warehouse, "scheduled_date": "2020-01-01",
+                                      "lines": [{"product_id": p, "demand_qty": q, "done_qty": q} for p, q in lines]})["id"]
+
+    def delivery(lines):
+        return post("/api/deliveries", {"delivery_address": "x", "warehouse_id": wh1, "scheduled_date": "2020-01-01",
+                                        "lines": [{"product_id": p, "demand_qty": q, "done_qty": q} for p, q in lines]})["id"]
+
+    post(f"/api/receipts/{receipt([(a, 10), (b, 4)])}/validate")
+    post(f"/api/receipts/{receipt([(b, 6)], wh2)}/validate")
+    post(f"/api/receipts/{receipt([(a, 1)])}/cancel")
+    receipt([(c, 2)])  # Stays pending (and late)
+    shipped, canceled, waiting = delivery([(a, 3)]), delivery([(b, 1)]), delivery([(a, 2)])
+    for d in (shipped, canceled, waiting):
+        post(f"/api/deliveries/{d}/mark-ready")
+    post(f"/api/deliveries/{shipped}/validate")
+    post(f"/api/deliveries/{canceled}/cancel")
+    delivery([(b, 1)])  # Draft delivery
+    moved = post("/api/transfers", {"from_warehouse_id": wh1, "to_warehouse_id": wh2, "lines": [{"product_id": a, "quantity": 2}]})["id"]
+    post(f"/api/transfers/{moved}/validate")
+    post("/api/transfers", {"from_warehouse_id": wh2, "to_warehouse_id": wh1, "lines": [{"product_id": c, "quantity": 1}]})
+    client.put(f"/api/products/{a}", json={"cost": 4, "reorder_min": 20}, headers=h)
+    client.put(f"/api/products/{b}", json={"reorder_min": 5}, headers=h)
+    check("Product without stock deleted", client.delete(f"/api/products/{gone}", headers=h).status_code == 200)
+    ndjson = (f'{{"sku": "KPI-E", "name": "Kpi E", "cost": 2, "initial_stock": {{"{wh1}": 5}}}}\n'
+              '{"sku": "KPI-F", "name": "Kpi F", "reorder_min": 1}\n')
+    imported = client.post("/api/products/import", data=ndjson.encode(), headers={**h, "Content-Type": "application/x-ndjson"}).json
+    check("Import ran", imported["imported"] == 2)
+    session = post("/api/adjustments/counts", {"warehouse_id": wh2})["id"]
+    post(f"/api/adjustments/counts/{session}/lines", {"lines": [{"product_id": b, "counted_qty": 0}, {"product_id": c, "counted_qty": 12}]})
+    post(f"/api/adjustments/counts/{session}/apply")
+    post("/api/adjustments", {"warehouse_id": wh1, "lines": [{"product_id": a, "counted_qty": 30}]})
+
+    incremental = client.get("/api/dashboard/summary", headers=h).json
+    with app.app_context():
+        rebuild_kpis()
+    rebuilt = client.get("/api/dashboard/summary", headers=h).json
+    check("Maintained KPIs match a full rebuild", incremental == rebuilt)
+    check("KPIs saw the operations", incremental["totalProducts"] == 5 and incremental["receiptsToReceive"] == 1
+          and incremental["lowStockCount"] > 0 and incremental["outOfStockCount"] > 0)
+
+def test_27_atomic_posting():
+    print("\n27. ALL-OR-NOTHING POSTING")
+    app, client, h = temp_app("atomic")
+    wh = client.post("/api/warehouses", json={"name": "Atomic", "short_code": "AT"}, headers=h).json["id"]
+    products = [client.post("/api/products", json={"name": f"Atomic {i}", "sku": f"AT-{i}",
+                                                   "initial_stock": {str(wh): 10}}, headers=h).json["id"] for i in range(3)]
+    lines = [{"product_id": p, "demand_qty": 4, "done_qty": 4} for p in products[:2]]
+    lines.append({"product_id": products[2], "demand_qty": 11, "done_qty": 11})  # More than on hand
+    d = client.post("/api/deliveries", json={"delivery_address": "x", "warehouse_id": wh, "lines": lines}, headers=h).json["id"]
+    client.post(f"/api/deliveries/{d}/mark-ready", headers=h)
+
+    def state():
+        quants = client.get(f"/api/stock-quants?warehouse_id={wh}", headers=h).json
+        with app.app_context():
+            moves = StockMove.query.count()
+        return sorted((q["product_id"], q["quantity"], q["reserved_qty"]) for q in quants), moves
+    before = state()
+    response = client.post(f"/api/deliveries/{d}/validate", headers=h)
+    check("Failing last line rejects the delivery", response.status_code == 400)
+    check("No quant or move changed", state() == before)
+    check("Delivery keeps its status", client.get(f"/api/deliveries/{d}", headers=h).json["status"] == "ready")
+
+def test_28_product_pages():
+    print("\n28. PRODUCT KEYSET PAGES")
+    app, client, h = temp_app("product-pages")
+    wh1, wh2 = [client.post("/api/warehouses", json={"name": f"Pages {i}", "short_code": f"PG{i}"}, headers=h).json["id"]
+                for i in (1, 2)]
+    expected = {}
+    for i in range(1, 26):
+        stock = {str(wh1): i, str(wh2): 2 * i} if i % 5 else {}  # Every fifth product has no stock
+        pid = client.post("/api/products", json={"name": f"Paged {i}", "sku": f"PG-{i}", "initial_stock": stock}, headers=h).json["id"]
+        expected[pid] = 3.0 * i if i % 5 else 0.0
+    with app.app_context():
+        engine = db.engine
+    statements = [0]
+    def count_statement(*args):
+        statements[0] += 1
+    client.get("/api/products?limit=7", headers=h)  # Warm-up (token version cache)
+    event.listen(engine, "before_cursor_execute", count_statement)
+    pages, counts, cursor = [], [], None
+    try:
+        while True:
+            statements[0] = 0
+            response = client.get("/api/products?limit=7" + (f"&after={cursor}" if cursor else ""), headers=h)
+            counts.append(statements[0])
+            pages.append(response.json)
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    ids = [p["id"] for page in pages for p in page]
+    check("Pages of 7 until the cursor runs out", [len(page) for page in pages] == [7, 7, 7, 4])
+    check("No duplicates or gaps across pages", ids == sorted(expected))
+    check("on_hand summed over warehouses", all(p["on_hand"] == expected[p["id"]] for page in pages for p in page))
+    check("Same statement count on every page", len(set(counts)) == 1 and counts[0] <= 2)
+    check("Invalid cursor rejected", client.get("/api/products?after=abc", headers=h).status_code == 400)
+
+def test_29_product_import():
+    print("\n29. PRODUCT IMPORT REPORT")
+    app, client, h = temp_app("import")
+    wh = client.post("/api/warehouses", json={"name": "Import", "short_code": "IM"}, headers=h).json["id"]
+    client.post("/api/products", json={"name": "Existing", "sku": "IM-OLD"}, headers=h)
+    ndjson = "\n".join([
+        f'{{"sku": "IM-1", "name": "Stocked", "category": "Imported", "cost": 2.5, "initial_stock": {{"{wh}": 7}}}}',
+        '{"sku": "IM-2", "name": "Plain", "reorder_min": 3}',
+        '{"sku": "IM-1", "name": "Same SKU again"}',          # Duplicate within the file
+        '{"sku": "IM-OLD", "name": "Already in the database"}',
+        '{"sku": "IM-3"}',                                     # No name
+        '{"sku": "IM-4", "name": "Bad cost", "cost": "cheap"}',
+        '{"sku": "IM-5", "name": "Nowhere", "initial_stock": {"9999": 1}}',
+        '{not json',
+        '["not", "an", "object"]',
+    ]) + "\n"
+    report = client.post("/api/products/import", data=ndjson.encode(),
+                         headers={**h, "Content-Type": "application/x-ndjson"}).json
+    errors = {e["row"]: (e["sku"], e["error"]) for e in report["errors"]}
+    check("Valid rows imported, the rest reported", report["imported"] == 2 and report["error_count"] == 7
+          and not report["errors_truncated"])
+    check("Duplicate SKUs (file and database) reported per row", errors[3] == ("IM-1", "SKU exists") and errors[4] == ("IM-OLD", "SKU exists"))
+    check("Bad rows reported with their reason", errors[5][1] == "Name and SKU required" and errors[6][0] == "IM-4"
+          and "Unknown warehouse" in errors[7][1] and errors[8][1].startswith("Invalid JSON") and 9 in errors)
+
+    stocked = client.get("/api/products?q=IM-1", headers=h).json
+    with app.app_context():
+        moves = [(m.product_id, m.to_location_id, m.quantity, m.reference) for m in StockMove.query]
+    check("Imported product with its category and stock", len(stocked) == 1 and stocked[0]["on_hand"] == 7
+          and stocked[0]["category"] == "Imported" and stocked[0]["cost"] == 2.5)
+    check("Initial stock written as a StockMove", moves == [(stocked[0]["id"], wh, 7.0, "IMPORT")])
+    csv = "sku,name,warehouse_id,initial_qty\nIM-6,From CSV,,4\nIM-7,From CSV,,\n"
+    report = client.post("/api/products/import", data=csv.encode(), headers={**h, "Content-Type": "text/csv"}).json
+    check("CSV stock without a warehouse reported", report["imported"] == 1 and report["errors"] == [
+        {"row": 1, "sku": "IM-6", "error": "warehouse_id required with initial_qty"}])
+
 # ===================================================================
 # RUN
 # ===================================================================
 if __name__ == "__main__":
+    test_05_query_plans()
+    test_06_concurrent_validations()
+    test_07_background_jobs()
+    test_08_event_stream()
+    test_09_stock_as_of()
+    test_10_move_archive()
+    test_11_field_projection()
+    test_12_document_lists()
+    test_13_product_search()
+    test_14_jwt_claims()
+    test_15_otp_store()
+    test_16_synthetic_data()
+    test_17_route_metrics()
+    test_18_counts_with_bins()
+    test_19_reference_sequence()
+    test_20_list_etags()
+    test_21_reorder_watchlist()
+    test_22_move_date_filters()
+    test_23_count_sessions()
+    test_24_reservations()
+    test_25_archive_id_reuse()
+    test_26_kpi_consistency()
+    test_27_atomic_posting()
+    test_28_product_pages()
+    test_29_product_import()
     test_01_auth()
     test_02_warehouse_location()
     if warehouse_id:  # Only continue if warehouse created